@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""SQLite profile benchmark
+
+Measure ConfigDB.update_tree throughput with each SQLite tuning profile in
+soundforest.models.SQLITE_PROFILES. A tree of generated FLAC tracks is added
+to a new database and updated twice: first update inserts all tracks, and
+second update after touching all files rewrites them.
+
+Each profile runs in a separate process with a temporary home directory,
+because ConfigDB is a singleton.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+DEFAULT_ALBUMS = 50
+DEFAULT_TRACKS = 10
+
+# FLAC STREAMINFO for 44.1 kHz stereo 16 bit stream with unknown length
+FLAC_STREAMINFO = struct.pack('>HH', 4096, 4096) + b'\x00' * 6 + \
+    ((44100 << 44) | (1 << 41) | (15 << 36)).to_bytes(8, 'big') + b'\x00' * 16
+
+
+def create_tree(path, albums, tracks):
+    """Create benchmark tree
+
+    Create albums directories with tracks tagged FLAC files each
+    """
+    from mutagen.flac import FLAC
+
+    for album in range(albums):
+        directory = os.path.join(path, 'Artist {:d}'.format(album), 'Album {:d}'.format(album))
+        os.makedirs(directory)
+        for track in range(tracks):
+            filename = os.path.join(directory, '{:02d} Track {:d}.flac'.format(track + 1, track + 1))
+            with open(filename, 'wb') as fd:
+                fd.write(b'fLaC\x80' + len(FLAC_STREAMINFO).to_bytes(3, 'big') + FLAC_STREAMINFO)
+                fd.write(os.urandom(4096))
+
+            tags = FLAC(filename)
+            tags['artist'] = 'Artist {:d}'.format(album)
+            tags['album'] = 'Album {:d}'.format(album)
+            tags['title'] = 'Track {:d}'.format(track + 1)
+            tags['tracknumber'] = '{:d}'.format(track + 1)
+            tags.save()
+
+
+def update(path, profile):
+    """Update tree with profile
+
+    Returns dictionary with seconds used by initial and repeated tree update
+    """
+    from soundforest.database import ConfigDB
+    from soundforest.tree import Tree
+
+    db = ConfigDB()
+    db.set('sqlite_profile', profile)
+    db.session.close()
+    db.session.bind.dispose()
+    db.add_tree(path)
+
+    results = {}
+    for name in ('insert', 'update'):
+        if name == 'update':
+            now = time.time()
+            for root, directories, files in os.walk(path):
+                for filename in files:
+                    os.utime(os.path.join(root, filename), (now, now))
+
+        started = time.time()
+        db.update_tree(Tree(path))
+        results[name] = time.time() - started
+
+    results['journal_mode'] = db.session.execute('pragma journal_mode').scalar()
+    return results
+
+
+def run(workdir, albums=DEFAULT_ALBUMS, tracks=DEFAULT_TRACKS, profiles=None):
+    """Run benchmark
+
+    Returns list of (profile, journal mode, tracks, insert seconds, update
+    seconds) tuples
+    """
+    from soundforest.models import SQLITE_PROFILES
+
+    path = os.path.join(workdir, 'tree')
+    create_tree(path, albums, tracks)
+
+    results = []
+    for profile in profiles or sorted(SQLITE_PROFILES):
+        env = dict(os.environ)
+        env['HOME'] = os.path.join(workdir, profile)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, (ROOT, env.get('PYTHONPATH', None))))
+        os.makedirs(env['HOME'])
+
+        command = [sys.executable, os.path.realpath(__file__), '--worker', profile, path]
+        output = subprocess.check_output(command, env=env)
+        result = json.loads(output.decode('utf-8').strip().split('\n')[-1])
+        results.append((profile, result['journal_mode'], albums * tracks, result['insert'], result['update']))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-a', '--albums', type=int, default=DEFAULT_ALBUMS, help='Number of albums')
+    parser.add_argument('-n', '--tracks', type=int, default=DEFAULT_TRACKS, help='Tracks per album')
+    parser.add_argument('-p', '--profile', action='append', help='Profiles to benchmark')
+    parser.add_argument('--worker', nargs=2, metavar=('PROFILE', 'PATH'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(update(args.worker[1], args.worker[0])))
+        return
+
+    workdir = tempfile.mkdtemp(prefix='soundforest-benchmark-')
+    try:
+        results = run(workdir, args.albums, args.tracks, args.profile)
+    finally:
+        shutil.rmtree(workdir)
+
+    print('{:<12} {:<8} {:>7} {:>10} {:>10} {:>10} {:>10}'.format(
+        'profile', 'journal', 'tracks', 'insert', 'tracks/s', 'update', 'tracks/s'
+    ))
+    for profile, journal_mode, count, inserted, updated in results:
+        print('{:<12} {:<8} {:7d} {:9.3f}s {:10.1f} {:9.3f}s {:10.1f}'.format(
+            profile, journal_mode, count,
+            inserted, count / max(inserted, 0.000001),
+            updated, count / max(updated, 0.000001),
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Tree walk benchmark
+
+Compare serial and parallel Tree walks on generated trees with different
+directory fan-out. Latency of network filesystems is simulated by delaying
+each directory listing with --latency milliseconds.
+
+Runs with a temporary home directory, so the user configuration database
+is not used.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+DEFAULT_FANOUTS = (2, 4, 8, 16)
+DEFAULT_DEPTH = 2
+DEFAULT_FILES = 10
+DEFAULT_THREADS = 8
+DEFAULT_LATENCY = 5.0
+
+
+def create_tree(path, fanout, depth, files):
+    """Create benchmark tree
+
+    Create fanout subdirectories per level, depth levels deep, with files
+    empty mp3 files in each leaf directory. Returns number of directories.
+    """
+    os.makedirs(path)
+    if depth == 0:
+        for index in range(files):
+            open(os.path.join(path, '{:02d} Track.mp3'.format(index + 1)), 'w').close()
+        return 1
+
+    directories = 1
+    for index in range(fanout):
+        directories += create_tree(os.path.join(path, 'Directory {:d}'.format(index)), fanout, depth - 1, files)
+    return directories
+
+
+def walk(path, parallel, threads, latency):
+    """Walk tree
+
+    Returns (seconds, files) for loading the tree, with latency seconds added
+    to each directory listing
+    """
+    from soundforest.tree import Tree
+
+    scandir = os.scandir
+
+    def delayed_scandir(path):
+        time.sleep(latency)
+        return scandir(path)
+
+    tree = Tree(path, parallel=parallel, threads=threads)
+    os.scandir = delayed_scandir
+    try:
+        started = time.time()
+        tree.load()
+        elapsed = time.time() - started
+    finally:
+        os.scandir = scandir
+
+    return elapsed, tree.files
+
+
+def run(workdir, fanouts=DEFAULT_FANOUTS, depth=DEFAULT_DEPTH, files=DEFAULT_FILES, threads=DEFAULT_THREADS,
+        latency=DEFAULT_LATENCY):
+    """Run benchmark
+
+    Returns list of (fanout, directories, files, serial seconds, parallel
+    seconds) tuples. Serial and parallel walks must return same files.
+    """
+    results = []
+    for fanout in fanouts:
+        path = os.path.join(workdir, 'fanout-{:d}'.format(fanout))
+        directories = create_tree(path, fanout, depth, files)
+
+        serial, serial_files = walk(path, False, 1, latency / 1000)
+        parallel, parallel_files = walk(path, True, threads, latency / 1000)
+        if serial_files != parallel_files:
+            raise RuntimeError('Parallel walk returned different files for fan-out {:d}'.format(fanout))
+
+        results.append((fanout, directories, len(serial_files), serial, parallel))
+        shutil.rmtree(path)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-f', '--fanout', type=int, action='append', help='Subdirectories per directory')
+    parser.add_argument('-d', '--depth', type=int, default=DEFAULT_DEPTH, help='Directory levels')
+    parser.add_argument('-n', '--files', type=int, default=DEFAULT_FILES, help='Files per leaf directory')
+    parser.add_argument('-t', '--threads', type=int, default=DEFAULT_THREADS, help='Parallel walk threads')
+    parser.add_argument('-l', '--latency', type=float, default=DEFAULT_LATENCY,
+                        help='Milliseconds added to each directory listing')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='soundforest-benchmark-')
+    os.environ['HOME'] = workdir
+    try:
+        results = run(
+            os.path.join(workdir, 'trees'),
+            fanouts=args.fanout or DEFAULT_FANOUTS,
+            depth=args.depth,
+            files=args.files,
+            threads=args.threads,
+            latency=args.latency,
+        )
+    finally:
+        shutil.rmtree(workdir)
+
+    print('{:>7} {:>7} {:>7} {:>10} {:>10} {:>8}'.format(
+        'fanout', 'dirs', 'files', 'serial', 'parallel', 'speedup'
+    ))
+    for fanout, directories, count, serial, parallel in results:
+        print('{:7d} {:7d} {:7d} {:9.3f}s {:9.3f}s {:7.1f}x'.format(
+            fanout, directories, count, serial, parallel, serial / max(parallel, 0.000001)
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,13 +5,18 @@ Audio file tree processing classes
 
 """
 
+import json
 import os
 import sys
+import tempfile
 import unicodedata
 
+from soundforest.defaults import SOUNDFOREST_CACHE_DIR
 
 __version__ = '4.5.0'
 
+DEFAULT_COMMAND_CACHE = os.path.join(SOUNDFOREST_CACHE_DIR, 'commands.json')
+
 
 class SoundforestError(Exception):
     pass
@@ -26,10 +31,10 @@ def normalized(path, normalization='NFC'):
     Return given path value as normalized unicode string on OS/X,
     on other platform return the original string as unicode
     """
-    if sys.platform != 'darwin':
-        return type(path) == str and path or str(path, 'utf-8')
     if not isinstance(path, str):
         path = str(path, 'utf-8')
+    if sys.platform != 'darwin':
+        return path
     return unicodedata.normalize(normalization, path)
 
 
@@ -77,45 +82,120 @@ class path_string(str):
         return path[len(self):].lstrip('/')
 
 
-class CommandPathCache(list):
+class CommandPathCache(dict):
 
     """
     Class to represent commands on user's search path.
+
+    Commands are looked up from PATH directories by name when first
+    requested, and stored by command name. Looked up commands are saved to
+    cache file given as path with flush(), and the saved commands are used
+    until PATH or mtime of any directory on PATH changes. Only the shared
+    soundforest.formats.PATH_CACHE is flushed at exit.
     """
-    def __init__(self):
-        self.paths = None
+    def __init__(self, path=DEFAULT_COMMAND_CACHE):
+        self.path = path
+        self.paths = []
+        self.mtimes = {}
+        self.modified = False
         self.update()
+        self.load()
+
+    def __directory_mtimes(self):
+        mtimes = {}
+        for path in self.paths:
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                mtimes[path] = None
+        return mtimes
 
     def update(self):
         """
-        Updates the commands available on user's PATH
+        Reads directories on user's PATH and clears looked up commands
         """
+        self.clear()
         self.paths = []
-        del self[0:len(self)]
-
-        for path in os.getenv('PATH').split(os.pathsep):
-            if not self.paths.count(path):
+        for path in os.getenv('PATH', '').split(os.pathsep):
+            if path and not self.paths.count(path):
                 self.paths.append(path)
+        self.mtimes = self.__directory_mtimes()
 
-        for path in self.paths:
-            if not os.path.isdir(path):
-                continue
-
-            for cmd in [os.path.join(path, f) for f in os.listdir(path)]:
-                if os.path.isdir(cmd) or not os.access(cmd, os.X_OK):
-                    continue
-
-                self.append(cmd)
+    def load(self):
+        """
+        Loads looked up commands from cache file, if PATH directories have
+        not been modified after the cache file was saved
+        """
+        if self.path is None or not os.path.isfile(self.path):
+            return
+
+        try:
+            with open(self.path, 'r') as fd:
+                data = json.load(fd)
+        except (OSError, ValueError):
+            return
+
+        if not isinstance(data, dict) or data.get('paths', None) != self.paths:
+            return
+        if data.get('mtimes', None) != [self.mtimes[path] for path in self.paths]:
+            return
+
+        commands = data.get('commands', None)
+        if isinstance(commands, dict):
+            # update() is overridden to read PATH
+            dict.update(self, commands)
+
+    def save(self):
+        """
+        Saves looked up commands to cache file
+        """
+        if self.path is None:
+            return
+
+        self.modified = False
+        data = {
+            'paths': self.paths,
+            'mtimes': [self.mtimes[path] for path in self.paths],
+            'commands': dict(self),
+        }
+        try:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as tmpfile:
+                    json.dump(data, tmpfile)
+                os.replace(tmp, self.path)
+            except OSError:
+                os.unlink(tmp)
+                raise
+        except OSError:
+            pass
+
+    def flush(self):
+        """
+        Saves looked up commands to cache file, if new commands were looked up
+        after loading or saving the cache
+        """
+        if self.modified:
+            self.save()
 
     def versions(self, name):
         """
         Returns all commands with given name on path, ordered by PATH search
         order.
         """
-        if not len(self):
-            self.update()
-
-        return [cmd for cmd in self if os.path.basename(cmd) == name]
+        if name not in self:
+            commands = []
+            for path in self.paths:
+                cmd = os.path.join(path, name)
+                if os.path.isfile(cmd) and os.access(cmd, os.X_OK):
+                    commands.append(cmd)
+            self[name] = commands
+            self.modified = True
+
+        return list(self[name])
 
     def which(self, name):
         """
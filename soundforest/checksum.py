@@ -0,0 +1,594 @@
+# coding=utf-8
+"""File checksums
+
+Streaming checksum calculation for audio files
+
+Checksums are stored as '<algorithm>:<hexdigest>' strings. Checksums without
+algorithm prefix were created by older versions and are md5 hexdigests.
+
+Audio checksums are calculated only from the audio payload of the file,
+skipping tags and embedded albumart, and don't change when file is retagged.
+
+"""
+
+import hashlib
+import os
+import struct
+import time
+
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+DEFAULT_CHECKSUM_ALGORITHM = 'md5'
+CHECKSUM_ALGORITHMS = (
+    'md5',
+    'sha1',
+    'sha256',
+    'blake2b',
+)
+
+# Size of chunks read from files while calculating checksums
+CHECKSUM_CHUNK_SIZE = 2**20
+
+# Number of jobs read ahead from job iterator per checksum thread
+CHECKSUM_READAHEAD = 4
+
+ID3V2_HEADER = struct.Struct('>3sBBB4s')
+ID3V1_TAG_SIZE = 128
+APEV2_FOOTER = struct.Struct('<8sIIII8s')
+MP4_ATOM_HEADER = struct.Struct('>I4s')
+OGG_PAGE_HEADER = struct.Struct('<4sBBqIIIB')
+
+# Number of header packets in Ogg logical streams by first packet magic
+OGG_HEADER_PACKETS = {
+    b'\x01vorbis': 3,
+    b'OpusHead': 2,
+    b'\x80theora': 3,
+}
+OGG_HEADER_PROBE_SIZE = 80
+
+
+class ChecksumError(Exception):
+    pass
+
+
+def parse_checksum(value):
+    """Parse checksum string
+
+    Returns (algorithm, hexdigest) tuple for checksum string. Values without
+    algorithm prefix are md5 checksums.
+    """
+    if value is None:
+        return None, None
+
+    try:
+        algorithm, digest = value.split(':', 1)
+    except ValueError:
+        return 'md5', value
+
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        raise ChecksumError('Unsupported checksum algorithm: {}'.format(algorithm))
+
+    return algorithm, digest
+
+
+def checksums_equal(checksum, other):
+    """Compare checksum strings
+
+    Returns True if checksums have same algorithm and hexdigest. Checksums
+    without algorithm prefix are compared as md5 checksums, and invalid
+    checksums don't match anything.
+    """
+    try:
+        return parse_checksum(checksum) == parse_checksum(other)
+    except ChecksumError:
+        return False
+
+
+def format_checksum(algorithm, digest):
+    """Format checksum string
+
+    Returns checksum hexdigest prefixed with algorithm name
+    """
+    return '{}:{}'.format(algorithm, digest)
+
+
+def file_checksum(path, algorithm=DEFAULT_CHECKSUM_ALGORITHM, chunk_size=CHECKSUM_CHUNK_SIZE):
+    """Calculate file checksum
+
+    Reads the file in chunks of chunk_size bytes to a reused buffer, so memory
+    use does not depend on file size. Returns formatted checksum string.
+    """
+    return read_checksums(path, algorithm, chunk_size=chunk_size)[1]
+
+
+def id3v2_size(fd, offset=0):
+    """Size of ID3v2 tag
+
+    Returns size of ID3v2 tag at offset, or 0 if there is no ID3v2 tag
+    """
+    fd.seek(offset)
+    data = fd.read(ID3V2_HEADER.size)
+    if len(data) < ID3V2_HEADER.size or data[:3] != b'ID3':
+        return 0
+
+    flags, size = ID3V2_HEADER.unpack(data)[3:]
+    size = ID3V2_HEADER.size + sum((b & 0x7f) << (7 * (3 - i)) for i, b in enumerate(size))
+    if flags & 0x10:
+        # Tag has a footer
+        size += ID3V2_HEADER.size
+    return size
+
+
+def flac_payload_ranges(fd, size, offset=0):
+    """FLAC audio payload
+
+    Audio frames follow the metadata blocks after 'fLaC' marker
+    """
+    offset += 4
+    last = False
+    while not last:
+        fd.seek(offset)
+        header = fd.read(4)
+        if len(header) < 4:
+            raise ChecksumError('Truncated FLAC metadata block')
+        last = header[0] & 0x80
+        offset += 4 + int.from_bytes(header[1:], 'big')
+
+    if offset > size:
+        raise ChecksumError('Truncated FLAC metadata block')
+    return [(offset, size)]
+
+
+def mp3_payload_ranges(fd, size, offset=0):
+    """MP3 audio payload
+
+    Audio frames between ID3v2 tags in start of file and APEv2 and ID3v1 tags
+    in end of file. Tags in end of file may be written in either order.
+    """
+    end = None
+    tag_end = size
+    while tag_end != end:
+        end = tag_end
+
+        if end - offset >= ID3V1_TAG_SIZE:
+            fd.seek(end - ID3V1_TAG_SIZE)
+            if fd.read(3) == b'TAG':
+                tag_end -= ID3V1_TAG_SIZE
+
+        if tag_end - offset >= APEV2_FOOTER.size:
+            fd.seek(tag_end - APEV2_FOOTER.size)
+            footer = APEV2_FOOTER.unpack(fd.read(APEV2_FOOTER.size))
+            if footer[0] == b'APETAGEX':
+                tag_end -= footer[2]
+                if footer[4] & 0x80000000:
+                    # Tag has a header
+                    tag_end -= APEV2_FOOTER.size
+
+    if end < offset:
+        raise ChecksumError('Invalid MP3 tags')
+    return [(offset, end)]
+
+
+def mp4_payload_ranges(fd, size, offset=0):
+    """MP4 audio payload
+
+    Contents of top level mdat atoms
+    """
+    ranges = []
+    while offset + MP4_ATOM_HEADER.size <= size:
+        fd.seek(offset)
+        length, atom = MP4_ATOM_HEADER.unpack(fd.read(MP4_ATOM_HEADER.size))
+        header = MP4_ATOM_HEADER.size
+        if length == 1:
+            length = struct.unpack('>Q', fd.read(8))[0]
+            header += 8
+        elif length == 0:
+            length = size - offset
+
+        if length < header or offset + length > size:
+            raise ChecksumError('Invalid MP4 atom {}'.format(atom))
+
+        if atom == b'mdat':
+            ranges.append((offset + header, offset + length))
+        offset += length
+
+    if not ranges:
+        raise ChecksumError('No MP4 mdat atom found')
+    return ranges
+
+
+def ogg_header_packets(packet):
+    """Number of Ogg header packets
+
+    Returns number of header packets in Ogg logical stream from the first
+    packet of the stream, or None for unknown codecs
+    """
+    for magic, count in OGG_HEADER_PACKETS.items():
+        if packet.startswith(magic):
+            return count
+
+    # Ogg FLAC mapping header gives number of following header packets, 0 if unknown
+    if packet.startswith(b'\x7fFLAC') and len(packet) >= 9:
+        count = struct.unpack('>H', packet[7:9])[0]
+        return count > 0 and count + 1 or None
+
+    # Speex header gives number of extra headers after comment packet
+    if packet.startswith(b'Speex   ') and len(packet) >= 72:
+        return 2 + struct.unpack('<I', packet[68:72])[0]
+
+    return None
+
+
+def ogg_payload_ranges(fd, size, offset=0):
+    """Ogg audio payload
+
+    Payload of Ogg pages after the header packets of each logical stream.
+    Header packets are counted from segment lacing values, because comment
+    packets with embedded pictures continue on pages with granule position
+    -1 like audio packets do. For unknown codecs, pages before the first page
+    with positive granule position are headers. Page headers are skipped,
+    because page sequence numbers and checksums change when comment header
+    size changes.
+    """
+    ranges = []
+    headers = {}
+    while offset < size:
+        fd.seek(offset)
+        header = fd.read(OGG_PAGE_HEADER.size)
+        if len(header) < OGG_PAGE_HEADER.size:
+            raise ChecksumError('Truncated Ogg page')
+
+        fields = OGG_PAGE_HEADER.unpack(header)
+        if fields[0] != b'OggS':
+            raise ChecksumError('Invalid Ogg page at offset {:d}'.format(offset))
+
+        segments = fd.read(fields[7])
+        start = offset + OGG_PAGE_HEADER.size + fields[7]
+        offset = start + sum(segments)
+        if offset > size:
+            raise ChecksumError('Truncated Ogg page')
+
+        serial = fields[4]
+        if serial not in headers:
+            headers[serial] = ogg_header_packets(fd.read(min(offset - start, OGG_HEADER_PROBE_SIZE)))
+
+        remaining = headers[serial]
+        if remaining is None:
+            if fields[3] <= 0:
+                continue
+            headers[serial] = 0
+
+        elif remaining > 0:
+            headers[serial] = max(0, remaining - sum(1 for lacing in segments if lacing < 255))
+            continue
+
+        if offset > start:
+            ranges.append((start, offset))
+
+    return ranges
+
+
+def audio_cache_key(algorithm):
+    """Audio checksum cache key
+
+    Returns algorithm name used for audio checksums in checksum cache
+    """
+    return 'audio:{}'.format(algorithm)
+
+
+def audio_payload_ranges(path):
+    """Audio payload of file
+
+    Returns sorted list of (start, end) byte ranges containing the audio
+    payload of FLAC, MP3, MP4 and Ogg files, or None for other files.
+    """
+    try:
+        with open(path, 'rb') as fd:
+            return file_payload_ranges(fd, os.fstat(fd.fileno()).st_size, path)
+    except IOError as e:
+        raise ChecksumError('Error reading {}: {}'.format(path, e))
+    except OSError as e:
+        raise ChecksumError('Error reading {}: {}'.format(path, e))
+
+
+def file_payload_ranges(fd, size, path):
+    """Audio payload of open file
+
+    Returns audio payload ranges like audio_payload_ranges for file opened
+    from path. File extension of path is used to detect MP3 files without
+    ID3v2 tag.
+    """
+    try:
+        offset = id3v2_size(fd)
+        fd.seek(offset)
+        magic = fd.read(12)
+
+        if magic[:4] == b'fLaC':
+            return flac_payload_ranges(fd, size, offset)
+        if magic[:4] == b'OggS':
+            return ogg_payload_ranges(fd, size, offset)
+        if magic[4:8] == b'ftyp':
+            return mp4_payload_ranges(fd, size, offset)
+        if offset > 0 or os.path.splitext(path)[1].lower() == '.mp3':
+            return mp3_payload_ranges(fd, size, offset)
+
+    except IOError as e:
+        raise ChecksumError('Error reading {}: {}'.format(path, e))
+    except OSError as e:
+        raise ChecksumError('Error reading {}: {}'.format(path, e))
+    except struct.error as e:
+        raise ChecksumError('Error parsing {}: {}'.format(path, e))
+
+    return None
+
+
+def file_checksums(path, algorithm=DEFAULT_CHECKSUM_ALGORITHM, chunk_size=CHECKSUM_CHUNK_SIZE):
+    """Calculate file and audio checksums
+
+    Calculates checksum of whole file and checksum of audio payload in one
+    pass over the file. Returns (checksum, audio_checksum) tuple. Audio
+    checksum of files with unknown container format is whole file checksum.
+    """
+    return read_checksums(path, algorithm, audio=True, chunk_size=chunk_size)[1:]
+
+
+def read_checksums(path, algorithm=DEFAULT_CHECKSUM_ALGORITHM, audio=False, chunk_size=CHECKSUM_CHUNK_SIZE):
+    """Read file checksums
+
+    Calculates file checksum, and audio checksum if audio is True, in one pass
+    over the file. Returns (stat, checksum, audio_checksum) tuple.
+
+    Stat is looked up from the open file before reading it, so it can be used
+    as checksum cache key. Stat is None if file size or mtime changed while
+    reading, and the checksums should not be cached.
+    """
+    if algorithm is None:
+        algorithm = DEFAULT_CHECKSUM_ALGORITHM
+
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        raise ChecksumError('Unsupported checksum algorithm: {}'.format(algorithm))
+
+    m = hashlib.new(algorithm)
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+
+    try:
+        with open(path, 'rb', buffering=0) as fd:
+            stat = os.fstat(fd.fileno())
+
+            ranges = None
+            if audio:
+                ranges = file_payload_ranges(fd, stat.st_size, path)
+                fd.seek(0)
+
+            payload = ranges is not None and hashlib.new(algorithm) or None
+            offset = 0
+            index = 0
+            while True:
+                length = fd.readinto(buffer)
+                if not length:
+                    break
+                m.update(view[:length])
+
+                end = offset + length
+                while payload is not None and index < len(ranges) and ranges[index][0] < end:
+                    start, stop = ranges[index]
+                    if stop > offset:
+                        payload.update(view[max(start, offset) - offset:min(stop, end) - offset])
+                    if stop > end:
+                        break
+                    index += 1
+                offset = end
+
+            current = os.fstat(fd.fileno())
+            if (current.st_size, current.st_mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+                stat = None
+
+    except IOError as e:
+        raise ChecksumError('Error reading {}: {}'.format(path, e))
+    except OSError as e:
+        raise ChecksumError('Error reading {}: {}'.format(path, e))
+
+    checksum = format_checksum(algorithm, m.hexdigest())
+    if not audio:
+        return stat, checksum, None
+    if payload is None:
+        return stat, checksum, checksum
+    return stat, checksum, format_checksum(algorithm, payload.hexdigest())
+
+
+def audio_checksum(path, algorithm=DEFAULT_CHECKSUM_ALGORITHM, chunk_size=CHECKSUM_CHUNK_SIZE):
+    """Calculate audio checksum
+
+    Returns formatted checksum string of the audio payload of file
+    """
+    return file_checksums(path, algorithm, chunk_size)[1]
+
+
+def match_checksum(path, value):
+    """Verify file checksum
+
+    Calculate file checksum with algorithm of given checksum string and
+    return True if checksums match.
+    """
+    algorithm, digest = parse_checksum(value)
+    if algorithm is None:
+        return False
+
+    return parse_checksum(file_checksum(path, algorithm))[1] == digest
+
+
+class ChecksumJob(object):
+    """ChecksumJob
+
+    File to process with ChecksumEngine. Device and size are used for
+    scheduling and throughput statistics, data can be used by the caller
+    to attach for example a database track to the job. Jobs created with a
+    known checksum, for example from checksum cache, are not hashed again.
+
+    With audio flag, also the audio payload checksum is calculated. Stat of
+    hashed jobs is set to stat of the file when it was read, or None if the
+    file was modified while reading.
+    """
+
+    def __init__(self, path, algorithm=None, size=0, device=None, data=None, checksum=None,
+                 audio=False, audio_checksum=None):
+        self.path = path
+        self.algorithm = algorithm
+        self.size = size is not None and size or 0
+        self.device = device
+        self.data = data
+        self.audio = audio
+        self.checksum = checksum
+        self.audio_checksum = audio_checksum
+        self.cached = checksum is not None and (not audio or audio_checksum is not None)
+        self.stat = None
+        self.error = None
+
+    def __repr__(self):
+        return '{} {}'.format(self.checksum, self.path)
+
+
+class ChecksumEngine(object):
+    """ChecksumEngine
+
+    Calculate file checksums in a pool of worker threads. File reads and
+    hashing of large buffers release the GIL, so threads run in parallel.
+
+    Number of jobs running on same device is limited to device_threads, if
+    given. Completed jobs are returned to the calling thread, which can write
+    the results to database.
+    """
+
+    def __init__(self, threads=1, device_threads=None):
+        self.threads = max(1, int(threads))
+        self.device_threads = device_threads is not None and max(1, int(device_threads)) or None
+        self.files = 0
+        self.bytes = 0
+        self.cached = 0
+        self.errors = 0
+        self.started = None
+        self.stopped = None
+
+    def __repr__(self):
+        return '{:d} files ({:d} cached), {:.1f} MB in {:.1f} seconds: {:.1f} MB/s, {:.1f} files/s, {:d} errors'.format(
+            self.files,
+            self.cached,
+            self.bytes / 2**20,
+            self.elapsed,
+            self.bytes / 2**20 / max(self.elapsed, 0.001),
+            self.files / max(self.elapsed, 0.001),
+            self.errors,
+        )
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        if self.stopped is None:
+            return time.time() - self.started
+        return self.stopped - self.started
+
+    def checksum(self, job):
+        """Calculate checksum for job
+
+        Called in worker threads
+        """
+        try:
+            if job.audio:
+                job.stat, job.checksum, job.audio_checksum = read_checksums(job.path, job.algorithm, audio=True)
+            else:
+                job.stat, job.checksum = read_checksums(job.path, job.algorithm)[:2]
+        except ChecksumError as e:
+            job.error = e
+        return job
+
+    def __schedule(self, queues, active, pending, executor):
+        """Submit queued jobs
+
+        Submit jobs from device queues in turns until all threads are busy
+        or device limits are reached.
+        """
+        submitted = True
+        while submitted and len(pending) < self.threads:
+            submitted = False
+            for device in list(queues.keys()):
+                if len(pending) >= self.threads:
+                    break
+
+                if self.device_threads is not None and active.get(device, 0) >= self.device_threads:
+                    continue
+
+                job = queues[device].popleft()
+                if not queues[device]:
+                    del queues[device]
+
+                active[device] = active.get(device, 0) + 1
+                pending[executor.submit(self.checksum, job)] = job
+                submitted = True
+
+    def run(self, jobs):
+        """Process checksum jobs
+
+        Generator returning completed ChecksumJob objects in order of
+        completion. Failed jobs have error set and checksum None. Jobs with
+        known checksum are returned as soon as they are read, without reading
+        the files.
+
+        Jobs are read from the jobs iterable while files are hashed, with at
+        most CHECKSUM_READAHEAD jobs per thread waiting in device queues.
+        """
+        self.started = time.time()
+        self.stopped = None
+
+        jobs = iter(jobs)
+        readahead = CHECKSUM_READAHEAD * self.threads
+        device_readahead = CHECKSUM_READAHEAD * min(self.threads, self.device_threads or self.threads)
+        exhausted = False
+
+        queues = OrderedDict()
+        active = {}
+        pending = {}
+
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            while True:
+                queued = sum(len(queue) for queue in queues.values())
+                while not exhausted and queued < readahead:
+                    try:
+                        job = next(jobs)
+                    except StopIteration:
+                        exhausted = True
+                        break
+
+                    if job.cached:
+                        self.files += 1
+                        self.cached += 1
+                        yield job
+                        continue
+
+                    queue = queues.setdefault(job.device, deque())
+                    queue.append(job)
+                    queued += 1
+                    if len(queue) >= device_readahead:
+                        break
+
+                self.__schedule(queues, active, pending, executor)
+                if not pending:
+                    if exhausted and not queues:
+                        break
+                    continue
+
+                done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = pending.pop(future)
+                    active[job.device] -= 1
+
+                    self.files += 1
+                    self.bytes += job.size
+                    if job.error is not None:
+                        self.errors += 1
+
+                    yield job
+
+        self.stopped = time.time()
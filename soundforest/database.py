@@ -5,18 +5,36 @@ Soundforest configuration database, implementing the database
 classes in soundforest.models for cli scripts.
 """
 
+import multiprocessing
 import os
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
 from soundforest import models, TreeError, SoundforestError
+from soundforest.checksum import CHECKSUM_ALGORITHMS, DEFAULT_CHECKSUM_ALGORITHM, checksums_equal
 from soundforest.log import SoundforestLogger
 from soundforest.defaults import DEFAULT_CODECS, DEFAULT_TREE_TYPES
+from soundforest.tags.albumart import AlbumArtStore, AlbumArtError
+from soundforest.models import directory_filter
 
-from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy import event
 
 FIELD_CONVERT_MAP = {
-    'threads': lambda x: int(x)
+    'threads': lambda x: int(x),
+    'batch_size': lambda x: int(x),
 }
 
+# Number of modified tracks to commit in one transaction during tree updates
+DEFAULT_BATCH_SIZE = 500
+
+# Number of tracks sent to tag reader worker processes in one task
+TAG_READER_CHUNK_SIZE = 32
+
+# Number of tag reader tasks queued per worker process
+TAG_READER_READAHEAD = 2
+
 
 class ConfigDB(object):
     """ConfigDB
@@ -35,6 +53,17 @@ class ConfigDB(object):
     def __getattr__(self, attr):
         return getattr(self.__db_instance, attr)
 
+    @classmethod
+    def codecs_changed(cls, *args):
+        """Codecs changed
+
+        Invalidate codec extension index of the configuration database
+        instance, if it exists. Registered once for codec and extension model
+        events at end of this module.
+        """
+        if cls.__db_instance is not None:
+            cls.__db_instance.invalidate_codec_configuration()
+
     class ConfigInstance(models.SoundforestDB):
         """Configuration database instance
 
@@ -56,8 +85,33 @@ class ConfigDB(object):
                 self.add(treetypes)
                 self.commit()
 
-            self.codec_configuration = CodecConfiguration(db=self)
-            self.sync_configuration = SyncConfiguration(db=self)
+            self.__codec_configuration = None
+            self.__sync_configuration = None
+
+        @property
+        def codec_configuration(self):
+            """Codec configuration
+
+            Codecs are loaded on first use
+            """
+            if self.__codec_configuration is None:
+                self.__codec_configuration = CodecConfiguration(db=self)
+            return self.__codec_configuration
+
+        def invalidate_codec_configuration(self):
+            """Invalidate codec extension index, if codecs are loaded"""
+            if self.__codec_configuration is not None:
+                self.__codec_configuration.invalidate()
+
+        @property
+        def sync_configuration(self):
+            """Sync target configuration
+
+            Sync targets are loaded on first use
+            """
+            if self.__sync_configuration is None:
+                self.__sync_configuration = SyncConfiguration(db=self)
+            return self.__sync_configuration
 
         def get(self, key):
             entry = self.session.query(models.SettingModel).filter(models.SettingModel.key == key).first()
@@ -103,21 +157,139 @@ class ConfigDB(object):
         def values(self):
             return [s.value for s in self.session.query(models.SettingModel).all()]
 
-    def update_tree(self, tree, update_checksum=False, progresslog=False):
+    def update_tree(self, tree, update_checksum=False, progresslog=False, incremental=False, batch_size=None,
+                    processes=None):
         """
         Update tracks in database from loaded tree instance
-        """
-        added, updated, deleted, errors = 0, 0, 0, 0
 
+        Existing tracks of the tree are loaded with one query and compared to
+        the tracks in filesystem. Changes and track tags are committed in batches
+        of batch_size modified tracks, by default from 'batch_size' setting.
+
+        Tags of new and modified tracks are read after comparing the tree with
+        TrackTagReader, in given number of worker processes. Album artwork and
+        embedded albumart are saved to AlbumArtStore, and albums and tracks
+        refer to the images by checksum.
+
+        With incremental flag, albums with directory mtime matching the
+        database are skipped without processing the tracks. Directory mtime
+        changes when files are added, removed or renamed, but not when file
+        contents are modified in place: use full update to detect such changes.
+        Album mtime is only stored when all tracks of the album were updated
+        without errors, so failed tracks are retried by the next update.
+        """
         db_tree = self.get_tree(tree.path)
         albums = tree.as_albums()
+        album_paths = set(album.path for album in albums)
+        db_albums = dict((db_album.directory, db_album) for db_album in db_tree.albums)
+        db_tracks = self.get_tree_track_map(db_tree)
+
+        self.log.debug('{0} update tree'.format(tree.path))
+        added, updated, deleted, processed, errors = self.__update_albums(
+            tree, db_tree, albums, db_albums, db_tracks,
+            update_checksum=update_checksum,
+            progresslog=progresslog,
+            incremental=incremental,
+            batch_size=batch_size,
+            processes=processes,
+            removed_tracks=lambda path: path not in tree.paths and not os.path.isfile(path),
+            removed_albums=[album for album in db_tree.albums if album.path not in album_paths and not album.exists],
+        )
+        return added, updated, deleted, processed, errors
 
-        album_paths = [album.path for album in albums]
-        track_paths = tree.realpaths
+    def update_directories(self, tree, directories, update_checksum=False, batch_size=None, processes=None):
+        """
+        Update tracks in given directories of tree in database
+
+        Directories are given as (path, recursive) tuples. Albums in the
+        directory, and with recursive flag in all subdirectories, are updated
+        like in update_tree, and tracks and albums no longer found on disk are
+        removed. Tree is not loaded, only the given directories are scanned.
+        """
+        from soundforest.tree import Album, Tree
+
+        db_tree = self.get_tree(tree.path)
+        if db_tree is None:
+            raise SoundforestError('Tree not in database: {}'.format(tree.path))
+
+        albums = {}
+        scopes = []
+        for path, recursive in directories:
+            path = path.rstrip(os.sep)
+            relative_path = tree.relative_path(path)
+            scopes.append((path, relative_path, recursive))
+
+            if not os.path.isdir(path):
+                continue
+            albums[path] = Album(path)
+            if recursive:
+                for album in Tree(path, stat_files=False).as_albums():
+                    albums[album.path] = album
+
+        albums = [album for path, album in sorted(albums.items()) if path != tree.path and len(album)]
+        album_paths = set(album.path for album in albums)
+
+        db_tracks = {}
+        db_albums = {}
+        for path, relative_path, recursive in scopes:
+            db_tracks.update(self.get_tree_track_map(db_tree, path, recursive))
+            for db_album in self.get_tree_albums(db_tree, relative_path, recursive):
+                db_albums[db_album.directory] = db_album
+
+        self.log.debug('{} update {:d} directories'.format(tree.path, len(scopes)))
+        return self.__update_albums(
+            tree, db_tree, albums, db_albums, db_tracks,
+            update_checksum=update_checksum,
+            batch_size=batch_size,
+            processes=processes,
+            removed_tracks=lambda path: not os.path.isfile(path),
+            removed_albums=[
+                db_album for db_album in db_albums.values()
+                if db_album.path not in album_paths and not os.path.isdir(db_album.path)
+            ],
+        )
+
+    def __update_albums(self, tree, db_tree, albums, db_albums, db_tracks, update_checksum=False,
+                        progresslog=False, incremental=False, batch_size=None, processes=None,
+                        removed_tracks=None, removed_albums=()):
+        """
+        Update albums and tracks in database
+
+        Updates given albums of tree with tracks in db_tracks map, returned by
+        get_tree_track_map. Tracks left in db_tracks are removed if
+        removed_tracks callback returns True for track path, and albums in
+        removed_albums are removed.
+
+        New and modified tracks are updated and committed in batches of
+        batch_size tracks with __update_tracks.
+        """
+        added, updated, deleted, errors = 0, 0, 0, 0
+        if batch_size is None:
+            batch_size = self.batch_size
+        tag_writer = TrackTagWriter(self, batch_size, expire=False)
+        checksum_algorithm = self.checksum_algorithm
+        albumart_store = AlbumArtStore()
+        tag_reader = TrackTagReader(self, processes, albumart_store)
+        path_components = self.get_album_path_components(db_tree)
 
         processed = 0
+        skipped = 0
+        pending = []
+        album_mtimes = {}
+        failed_albums = set()
+
+        def update_tracks():
+            nonlocal added, updated, errors
+            batch_added, batch_updated, batch_errors = self.__update_tracks(
+                tree, pending, tag_reader, tag_writer, failed_albums,
+                update_checksum=update_checksum,
+                checksum_algorithm=checksum_algorithm,
+            )
+            added += batch_added
+            updated += batch_updated
+            errors += batch_errors
+            del pending[:]
 
-        self.log.debug('{0} update tree'.format(tree.path))
         for album in albums:
 
             album_relative_path = tree.relative_path(album.path)
@@ -127,10 +299,7 @@ class ConfigDB(object):
                     album.path,
                 ))
 
-            db_album = self.query(models.AlbumModel).filter(
-                models.AlbumModel.tree == db_tree,
-                models.AlbumModel.directory == album_relative_path
-            ).first()
+            db_album = db_albums.get(album_relative_path, None)
 
             if db_album is None:
                 self.log.debug('{} add album {}'.format(
@@ -140,30 +309,25 @@ class ConfigDB(object):
                 db_album = models.AlbumModel(
                     tree=db_tree,
                     directory=album_relative_path,
-                    mtime=album.mtime
                 )
 
-            elif db_album.mtime != album.mtime:
-                self.log.debug('{} update album mtime {}'.format(
-                    tree.path,
-                    album_relative_path
-                ))
-                db_album.mtime = album.mtime
+            elif incremental and db_album.mtime == album.mtime:
+                skipped += 1
+                continue
+
+            album_mtimes[album_relative_path] = (db_album, album.mtime)
 
-            self.update_album_path_components(db_album)
+            self.update_album_path_components(db_album, path_components)
+            self.update_album_albumart(album, db_album, albumart_store)
 
             self.log.debug('{} update album tracks {}'.format(
                 tree.path,
                 album_relative_path,
             ))
             for track in album:
-                db_track = self.query(models.TrackModel).filter(
-                    models.TrackModel.directory == track.directory,
-                    models.TrackModel.name == track.filename_no_extension,
-                    models.TrackModel.extension == track.extension,
-                ).first()
+                existing = db_tracks.pop((track.directory, track.filename_no_extension, track.extension), None)
 
-                if db_track is None:
+                if existing is None:
                     self.log.debug('{} add track {}'.format(
                         tree.path,
                         tree.relative_path(track),
@@ -177,30 +341,22 @@ class ConfigDB(object):
                         mtime=track.mtime,
                         deleted=False,
                     )
-                    if self.update_track(track, update_checksum, db_track=db_track):
-                        added += 1
-                    else:
-                        errors += 1
+                    self.session.add(db_track)
+                    pending.append((track, db_track, album_relative_path, 'add'))
 
-                elif db_track.mtime != track.mtime:
+                elif existing[1] != track.mtime:
                     self.log.debug('{} update track {}'.format(
                         tree.path,
                         tree.relative_path(track),
                     ))
-                    if self.update_track(track, update_checksum):
-                        updated += 1
-                    else:
-                        errors += 1
+                    pending.append((track, existing[0], album_relative_path, 'update'))
 
-                elif not db_track.checksum and update_checksum:
+                elif not (existing[2] and existing[3]) and update_checksum:
                     self.log.debug('{} update checksum {}'.format(
                         tree.path,
                         tree.relative_path(track),
                     ))
-                    if self.update_track_checksum(track) is not None:
-                        updated += 1
-                    else:
-                        errors += 1
+                    pending.append((track, existing[0], album_relative_path, 'checksum'))
 
                 processed += 1
                 if progresslog and processed % 1000 == 0:
@@ -209,30 +365,51 @@ class ConfigDB(object):
                         processed,
                     ))
 
-            self.commit()
+                if len(pending) >= batch_size:
+                    update_tracks()
 
-        self.log.debug('{} check for removed albums'.format(tree.path))
-        for album in db_tree.albums:
-            if album.path in album_paths or album.exists:
+        if pending:
+            update_tracks()
+
+        for album_relative_path, (db_album, mtime) in album_mtimes.items():
+            if album_relative_path in failed_albums or db_album.mtime == mtime:
                 continue
+            self.log.debug('{} update album mtime {}'.format(
+                tree.path,
+                album_relative_path,
+            ))
+            db_album.mtime = mtime
 
-            self.log.debug('{} remove album {}'.format(
+        self.commit(expire=False)
+
+        if skipped:
+            self.log.debug('{} skipped {:d} unmodified albums'.format(
                 tree.path,
-                album.relative_path(),
+                skipped,
             ))
-            self.delete(album)
 
         self.log.debug('{} check for removed tracks'.format(tree.path))
-        for db_track in db_tree.tracks:
-            if db_track.path in track_paths or db_track.exists:
+        removed = []
+        for (directory, name, extension), existing in db_tracks.items():
+            path = os.path.join(directory, '{}.{}'.format(name, extension))
+            if removed_tracks is None or not removed_tracks(path):
                 continue
 
             self.log.debug('{} remove track {}'.format(
                 tree.path,
-                db_track.relative_path(),
+                path,
+            ))
+            removed.append(existing[0])
+
+        deleted += self.delete_tracks(removed, batch_size)
+
+        self.log.debug('{} check for removed albums'.format(tree.path))
+        for album in removed_albums:
+            self.log.debug('{} remove album {}'.format(
+                tree.path,
+                album.relative_path(),
             ))
-            self.delete(db_track)
-            deleted += 1
+            self.session.delete(album)
 
         self.commit()
 
@@ -246,6 +423,164 @@ class ConfigDB(object):
 
         return added, updated, deleted, processed, errors
 
+    def __update_tracks(self, tree, pending, tag_reader, tag_writer, failed_albums, update_checksum=False,
+                        checksum_algorithm=None):
+        """
+        Update batch of tracks in database
+
+        Pending tracks are (track, db_track, album relative path, action)
+        tuples, where action is 'add', 'update' or 'checksum'. Updated tracks
+        are given as track IDs and loaded with one query. Tags of added and
+        updated tracks are read with tag_reader and written with tag_writer,
+        which commits the batch. Relative paths of albums with failed tracks
+        are added to failed_albums.
+
+        Returns numbers of added, updated and failed tracks.
+        """
+        added, updated, errors = 0, 0, 0
+
+        track_ids = [db_track for track, db_track, album_path, action in pending if action != 'add']
+        db_tracks = {}
+        if track_ids:
+            for db_track in self.query(models.TrackModel).filter(models.TrackModel.id.in_(track_ids)):
+                db_tracks[db_track.id] = db_track
+
+        tagged = []
+        for track, db_track, album_path, action in pending:
+            if action != 'add':
+                db_track = db_tracks.get(db_track, None)
+                if db_track is None:
+                    errors += 1
+                    failed_albums.add(album_path)
+                    continue
+
+            if action != 'checksum':
+                tagged.append((track, db_track, album_path, action))
+            elif self.update_track_checksum(track, db_track=db_track, commit=False,
+                                            algorithm=checksum_algorithm) is not None:
+                updated += 1
+            else:
+                errors += 1
+                failed_albums.add(album_path)
+
+        self.log.debug('{} read tags for {:d} tracks'.format(
+            tree.path,
+            len(tagged),
+        ))
+        results = tag_reader.read(track.path for track, db_track, album_path, action in tagged)
+        for (track, db_track, album_path, action), tags in zip(tagged, results):
+            if self.update_track(track, update_checksum, db_track=db_track, tag_writer=tag_writer,
+                                 checksum_algorithm=checksum_algorithm, tags=tags):
+                if action == 'add':
+                    added += 1
+                else:
+                    updated += 1
+            else:
+                errors += 1
+                failed_albums.add(album_path)
+
+        tag_writer.flush()
+
+        # Release committed tracks held by track collections of new albums
+        albums = dict((album_path, db_track.album) for track, db_track, album_path, action in pending
+                      if action == 'add' and db_track.album is not None)
+        for db_album in albums.values():
+            self.session.expire(db_album, ['tracks'])
+
+        return added, updated, errors
+
+    @property
+    def checksum_algorithm(self):
+        """
+        Return configured checksum algorithm for new checksums
+        """
+        value = self.get('checksum_algorithm')
+        if value is None:
+            return DEFAULT_CHECKSUM_ALGORITHM
+        if value not in CHECKSUM_ALGORITHMS:
+            raise SoundforestError('Unsupported checksum algorithm in configuration: {}'.format(value))
+        return value
+
+    @property
+    def batch_size(self):
+        """
+        Return configured batch size for database updates
+        """
+        value = self.get('batch_size')
+        if value is None:
+            return DEFAULT_BATCH_SIZE
+        return self.__format_item__('batch_size', value)
+
+    def get_threads(self, threads=None):
+        """
+        Return number of worker threads
+
+        Returns threads if given, otherwise configured 'threads' setting, or 1
+        if the setting is not configured.
+        """
+        if threads is None:
+            value = self.get('threads')
+            if value is None:
+                return 1
+            threads = self.__format_item__('threads', value)
+        return max(1, int(threads))
+
+    def get_tree_track_map(self, db_tree, directory=None, recursive=False):
+        """
+        Return tracks in tree as dictionary
+
+        Dictionary keys are (directory, name, extension) tuples and values
+        (id, mtime, checksum, audio_checksum) tuples, loaded with a single query.
+
+        Tracks can be limited to given directory, and with recursive flag to
+        its subdirectories.
+        """
+        rows = self.query(
+            models.TrackModel.directory,
+            models.TrackModel.name,
+            models.TrackModel.extension,
+            models.TrackModel.id,
+            models.TrackModel.mtime,
+            models.TrackModel.checksum,
+            models.TrackModel.audio_checksum,
+        ).filter(
+            models.TrackModel.tree_id == db_tree.id
+        )
+        if directory is not None:
+            rows = rows.filter(directory_filter(models.TrackModel.directory, directory, recursive))
+        return dict(((row[0], row[1], row[2]), tuple(row[3:])) for row in rows)
+
+    def get_tree_albums(self, db_tree, directory, recursive=False):
+        """
+        Return albums in tree relative directory
+
+        With recursive flag, albums in subdirectories are returned too.
+        """
+        return self.query(models.AlbumModel).filter(
+            models.AlbumModel.tree_id == db_tree.id,
+            directory_filter(models.AlbumModel.directory, directory, recursive),
+        ).all()
+
+    def delete_tracks(self, track_ids, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Delete tracks and their tags by track IDs
+
+        Tracks are deleted with bulk delete statements in batches of batch_size,
+        committing each batch. Returns number of deleted tracks.
+        """
+        deleted = 0
+        for index in range(0, len(track_ids), batch_size):
+            batch = track_ids[index:index + batch_size]
+            self.query(models.TagModel).filter(
+                models.TagModel.track_id.in_(batch)
+            ).delete(synchronize_session=False)
+            deleted += self.query(models.TrackModel).filter(
+                models.TrackModel.id.in_(batch)
+            ).delete(synchronize_session=False)
+            self.commit()
+
+        return deleted
+
     def find_tracks(self, path):
         track = self.get_track(path)
         if track is not None:
@@ -264,7 +599,38 @@ class ConfigDB(object):
 
         return []
 
-    def update_album_path_components(self, album):
+    def get_album_path_components(self, db_tree):
+        """
+        Return album path components of tree as dictionary
+
+        Dictionary keys are tuples of path component names from tree root and
+        values AlbumPathComponentModel objects, loaded with a single query.
+        """
+        components = {}
+        keys = {}
+        for component in self.query(models.AlbumPathComponentModel).filter(
+            models.AlbumPathComponentModel.tree_id == db_tree.id
+        ).order_by(models.AlbumPathComponentModel.level):
+            if component.parent_id is None:
+                key = (component.name, )
+            elif component.parent_id in keys:
+                key = keys[component.parent_id] + (component.name, )
+            else:
+                continue
+            keys[component.id] = key
+            components.setdefault(key, component)
+
+        return components
+
+    def update_album_path_components(self, album, components=None):
+        """
+        Update album path components
+
+        Components can be given as dictionary returned by
+        get_album_path_components, to look up existing components without
+        queries. Components missing from the dictionary are created and
+        added to it.
+        """
         parts = album.directory.split(os.sep)
 
         if not parts:
@@ -272,38 +638,45 @@ class ConfigDB(object):
 
         parent = None
         component = None
+        key = ()
         for level, name in enumerate(parts):
 
             if name == '':
                 continue
 
-            try:
+            key += (name, )
+            if components is not None:
+                component = components.get(key, None)
+            else:
                 component = self.query(models.AlbumPathComponentModel).filter(
                     models.AlbumPathComponentModel.tree == album.tree,
                     models.AlbumPathComponentModel.parent == parent,
                     models.AlbumPathComponentModel.name == name,
                     models.AlbumPathComponentModel.level == level,
-                ).one()
-
-                if component.name != name:
-                    component.name = name
+                ).first()
 
-            except NoResultFound:
+            if component is None:
                 component = models.AlbumPathComponentModel(tree=album.tree, parent=parent, level=level, name=name)
-                self.add(component)
+                self.session.add(component)
+                if components is not None:
+                    components[key] = component
 
             parent = component
 
         album.parent = component.parent
 
-        for invalid in self.query(models.AlbumPathComponentModel).filter(
-            models.AlbumPathComponentModel.tree == album.tree,
-            models.AlbumPathComponentModel.name == name,
-            level > len(parts),
-        ):
-            self.delete(invalid)
+    def update_track(self, track, update_checksum=False, db_track=None, commit=True, tag_writer=None,
+                     checksum_algorithm=None, tags=None):
+        """
+        Update track mtime and tags in database
 
-    def update_track(self, track, update_checksum=False, db_track=None):
+        Track tags are replaced with given TrackTagWriter, which writes and
+        commits the tags in batches. Without tag_writer tags are written
+        immediately.
+
+        Tags can be given as result from read_track_tags, otherwise the tags
+        are read from the track.
+        """
         if db_track is None:
             db_track = self.get_track(track.path)
 
@@ -311,50 +684,302 @@ class ConfigDB(object):
             self.log.debug('ERROR updating track {}: not found in database'.format(
                 track.path,
             ))
+            return False
 
         db_track.mtime = track.mtime
 
-        oldtags = self.query(models.TrackModel).filter(models.TagModel.track == db_track)
-        for tag in oldtags:
-            self.delete(tag)
+        if tag_writer is None:
+            writer = TrackTagWriter(self)
+        else:
+            writer = tag_writer
 
-        try:
-            tags = track.tags
-        except TreeError as e:
+        if tags is None:
+            tags = read_track_tags(track.path)
+
+        if tags['error'] is not None:
             self.log.debug('ERROR loading {}: {}'.format(
                 track.path,
-                e,
+                tags['error'],
             ))
-            return False
+            writer.add(db_track, [])
+        else:
+            writer.add(db_track, tags['tags'])
 
-        if tags:
-            for tag, value in tags.items():
-                if isinstance(value, list):
-                    value = value[0]
-                self.add(models.TagModel(track=db_track, tag=tag, value=value))
+        if tag_writer is None:
+            writer.flush(commit=commit)
 
-        self.commit()
+        if tags['error'] is not None:
+            return False
+
+        self.update_track_albumart(db_track, tags['albumart'])
 
         if update_checksum:
-            if self.update_track_checksum(track) is None:
+            commit = tag_writer is None and commit
+            if self.update_track_checksum(track, db_track=db_track, commit=commit,
+                                          algorithm=checksum_algorithm) is None:
                 return False
 
         return True
 
-    def update_track_checksum(self, track):
-        db_track = self.get_track(track.path)
+    def update_track_albumart(self, db_track, albumart):
+        """
+        Update track albumart reference
+
+        Albumart is given as image details from read_track_tags. Album of the
+        track refers to the first albumart found, if album has no albumart.
+        """
+        if albumart is None:
+            db_track.albumart_checksum = None
+            return
+
+        self.add_albumart(**albumart)
+        db_track.albumart_checksum = albumart['checksum']
+        if db_track.album is not None and db_track.album.albumart_checksum is None:
+            db_track.album.albumart_checksum = albumart['checksum']
+
+    def update_album_albumart(self, album, db_album, albumart_store):
+        """
+        Update album albumart reference from album artwork file
+
+        Artwork file is saved to albumart_store.
+        """
+        try:
+            albumart = album.albumart
+            if albumart is None:
+                return
+
+            width, height = albumart.size
+            checksum = albumart_store.store(albumart)
+            self.add_albumart(
+                checksum,
+                mimetype=albumart.mimetype,
+                size=len(albumart.dump()),
+                width=width,
+                height=height,
+            )
+        except AlbumArtError as e:
+            self.log.debug('ERROR storing albumart for {}: {}'.format(album.path, e))
+            return
+
+        db_album.albumart_checksum = checksum
+
+    def update_track_checksum(self, track, db_track=None, commit=True, algorithm=None, deep=False):
+        """
+        Update track checksums in database
+
+        Track and audio checksums are calculated with given algorithm, by default
+        with configured 'checksum_algorithm'. Cached checksums are used for
+        unchanged files unless deep is True. Returns new checksum, or None if
+        the checksums were not changed or could not be calculated.
+        """
+        if db_track is None:
+            db_track = self.get_track(track.path)
         if db_track is not None:
-            checksum = track.checksum
-            if db_track.checksum != checksum:
+            if algorithm is None:
+                algorithm = self.checksum_algorithm
+
+            try:
+                checksum, audio_checksum = track.get_checksums(algorithm, deep=deep, cache=self)
+            except TreeError as e:
+                self.log.debug('ERROR calculating checksum for {}: {}'.format(
+                    track.path,
+                    e,
+                ))
+                return None
+
+            if not checksums_equal(db_track.checksum, checksum) or \
+                    not checksums_equal(db_track.audio_checksum, audio_checksum):
                 db_track.checksum = checksum
-                self.commit()
+                db_track.audio_checksum = audio_checksum
+                if commit:
+                    self.commit()
                 return checksum
             else:
+                # Commit checksums added to checksum cache
+                if commit:
+                    self.commit()
                 return None
         else:
             return None
 
 
+def read_track_tags(path, albumart_store=None):
+    """Read track tags
+
+    Returns tags of the track as dictionary with keys path, tags, albumart and
+    error. Tags are returned as list of (tag, values) tuples instead of
+    TagParser objects, so results can be passed from worker processes cheaply.
+
+    Embedded albumart is saved to albumart_store, if given, and returned as
+    dictionary of image details.
+    """
+    from soundforest.tags import TagError
+    from soundforest.tags.albumart import AlbumArtError
+    from soundforest.tags.tagparser import Tags
+
+    try:
+        tags = Tags(path)
+    except TagError as e:
+        return {'path': path, 'tags': None, 'albumart': None, 'error': str(e)}
+
+    if tags is None:
+        return {'path': path, 'tags': None, 'albumart': None, 'error': 'No tag parser for {}'.format(path)}
+
+    details = None
+    albumart = None
+    if tags.albumart_obj is not None:
+        albumart = tags.albumart_obj.albumart
+
+    if albumart is not None and albumart_store is not None:
+        try:
+            width, height = albumart.size
+            details = {
+                'checksum': albumart_store.store(albumart),
+                'mimetype': albumart.mimetype,
+                'size': len(albumart.dump()),
+                'width': width,
+                'height': height,
+            }
+        except AlbumArtError:
+            pass
+
+    return {'path': path, 'tags': tags.items(), 'albumart': details, 'error': None}
+
+
+def read_track_tags_chunk(paths, albumart_store=None):
+    """Read track tags for list of paths
+
+    Returns list of read_track_tags results, for worker process tasks
+    """
+    return [read_track_tags(path, albumart_store) for path in paths]
+
+
+class TrackTagReader(object):
+    """TrackTagReader
+
+    Read track tags for database updates
+
+    With more than one process, tags are parsed with read_track_tags in a pool
+    of forked worker processes, because tag parsing is CPU bound. Results are
+    returned in order of given paths, for the calling process to write to the
+    database.
+    """
+
+    def __init__(self, db, processes=None, albumart_store=None):
+        self.db = db
+        self.log = SoundforestLogger().default_stream
+        self.processes = processes is not None and max(1, int(processes)) or 1
+        self.albumart_store = albumart_store
+
+        if self.processes > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+            self.log.debug('Forking worker processes not supported, reading tags in main process')
+            self.processes = 1
+
+    def read(self, paths, chunksize=TAG_READER_CHUNK_SIZE):
+        """Read tags
+
+        Generator returning read_track_tags results for paths. Paths are
+        consumed lazily: at most TAG_READER_READAHEAD chunks of chunksize
+        paths per worker process are queued at a time.
+        """
+        if self.processes == 1:
+            for path in paths:
+                yield read_track_tags(path, self.albumart_store)
+            return
+
+        # Load codecs before forking, so the workers match file formats with
+        # inherited codec models instead of each adding missing default codecs
+        # to the database. Commit without expiring pending tracks, which would
+        # be reloaded one at a time when the results are applied, and dispose
+        # pooled connections, so any worker queries open their own connections
+        # instead of sharing the parent's sqlite connection over fork.
+        self.db.codec_configuration.extension_index
+        self.db.commit(expire=False)
+        self.db.session.bind.dispose()
+
+        paths = iter(paths)
+        queue = deque()
+        readahead = self.processes * TAG_READER_READAHEAD
+
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers=self.processes, mp_context=context) as executor:
+            while True:
+                while len(queue) < readahead:
+                    chunk = list(islice(paths, chunksize))
+                    if not chunk:
+                        break
+                    queue.append(executor.submit(read_track_tags_chunk, chunk, self.albumart_store))
+
+                if not queue:
+                    break
+
+                for result in queue.popleft().result():
+                    yield result
+
+
+class TrackTagWriter(object):
+    """TrackTagWriter
+
+    Batched replacement of database track tags
+
+    Tags of queued tracks are replaced with one bulk delete and one bulk
+    insert statement per batch, and the batch is committed. Without expire,
+    loaded objects are not expired by the commits.
+    """
+
+    def __init__(self, db, batch_size=None, expire=True):
+        self.db = db
+        self.batch_size = batch_size is not None and batch_size or DEFAULT_BATCH_SIZE
+        self.expire = expire
+        self.tracks = []
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def add(self, db_track, tags):
+        """
+        Queue tags for database track
+
+        Tags must be list of (tag, value) pairs. Only first value is stored
+        for tags with multiple values. Batch is flushed when batch_size tracks
+        are queued.
+        """
+        rows = []
+        for tag, value in tags:
+            if isinstance(value, list):
+                value = value[0]
+            rows.append((tag, value))
+
+        self.tracks.append((db_track, rows))
+        if len(self.tracks) >= self.batch_size:
+            self.flush()
+
+    def flush(self, commit=True):
+        """
+        Write queued tags to database
+
+        Pending session changes are flushed first to assign IDs to new tracks.
+        """
+        if self.tracks:
+            self.db.session.flush()
+
+            table = models.TagModel.__table__
+            track_ids = [db_track.id for db_track, rows in self.tracks]
+            values = [
+                {'track_id': db_track.id, 'tag': tag, 'value': value, 'base64_encoded': False}
+                for db_track, rows in self.tracks for tag, value in rows
+            ]
+
+            self.db.session.execute(table.delete().where(table.c.track_id.in_(track_ids)))
+            if values:
+                self.db.session.execute(table.insert(), values)
+
+            self.tracks = []
+
+        if commit:
+            self.db.commit(expire=self.expire)
+
+
 class ConfigDBDictionary(dict):
     """Configuration database dictionary
 
@@ -390,7 +1015,7 @@ class SyncConfiguration(ConfigDBDictionary):
 
     @property
     def threads(self):
-        return int(self.db.get('threads'))
+        return self.db.get_threads()
 
     @property
     def default_targets(self):
@@ -406,13 +1031,23 @@ class CodecConfiguration(ConfigDBDictionary):
 
     Audio codec decoder/encoder commands configuration API
 
+    Codecs are matched to file extensions with a lowercase extension index,
+    which is rebuilt when codecs or codec extensions are changed.
     """
 
     def __init__(self, db):
         super(CodecConfiguration, self).__init__(db)
-
+        self.__extension_index = None
         self.load()
 
+    def __setitem__(self, key, value):
+        self.invalidate()
+        super(CodecConfiguration, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.invalidate()
+        super(CodecConfiguration, self).__delitem__(key)
+
     def load(self):
         for codec in self.db.codecs:
             self[str(codec.name)] = codec
@@ -424,6 +1059,33 @@ class CodecConfiguration(ConfigDBDictionary):
             codec = self.db.add_codec(name, **settings)
             self[str(codec.name)] = codec
 
+    def invalidate(self):
+        """Invalidate extension index
+
+        Extension index is rebuilt on next lookup
+        """
+        self.__extension_index = None
+
+    @property
+    def extension_index(self):
+        """Extension index
+
+        Return dictionary of lowercase extensions to codecs. Codec names take
+        precedence over extensions, otherwise first codec in name order wins.
+        """
+        if self.__extension_index is None:
+            index = {}
+            for codec in self.values():
+                for extension in codec.extensions:
+                    index.setdefault(extension.extension.lower(), codec)
+
+            for name, codec in self.items():
+                index[name.lower()] = codec
+
+            self.__extension_index = index
+
+        return self.__extension_index
+
     def extensions(self, codec):
         if codec in self.keys():
             return [codec] + [e.extension for e in self[codec].extensions]
@@ -435,11 +1097,13 @@ class CodecConfiguration(ConfigDBDictionary):
         if ext == '':
             ext = path
 
-        if ext in self.keys():
-            return self[ext]
+        return self.extension_index.get(ext.lower(), None)
 
-        for codec in self.values():
-            if ext in [e.extension for e in codec.extensions]:
-                return codec
 
-        return None
+# Codec extension index is invalidated when codecs or extensions are flushed,
+# and immediately when extensions are added to codecs or renamed
+for model in (models.CodecModel, models.ExtensionModel):
+    for name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(model, name, ConfigDB.codecs_changed)
+for attribute in (models.ExtensionModel.codec, models.ExtensionModel.extension):
+    event.listen(attribute, 'set', ConfigDB.codecs_changed)
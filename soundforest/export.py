@@ -0,0 +1,136 @@
+# coding=utf-8
+"""Track database export
+
+Streaming export of tracks with tags from the database
+
+"""
+
+import csv
+import io
+import json
+
+TRACK_EXPORT_FIELDS = (
+    'tree',
+    'path',
+    'checksum',
+    'audio_checksum',
+    'albumart',
+    'modified',
+)
+
+
+class ExportError(Exception):
+    pass
+
+
+class TrackExporter(object):
+    """TrackExporter
+
+    Parent class for track exporters. Tracks are streamed from database with
+    SoundforestDB.iter_track_tags and written to output file one at a time.
+    Output must be a file object opened in binary mode.
+    """
+
+    def __init__(self, db, output):
+        self.db = db
+        self.output = output
+
+    def export(self, trees=None):
+        """Export tracks
+
+        Export tracks with tags in given trees, or all tracks. Returns number
+        of exported tracks.
+        """
+        count = 0
+        self.start(trees)
+        for track in self.db.iter_track_tags(trees):
+            self.write(track)
+            count += 1
+        self.finish()
+        return count
+
+    def start(self, trees):
+        pass
+
+    def write(self, track):
+        raise NotImplementedError('Must be implemented in child class')
+
+    def finish(self):
+        pass
+
+
+class NDJSONTrackExporter(TrackExporter):
+    """NDJSONTrackExporter
+
+    Export tracks as newline delimited JSON, one object per track
+    """
+
+    def write(self, track):
+        details = dict((field, track[field]) for field in TRACK_EXPORT_FIELDS)
+        details['tags'] = track['tags']
+        self.output.write(json.dumps(details).encode('utf-8'))
+        self.output.write(b'\n')
+
+
+class CSVTrackExporter(TrackExporter):
+    """CSVTrackExporter
+
+    Export tracks as CSV, one row per track. Each tag found in exported trees
+    gets a column, so tag names are queried before exporting tracks.
+    """
+
+    def start(self, trees):
+        self.tags = self.db.get_track_tag_names(trees)
+        self.stream = io.TextIOWrapper(self.output, encoding='utf-8', newline='', write_through=True)
+        self.writer = csv.writer(self.stream)
+        self.writer.writerow(list(TRACK_EXPORT_FIELDS) + self.tags)
+
+    def write(self, track):
+        self.writer.writerow(
+            [track[field] for field in TRACK_EXPORT_FIELDS] +
+            [track['tags'].get(tag, None) for tag in self.tags]
+        )
+
+    def finish(self):
+        self.stream.flush()
+        self.stream.detach()
+
+
+class XMLTrackExporter(TrackExporter):
+    """XMLTrackExporter
+
+    Export tracks as XML track tree with XMLTrackWriter. Number of tracks is
+    queried before exporting tracks, for the tracks total attribute.
+    """
+
+    def start(self, trees):
+        from soundforest.tags.xmltag import XMLTrackWriter
+        self.writer = XMLTrackWriter(self.output, total=self.db.get_track_count(trees))
+        self.writer.open()
+
+    def write(self, track):
+        from soundforest.tags.xmltag import XMLTags
+        details = dict((tag, [value]) for tag, value in track['tags'].items() if value is not None)
+        details['path'] = [track['path']]
+        self.writer.append(XMLTags(details))
+
+    def finish(self):
+        self.writer.close()
+
+
+TRACK_EXPORTERS = {
+    'ndjson': NDJSONTrackExporter,
+    'csv': CSVTrackExporter,
+    'xml': XMLTrackExporter,
+}
+
+
+def track_exporter(fileformat, db, output):
+    """Return track exporter
+
+    Returns exporter for given file format writing to output file
+    """
+    try:
+        return TRACK_EXPORTERS[fileformat](db, output)
+    except KeyError:
+        raise ExportError('Unsupported export format: {}'.format(fileformat))
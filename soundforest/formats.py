@@ -5,9 +5,12 @@ Guessing of supported file formats and codecs based on extensions
 
 """
 
+import atexit
 import os
 import tempfile
 
+from stat import S_ISREG
+
 from subprocess import Popen, PIPE
 
 from soundforest import path_string, SoundforestError, CommandPathCache
@@ -30,9 +33,7 @@ TAG_EXTENSION_ALIASES = {
 }
 
 PATH_CACHE = CommandPathCache()
-PATH_CACHE.update()
-
-db = ConfigDB()
+atexit.register(PATH_CACHE.flush)
 
 
 def filter_available_command_list(commands):
@@ -47,23 +48,12 @@ def filter_available_command_list(commands):
             continue
         available.append(cmd.command)
 
+    PATH_CACHE.flush()
     return available
 
 
 def match_codec(path):
-    ext = os.path.splitext(path)[1][1:]
-
-    if ext == '':
-        ext = path
-
-    if ext in db.codec_configuration.keys():
-        return db.codec_configuration[ext]
-
-    for codec in db.codec_configuration.values():
-        if ext in [value.extension for value in codec.extensions]:
-            return codec
-
-    return None
+    return ConfigDB().codec_configuration.match(path)
 
 
 def match_metadata(path):
@@ -82,9 +72,10 @@ class AudioFileFormat(object):
 
     """
 
-    def __init__(self, path):
+    def __init__(self, path, stat=None):
         self.log = SoundforestLogger().default_stream
         self.path = path_string(path)
+        self.__stat = stat
         self.codec = None
         self.description = None
         self.is_metadata = False
@@ -120,23 +111,50 @@ class AudioFileFormat(object):
     def extension(self):
         return os.path.splitext(self.path)[1][1:]
 
+    @property
+    def stat(self):
+        """File stat
+
+        Returns os.stat result for regular files and None for other paths. The
+        result is given by tree walker or cached on first lookup.
+        """
+        if self.__stat is None:
+            try:
+                self.__stat = os.stat(self.path)
+            except OSError:
+                return None
+
+        if not S_ISREG(self.__stat.st_mode):
+            return None
+        return self.__stat
+
+    def invalidate_stat(self):
+        """Invalidate cached stat
+
+        Called when the file is written, so size and mtime are looked up again
+        """
+        self.__stat = None
+
     @property
     def size(self):
-        if not self.path.isfile:
+        stat = self.stat
+        if stat is None:
             return None
-        return os.stat(self.path).st_size
+        return stat.st_size
 
     @property
     def ctime(self):
-        if not self.path.isfile:
+        stat = self.stat
+        if stat is None:
             return None
-        return os.stat(self.path).st_ctime
+        return stat.st_ctime
 
     @property
     def mtime(self):
-        if not self.path.isfile:
+        stat = self.stat
+        if stat is None:
             return None
-        return os.stat(self.path).st_mtime
+        return stat.st_mtime
 
     def get_temporary_file(self, dir=SOUNDFOREST_CACHE_DIR, prefix='tmp', suffix=''):
         if not os.path.isdir(dir):
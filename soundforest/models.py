@@ -6,6 +6,7 @@ SQLAlchemy models for soundforest configuration and music tree databases
 """
 
 import os
+import re
 import base64
 import json
 import pytz
@@ -13,10 +14,11 @@ import sys
 
 from datetime import datetime
 
-from sqlite3 import Connection as SQLite3Connection
-from sqlalchemy import (create_engine, event,
+from sqlite3 import Connection as SQLite3Connection, DatabaseError as SQLite3DatabaseError
+from sqlalchemy import (create_engine, event, func, text, and_, or_,
                         Column, ForeignKey, Integer, Boolean,
                         String, Date, Index)
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.engine import reflection
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship, backref
@@ -31,9 +33,127 @@ logger = SoundforestLogger().default_stream
 
 DEFAULT_DATABASE = os.path.join(SOUNDFOREST_USER_DIR, 'soundforest.sqlite')
 
+# Database schema version, stored in SQLite user_version. Increase when tables,
+# columns or indexes are added, to run schema upgrade again. Search indexes are
+# checked separately when database is opened.
+SCHEMA_VERSION = 2
+
+# SQLite tuning profiles, selected with 'sqlite_profile' setting. Individual
+# pragmas can be overridden with settings named 'sqlite_<pragma>', for example
+# 'sqlite_synchronous'. Note journal_mode is persistent in the database file.
+SQLITE_PRAGMAS = (
+    'journal_mode',
+    'synchronous',
+    'cache_size',
+    'mmap_size',
+    'temp_store',
+    'busy_timeout',
+)
+SQLITE_PROFILES = {
+    'default': {},
+    'wal': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'busy_timeout': '10000',
+    },
+    'performance': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': '-65536',
+        'mmap_size': '268435456',
+        'temp_store': 'MEMORY',
+        'busy_timeout': '10000',
+    },
+}
+SQLITE_PRAGMA_VALUE = re.compile(r'^-?\w+$')
+
+# SQLite FTS5 full text search indexes for tag values and track paths. Indexes
+# use tag and track tables as external content and are kept in sync with
+# triggers, so bulk inserts and deletes of tags are indexed too.
+SEARCH_INDEXES = {
+    'tag_search': ('tag', ('value', )),
+    'track_search': ('track', ('directory', 'name')),
+}
+SEARCH_INDEX_TOKENIZER = 'unicode61 remove_diacritics 2'
+
+# Number of rows fetched at once when streaming tracks with tags
+TRACK_STREAM_BATCH_SIZE = 1000
+
 Base = declarative_base()
 
 
+def directory_filter(column, directory, recursive=False):
+    """Return directory filter
+
+    Return filter expression matching directory column to given directory,
+    and with recursive flag to its subdirectories. Subdirectories are matched
+    with a range comparison which can use an index on the column.
+    """
+    directory = directory.rstrip(os.sep)
+    if not recursive:
+        return column == directory
+    if directory == '':
+        return column.isnot(None)
+
+    prefix = directory + os.sep
+    return (column == directory) | ((column >= prefix) & (column < directory + chr(ord(os.sep) + 1)))
+
+
+def search_match_query(match):
+    """Return full text search query
+
+    Return FTS5 query matching all words in match string as prefixes. Words
+    are quoted, so FTS5 query syntax in match string is not interpreted.
+    """
+    words = ['"{}"*'.format(word.replace('"', '""')) for word in match.split()]
+    if not words:
+        raise SoundforestError('Empty search string')
+    return ' '.join(words)
+
+
+def search_tracks(session, index, match, tree=None, limit=None):
+    """Search tracks
+
+    Return tracks matching match string in full text search index 'tag_search'
+    or 'track_search', best matches first. Tracks are optionally limited to
+    given tree. Returns None if full text search is not available.
+    """
+    if index == 'tag_search':
+        query = 'select tag.track_id, min(tag_search.rank) as score ' \
+            'from tag_search join tag on tag.id = tag_search.rowid ' \
+            'join track on track.id = tag.track_id ' \
+            'where tag_search match :match {} group by tag.track_id order by score'
+    elif index == 'track_search':
+        query = 'select track.id, track_search.rank as score ' \
+            'from track_search join track on track.id = track_search.rowid ' \
+            'where track_search match :match {} order by score'
+    else:
+        raise SoundforestError('Unknown search index: {}'.format(index))
+
+    params = {'match': search_match_query(match)}
+    if tree is not None:
+        query = query.format('and track.tree_id = :tree_id')
+        params['tree_id'] = tree.id
+    else:
+        query = query.format('')
+    if limit is not None:
+        query += ' limit :limit'
+        params['limit'] = int(limit)
+
+    try:
+        track_ids = [row[0] for row in session.execute(text(query), params)]
+    except OperationalError as e:
+        logger.debug('Full text search not available: {}'.format(e))
+        return None
+
+    tracks = {}
+    for offset in range(0, len(track_ids), TRACK_STREAM_BATCH_SIZE):
+        for track in session.query(TrackModel).filter(
+                TrackModel.id.in_(track_ids[offset:offset + TRACK_STREAM_BATCH_SIZE])):
+            tracks[track.id] = track
+    return [tracks[track_id] for track_id in track_ids if track_id in tracks]
+
+
 class SafeUnicode(TypeDecorator):
     """SafeUnicode columns
 
@@ -479,26 +599,43 @@ class TreeModel(Base, BasePathNamedModel):
             TagModel.track_id == TrackModel.id
         ).count()
 
-    def match_tag(self, session, match):
+    def match_tag(self, session, match, limit=None):
         """Match database track tags
 
-        Return tracks matching given tag value
+        Return tracks with tag values matching words in match as prefixes,
+        best matches first. Without full text search index, return tracks
+        with tag values containing match string.
 
         """
+        tracks = search_tracks(session, 'tag_search', match, tree=self, limit=limit)
+        if tracks is not None:
+            return tracks
+
         return session.query(TrackModel).filter(
             TrackModel.tree == self
         ).filter(
             TagModel.track_id == TrackModel.id
         ).filter(
             TagModel.value.like('%{}%'.format(match))
-        ).all()
+        ).distinct().limit(limit).all()
+
+    def filter_tracks(self, session, path, limit=None):
+        """Filter tracks by path
+
+        Return tracks with directory or name matching words in path as
+        prefixes, best matches first. Without full text search index, return
+        tracks with directory or name containing path string.
+
+        """
+        tracks = search_tracks(session, 'track_search', path, tree=self, limit=limit)
+        if tracks is not None:
+            return tracks
 
-    def filter_tracks(self, session, path):
         res = session.query(TrackModel).filter(TrackModel.tree == self)
         return res.filter(
             TrackModel.directory.like('%{}%'.format(path)) |
             TrackModel.name.like('%{}%'.format(path))
-        ).all()
+        ).limit(limit).all()
 
     def to_json(self):
         """Return tree as JSON
@@ -533,6 +670,7 @@ class AlbumModel(Base, BasePathNamedModel):
 
     directory = Column(SafeUnicode, index=True)
     mtime = Column(Integer)
+    albumart_checksum = Column(String, index=True)
 
     parent_id = Column(Integer, ForeignKey('albumpathcomponent.id'), nullable=True)
     parent = relationship(
@@ -633,7 +771,7 @@ class AlbumPathComponentModel(Base, BasePathNamedModel):
     parent_id = Column(Integer, ForeignKey('albumpathcomponent.id'), nullable=True)
     parent = relationship(
         'AlbumPathComponentModel',
-        single_parent=True,
+        single_parent=False,
         remote_side=[id],
         backref=backref(
             'children',
@@ -652,28 +790,26 @@ class AlbumPathComponentModel(Base, BasePathNamedModel):
 class AlbumArtModel(Base):
     """AlbumArtModel
 
-    Albumart files for music albums in tree database
+    Albumart images, identified by image checksum. Image files are stored in
+    soundforest.tags.albumart.AlbumArtStore, and albums and tracks refer to
+    the images by checksum.
     """
 
     __tablename__ = 'albumart'
 
     id = Column(Integer, primary_key=True)
-    mtime = Column(Integer)
-    albumart = Column(Base64Field)
-
-    album_id = Column(Integer, ForeignKey('album.id'), nullable=True)
-    album = relationship(
-        'AlbumModel',
-        single_parent=False,
-        backref=backref(
-            'albumart',
-            cascade='all, delete, delete-orphan'
-        )
-    )
+    checksum = Column(String, unique=True)
+    mimetype = Column(String)
+    size = Column(Integer)
+    width = Column(Integer)
+    height = Column(Integer)
 
     def __repr__(self):
-        return 'AlbumArtModel for {}'.format(
-            self.album.path,
+        return '{} {} {}x{}'.format(
+            self.checksum,
+            self.mimetype,
+            self.width,
+            self.height,
         )
 
 
@@ -686,6 +822,7 @@ class TrackModel(Base, BasePathNamedModel):
     __tablename__ = 'track'
     __table_args__ = (
         Index('track_directory_name_extension', 'directory', 'name', 'extension', ),
+        Index('track_audio_checksum', 'audio_checksum'),
     )
 
     id = Column(Integer, primary_key=True)
@@ -695,6 +832,8 @@ class TrackModel(Base, BasePathNamedModel):
     extension = Column(SafeUnicode)
 
     checksum = Column(SafeUnicode)
+    audio_checksum = Column(SafeUnicode)
+    albumart_checksum = Column(String, index=True)
     mtime = Column(Integer)
     deleted = Column(Boolean)
 
@@ -762,6 +901,8 @@ class TrackModel(Base, BasePathNamedModel):
             'name': self.name,
             'extension': self.extension,
             'checksum': self.checksum,
+            'audio_checksum': self.audio_checksum,
+            'albumart': self.albumart_checksum,
             'modified': self.modified_isoformat,
             'tags': dict((t.tag, t.value) for t in self.tags)
         })
@@ -774,7 +915,7 @@ class TagModel(Base):
     """
 
     __tablename__ = 'tag'
-    __table_args = (
+    __table_args__ = (
         Index('track_tag', 'track_id', 'tag'),
     )
 
@@ -801,6 +942,38 @@ class TagModel(Base):
         )
 
 
+class ChecksumCacheModel(Base):
+    """ChecksumCacheModel
+
+    Cached file checksum, keyed by file stat signature. A cached checksum is
+    valid while device, inode, size and mtime of the file are unchanged.
+
+    Path of the file is stored to remove cached checksums of deleted tracks.
+    """
+
+    __tablename__ = 'checksum_cache'
+    __table_args__ = (
+        Index('checksum_cache_signature', 'device', 'inode', 'size', 'mtime', 'algorithm', unique=True),
+        Index('checksum_cache_path', 'path'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    path = Column(SafeUnicode)
+    device = Column(Integer)
+    inode = Column(Integer)
+    size = Column(Integer)
+    mtime = Column(Integer)
+    algorithm = Column(String)
+    checksum = Column(SafeUnicode)
+
+    def __repr__(self):
+        return '{} {}:{}'.format(
+            self.checksum,
+            self.device,
+            self.inode,
+        )
+
+
 class PlaylistTreeModel(Base, BaseNamedModel):
     """PlaylistTreeModel
 
@@ -987,12 +1160,56 @@ class SoundforestDB(object):
             )
 
         event.listen(engine, 'connect', self._fk_pragma_on_connect)
-        Base.metadata.create_all(engine)
+        event.listen(engine, 'connect', self._tuning_pragmas_on_connect)
+
+        if engine.dialect.name != 'sqlite' or self._schema_version(engine) != SCHEMA_VERSION:
+            self._upgrade_schema(engine)
+
+        self.search_indexes = engine.dialect.name == 'sqlite' and self._search_indexes(engine)
+
         self.session = sessionmaker(bind=engine)()
+        self.__albumart_checksums = None
+
+    def _schema_version(self, engine):
+        """Return schema version
+
+        Return schema version stored in SQLite user_version, 0 for new
+        databases and databases of older versions
+        """
+        return engine.execute('pragma user_version').scalar()
+
+    def _upgrade_schema(self, engine):
+        """Upgrade schema
+
+        Create missing tables, columns and indexes. Reflecting existing schema
+        is slow, so for SQLite this is only done when stored schema version is
+        not current.
+        """
+        # Albumart table of older versions was never used and has different columns
+        inspector = reflection.Inspector.from_engine(engine)
+        if AlbumArtModel.__tablename__ in inspector.get_table_names():
+            albumart_columns = [column['name'] for column in inspector.get_columns(AlbumArtModel.__tablename__)]
+            if 'checksum' not in albumart_columns:
+                engine.execute('alter table {0} rename to {0}_unused'.format(AlbumArtModel.__tablename__))
+
+        Base.metadata.create_all(engine)
 
-        indexes = (
-        )
         inspector = reflection.Inspector.from_engine(engine)
+        for model, columns in (
+                (TrackModel, ('audio_checksum', 'albumart_checksum')),
+                (AlbumModel, ('albumart_checksum', )),
+                (ChecksumCacheModel, ('path', ))):
+            existing_columns = [column['name'] for column in inspector.get_columns(model.__tablename__)]
+            for column in columns:
+                if column not in existing_columns:
+                    engine.execute('alter table {} add column {} {}'.format(
+                        model.__tablename__,
+                        column,
+                        model.__table__.columns[column].type.compile(engine.dialect),
+                    ))
+
+        indexes = tuple(TagModel.__table__.indexes) + tuple(TrackModel.__table__.indexes) + \
+            tuple(AlbumModel.__table__.indexes) + tuple(ChecksumCacheModel.__table__.indexes)
         existing_index_names = [
             index['name'] for table in inspector.get_table_names() for index in inspector.get_indexes(table)
         ]
@@ -1000,6 +1217,88 @@ class SoundforestDB(object):
             if index.name not in existing_index_names:
                 index.create(bind=engine)
 
+        # Cached checksums of schema versions before 2 have no path and could never be removed
+        if engine.dialect.name != 'sqlite' or self._schema_version(engine) < 2:
+            engine.execute('delete from {} where path is null'.format(ChecksumCacheModel.__tablename__))
+
+        if engine.dialect.name == 'sqlite':
+            self._create_checksum_cache_trigger(engine)
+            engine.execute('pragma user_version = {:d}'.format(SCHEMA_VERSION))
+
+    def _create_checksum_cache_trigger(self, engine):
+        """Create checksum cache trigger
+
+        Remove cached checksums of tracks when tracks are deleted, also with
+        bulk delete statements and tree or album cascades
+        """
+        engine.execute(
+            "create trigger if not exists {cache}_track_delete after delete on {track} begin "
+            "delete from {cache} where path = old.directory || '{sep}' || old.name || '.' || old.extension; end".format(
+                cache=ChecksumCacheModel.__tablename__,
+                track=TrackModel.__tablename__,
+                sep=os.sep,
+            )
+        )
+
+    def _search_indexes(self, engine):
+        """Check full text search indexes
+
+        Return True if all SEARCH_INDEXES exist. Missing indexes are created,
+        so indexes are added when SQLite with FTS5 support is available, even
+        if schema version is already current.
+        """
+        existing_tables = [row[0] for row in engine.execute(
+            "select name from sqlite_master where type = 'table'"
+        )]
+        if all(index in existing_tables for index in SEARCH_INDEXES):
+            return True
+        return self._create_search_indexes(engine, existing_tables)
+
+    def _create_search_indexes(self, engine, existing_tables):
+        """Create full text search indexes
+
+        Create SEARCH_INDEXES FTS5 tables and triggers to keep them in sync
+        with content tables. New indexes are built from existing content.
+        SQLite without FTS5 support is left without search indexes. Returns
+        False if any search index could not be created.
+        """
+        created = True
+        for index, (table, columns) in SEARCH_INDEXES.items():
+            if index in existing_tables:
+                continue
+
+            new_values = ', '.join('new.{}'.format(column) for column in columns)
+            old_values = ', '.join('old.{}'.format(column) for column in columns)
+            statements = (
+                "create virtual table {index} using fts5({columns}, content='{table}', content_rowid='id', "
+                "tokenize='{tokenizer}', prefix='2 3')",
+                "create trigger {index}_insert after insert on {table} begin "
+                "insert into {index}(rowid, {columns}) values (new.id, {new_values}); end",
+                "create trigger {index}_delete after delete on {table} begin "
+                "insert into {index}({index}, rowid, {columns}) values ('delete', old.id, {old_values}); end",
+                "create trigger {index}_update after update of {columns} on {table} begin "
+                "insert into {index}({index}, rowid, {columns}) values ('delete', old.id, {old_values}); "
+                "insert into {index}(rowid, {columns}) values (new.id, {new_values}); end",
+                "insert into {index}({index}) values ('rebuild')",
+            )
+
+            try:
+                with engine.begin() as connection:
+                    for statement in statements:
+                        connection.execute(statement.format(
+                            index=index,
+                            table=table,
+                            columns=', '.join(columns),
+                            new_values=new_values,
+                            old_values=old_values,
+                            tokenizer=SEARCH_INDEX_TOKENIZER,
+                        ))
+            except OperationalError as e:
+                logger.debug('Error creating search index {}: {}'.format(index, e))
+                created = False
+
+        return created
+
     def _fk_pragma_on_connect(self, connection, record):
         """Enable foreign keys
 
@@ -1010,6 +1309,44 @@ class SoundforestDB(object):
             cursor.execute('pragma foreign_keys=ON')
             cursor.close()
 
+    def _tuning_pragmas_on_connect(self, connection, record):
+        """Apply SQLite tuning profile
+
+        Apply pragmas from SQLITE_PROFILES profile selected with 'sqlite_profile'
+        setting and pragma overrides from 'sqlite_<pragma>' settings. Settings are
+        read with the new connection, because session is not available here.
+        """
+        if not isinstance(connection, SQLite3Connection):
+            return
+
+        cursor = connection.cursor()
+        try:
+            cursor.execute("select key, value from setting where key like 'sqlite_%'")
+            settings = dict(cursor.fetchall())
+        except SQLite3DatabaseError:
+            # Setting table is not yet created
+            cursor.close()
+            return
+
+        profile = settings.get('sqlite_profile', 'default')
+        if profile not in SQLITE_PROFILES:
+            logger.debug('Unknown sqlite profile: {}'.format(profile))
+            profile = 'default'
+
+        pragmas = dict(SQLITE_PROFILES[profile])
+        for pragma in SQLITE_PRAGMAS:
+            value = settings.get('sqlite_{}'.format(pragma), None)
+            if value is not None:
+                pragmas[pragma] = value
+
+        for pragma, value in pragmas.items():
+            if not SQLITE_PRAGMA_VALUE.match(value):
+                logger.debug('Invalid sqlite {} value: {}'.format(pragma, value))
+                continue
+            cursor.execute('pragma {}={}'.format(pragma, value))
+
+        cursor.close()
+
     def query(self, *args, **kwargs):
         """Query session
 
@@ -1022,14 +1359,25 @@ class SoundforestDB(object):
 
         Wrapper to rolllback current session query
         """
+        self.__albumart_checksums = None
         return self.session.rollback()
 
-    def commit(self):
+    def commit(self, expire=True):
         """Commit session
 
-        Wrapper to commit current session query
+        Wrapper to commit current session query. Without expire, loaded
+        objects are not expired, so they are not reloaded one row at a time
+        when accessed after the commit.
         """
-        return self.session.commit()
+        if expire:
+            return self.session.commit()
+
+        expire_on_commit = self.session.expire_on_commit
+        self.session.expire_on_commit = False
+        try:
+            return self.session.commit()
+        finally:
+            self.session.expire_on_commit = expire_on_commit
 
     def as_dict(self, result):
         """Return query result dictionary
@@ -1434,11 +1782,196 @@ class SoundforestDB(object):
         """Return trach matching path
 
         """
+        name, extension = os.path.splitext(os.path.basename(path))
         return self.query(TrackModel).filter(
             TrackModel.directory == os.path.dirname(path),
-            TrackModel.name == os.path.basename(path),
+            TrackModel.name == name,
+            TrackModel.extension == extension[1:],
         ).first()
 
+    def add_albumart(self, checksum, mimetype=None, size=None, width=None, height=None):
+        """Add albumart image
+
+        Add details of albumart image stored with checksum, if not yet in
+        database. Known checksums are loaded once and cached.
+        """
+        if self.__albumart_checksums is None:
+            self.__albumart_checksums = set(
+                row[0] for row in self.query(AlbumArtModel.checksum)
+            )
+
+        if checksum in self.__albumart_checksums:
+            return False
+
+        self.session.add(AlbumArtModel(
+            checksum=checksum,
+            mimetype=mimetype,
+            size=size,
+            width=width,
+            height=height,
+        ))
+        self.__albumart_checksums.add(checksum)
+        return True
+
+    def get_albumart(self, checksum):
+        """Return albumart image details by checksum
+
+        """
+        return self.query(AlbumArtModel).filter(
+            AlbumArtModel.checksum == checksum
+        ).first()
+
+    def get_duplicate_tracks(self):
+        """Return duplicate tracks
+
+        Returns lists of tracks with same audio checksum. Tracks in a list
+        contain same audio, but may have different tags or albumart.
+        """
+        checksums = self.query(TrackModel.audio_checksum).filter(
+            TrackModel.audio_checksum.isnot(None)
+        ).group_by(TrackModel.audio_checksum).having(func.count(TrackModel.id) > 1)
+
+        duplicates = []
+        tracks = self.query(TrackModel).filter(
+            TrackModel.audio_checksum.in_(checksums.subquery())
+        ).order_by(TrackModel.audio_checksum, TrackModel.directory, TrackModel.name)
+        for track in tracks:
+            if not duplicates or duplicates[-1][0].audio_checksum != track.audio_checksum:
+                duplicates.append([])
+            duplicates[-1].append(track)
+
+        return duplicates
+
+    def iter_track_tags(self, trees=None, batch_size=TRACK_STREAM_BATCH_SIZE):
+        """Iterate tracks with tags
+
+        Yields details of each track with tags as dictionaries, optionally
+        limited to tracks in given trees. Tracks and tags are read with a
+        single joined query, fetching batch_size rows at a time, so memory
+        use does not depend on number of tracks.
+        """
+        query = self.session.query(
+            TrackModel.id,
+            TreeModel.path,
+            TrackModel.directory,
+            TrackModel.name,
+            TrackModel.extension,
+            TrackModel.checksum,
+            TrackModel.audio_checksum,
+            TrackModel.albumart_checksum,
+            TrackModel.mtime,
+            TagModel.tag,
+            TagModel.value,
+        ).outerjoin(
+            TreeModel, TrackModel.tree_id == TreeModel.id
+        ).outerjoin(
+            TagModel, TagModel.track_id == TrackModel.id
+        )
+        if trees is not None:
+            query = query.filter(TrackModel.tree_id.in_([tree.id for tree in trees]))
+        query = query.order_by(TrackModel.id, TagModel.tag)
+
+        track = None
+        for row in query.execution_options(stream_results=True).yield_per(batch_size):
+            if track is None or track['id'] != row[0]:
+                if track is not None:
+                    yield track
+
+                modified = None
+                if row[8] is not None:
+                    modified = datetime.fromtimestamp(row[8]).replace(tzinfo=pytz.utc).isoformat()
+                track = {
+                    'id': row[0],
+                    'tree': row[1],
+                    'path': os.path.join(row[2], '{}.{}'.format(row[3], row[4])),
+                    'directory': row[2],
+                    'name': row[3],
+                    'extension': row[4],
+                    'checksum': row[5],
+                    'audio_checksum': row[6],
+                    'albumart': row[7],
+                    'modified': modified,
+                    'tags': {},
+                }
+
+            if row[9] is not None:
+                track['tags'][row[9]] = row[10]
+
+        if track is not None:
+            yield track
+
+    def get_track_count(self, trees=None):
+        """Return number of tracks
+
+        Returns number of tracks, optionally limited to tracks in given trees.
+        """
+        query = self.session.query(func.count(TrackModel.id))
+        if trees is not None:
+            query = query.filter(TrackModel.tree_id.in_([tree.id for tree in trees]))
+        return query.scalar()
+
+    def get_track_tag_names(self, trees=None):
+        """Return tag names
+
+        Returns sorted list of distinct tag names in tracks, optionally
+        limited to tracks in given trees.
+        """
+        query = self.session.query(TagModel.tag).distinct()
+        if trees is not None:
+            query = query.join(
+                TrackModel, TagModel.track_id == TrackModel.id
+            ).filter(TrackModel.tree_id.in_([tree.id for tree in trees]))
+        return sorted(row[0] for row in query)
+
+    def get_cached_checksum(self, stat, algorithm):
+        """Return cached checksum
+
+        Returns checksum cached for file with given os.stat_result and algorithm,
+        or None if the file has not been hashed with same stat signature.
+        """
+        if stat is None:
+            return None
+
+        entry = self.query(ChecksumCacheModel).filter(
+            ChecksumCacheModel.device == stat.st_dev,
+            ChecksumCacheModel.inode == stat.st_ino,
+            ChecksumCacheModel.size == stat.st_size,
+            ChecksumCacheModel.mtime == stat.st_mtime_ns,
+            ChecksumCacheModel.algorithm == algorithm,
+        ).first()
+
+        return entry is not None and entry.checksum or None
+
+    def cache_checksum(self, path, stat, algorithm, checksum, commit=True):
+        """Store checksum to cache
+
+        Replaces any checksum cached for same path or same device and inode with
+        algorithm, since earlier signatures of the file can't match again. Stat
+        must be taken from the file that was hashed.
+        """
+        if stat is None or checksum is None:
+            return
+
+        self.query(ChecksumCacheModel).filter(
+            or_(
+                ChecksumCacheModel.path == path,
+                and_(ChecksumCacheModel.device == stat.st_dev, ChecksumCacheModel.inode == stat.st_ino),
+            ),
+            ChecksumCacheModel.algorithm == algorithm,
+        ).delete(synchronize_session=False)
+
+        self.session.add(ChecksumCacheModel(
+            path=path,
+            device=stat.st_dev,
+            inode=stat.st_ino,
+            size=stat.st_size,
+            mtime=stat.st_mtime_ns,
+            algorithm=algorithm,
+            checksum=checksum,
+        ))
+        if commit:
+            self.commit()
+
     def get_playlist_tree(self, path):
         """Get playlist tree
 
@@ -1457,8 +1990,27 @@ class SoundforestDB(object):
     def match_tracks_by_tree_prefix(self, path):
         """Match tracks
 
-        Return tracks matching path prefix
+        Return tracks in directory path and its subdirectories. Path is
+        matched as a whole directory prefix, not as a substring of track
+        directories: '/music/a' does not match tracks in '/music/ab' or
+        '/other/music/a'.
         """
         return self.query(TrackModel).filter(
-            TrackModel.directory.like('%{0}%'.format(path))
+            directory_filter(TrackModel.directory, path, recursive=True)
         ).all()
+
+    def search_tracks(self, match, tree=None, paths=False, limit=None):
+        """Search tracks
+
+        Return tracks with tag values, or directory and name if paths is True,
+        matching words in match as prefixes. Tracks are optionally limited to
+        given tree and sorted best matches first.
+        """
+        if not self.search_indexes:
+            raise SoundforestError('Full text search is not available')
+
+        index = paths and 'track_search' or 'tag_search'
+        tracks = search_tracks(self.session, index, match, tree=tree, limit=limit)
+        if tracks is None:
+            raise SoundforestError('Full text search is not available')
+        return tracks
@@ -21,6 +21,9 @@ DEFAULT_PATHS = [
     os.path.join(os.getenv('HOME'), 'Music')
 ]
 
+# Maximum number of directory realpaths cached for prefix lookups
+REALPATH_CACHE_SIZE = 4096
+
 ITUNES_MUSIC = os.path.join(os.getenv('HOME'), 'Music', 'iTunes', 'iTunes Media', 'Music')
 ITUNES_PARTS = ITUNES_MUSIC.split(os.sep)
 for i in range(0, len(ITUNES_PARTS) + 1):
@@ -43,6 +46,7 @@ class MusicTreePrefix(object):
     def __init__(self, path, extensions=[]):
         self.log = SoundforestLogger().default_stream
         self.path = path.rstrip(os.sep)
+        self.__realpath = None
 
         if not isinstance(extensions, list):
             raise PrefixError('Extensions must be a list')
@@ -63,14 +67,26 @@ class MusicTreePrefix(object):
 
     @property
     def realpath(self):
-        return os.path.realpath(self.path)
+        """Prefix realpath
+
+        Resolved path of the prefix, cached until refresh() is called
+        """
+        if self.__realpath is None:
+            self.__realpath = os.path.realpath(self.path)
+        return self.__realpath
+
+    def refresh(self):
+        """Refresh cached realpath
+
+        """
+        self.__realpath = None
 
     def match(self, path):
         if path[:len(self.path)] == self.path:
             return True
 
         realpath = os.path.realpath(path)
-        mypath = os.path.realpath(self.path)
+        mypath = self.realpath
         if realpath[:len(mypath)] == mypath:
             return True
 
@@ -87,7 +103,7 @@ class MusicTreePrefix(object):
             return path_string(path[len(self.path):].lstrip(os.sep))
 
         realpath = os.path.realpath(path)
-        mypath = os.path.realpath(self.path)
+        mypath = self.realpath
 
         if realpath[:len(mypath)] == mypath:
             return path_string(realpath[len(mypath):].lstrip(os.sep))
@@ -95,6 +111,60 @@ class MusicTreePrefix(object):
         raise PrefixError('Prefix does not match: {}'.format(path))
 
 
+class PrefixTrie(object):
+
+    """PrefixTrie
+
+    Trie of tree prefixes by path components. Each prefix is added with its
+    path and realpath, and the position of prefix in prefix list. Lookup
+    walks the trie once with the components of the looked up path.
+
+    """
+    def __init__(self, prefixes=[]):
+        self.root = {}
+        for index, prefix in enumerate(prefixes):
+            self.add(prefix.path, index, prefix)
+            if prefix.realpath != prefix.path:
+                self.add(prefix.realpath, index, prefix)
+
+    def add(self, path, index, prefix):
+        node = self.root
+        for component in path.rstrip(os.sep).split(os.sep):
+            node = node.setdefault(component, {})
+
+        existing = node.get(None, None)
+        if existing is None or index < existing[0]:
+            node[None] = (index, prefix)
+
+    def lookup(self, path, match_existing=False):
+        """Lookup prefix for path
+
+        Returns (index, prefix, relative path) for prefix matching path that
+        comes first in prefix list, or None if no prefix matches. With
+        match_existing flag, only prefixes with existing directories match.
+        """
+        components = path.rstrip(os.sep).split(os.sep)
+        match = None
+        node = self.root
+        for depth, component in enumerate(components):
+            node = node.get(component, None)
+            if node is None:
+                break
+
+            entry = node.get(None, None)
+            if entry is None or match is not None and match[0] < entry[0]:
+                continue
+            if match_existing and not os.path.isdir(entry[1].path):
+                continue
+            match = (entry[0], entry[1], depth + 1)
+
+        if match is None:
+            return None
+
+        index, prefix, depth = match
+        return index, prefix, path_string(os.sep.join(components[depth:]))
+
+
 class TreePrefixes(object):
 
     """TreePrefixes
@@ -114,6 +184,8 @@ class TreePrefixes(object):
         def __init__(self):
             self.log = SoundforestLogger().default_stream
             self.db = ConfigDB()
+            self.__trie = None
+            self.__realpaths = {}
 
             common_prefixes = set(DEFAULT_PATHS + [prefix.path for prefix in self.db.tree_prefixes])
 
@@ -209,33 +281,145 @@ class TreePrefixes(object):
 
             return prefix
 
-        def match_extension(self, extension, match_existing=False):
-            for prefix in self:
-                if match_existing and not os.path.isdir(prefix.path):
-                    continue
+        def invalidate(self):
+            """Invalidate prefix trie
 
-                if prefix.match_extension(extension):
-                    return prefix
+            Called when prefixes are modified, trie is rebuilt on next lookup
+            and cached directory realpaths are resolved again
+            """
+            self.__trie = None
+            self.__realpaths = {}
 
-            return None
+        def __setitem__(self, key, value):
+            super().__setitem__(key, value)
+            self.invalidate()
 
-        def match(self, path, match_existing=False):
+        def __delitem__(self, key):
+            super().__delitem__(key)
+            self.invalidate()
+
+        def __iadd__(self, other):
+            result = super().__iadd__(other)
+            self.invalidate()
+            return result
+
+        def append(self, prefix):
+            super().append(prefix)
+            self.invalidate()
+
+        def extend(self, prefixes):
+            super().extend(prefixes)
+            self.invalidate()
+
+        def insert(self, index, prefix):
+            super().insert(index, prefix)
+            self.invalidate()
+
+        def remove(self, prefix):
+            super().remove(prefix)
+            self.invalidate()
+
+        def pop(self, index=-1):
+            prefix = super().pop(index)
+            self.invalidate()
+            return prefix
+
+        def clear(self):
+            super().clear()
+            self.invalidate()
+
+        def sort(self, *args, **kwargs):
+            super().sort(*args, **kwargs)
+            self.invalidate()
+
+        def reverse(self):
+            super().reverse()
+            self.invalidate()
+
+        def refresh(self):
+            """Refresh prefix lookups
+
+            Resolve realpaths of prefixes again and rebuild the prefix trie,
+            for example after symlinks in prefix paths have changed
+            """
             for prefix in self:
+                prefix.refresh()
+            self.invalidate()
+
+        @property
+        def trie(self):
+            """Prefix trie
+
+            PrefixTrie of registered prefixes, built on first lookup after
+            prefixes were modified with list methods or refresh()
+            """
+            if self.__trie is None:
+                self.__trie = PrefixTrie(self)
+            return self.__trie
+
+        def realpath(self, path):
+            """Return realpath of path
+
+            Realpaths of parent directories are cached, so looking up files in
+            same directory costs one lstat for the file itself instead of a
+            realpath syscall per path component. Cache is cleared when
+            prefixes change or are refreshed.
+            """
+            directory, name = os.path.split(path)
+            if not os.path.isabs(path) or name in ('', '.', '..') or os.path.islink(path):
+                return os.path.realpath(path)
+
+            realpath = self.__realpaths.get(directory, None)
+            if realpath is None:
+                if len(self.__realpaths) >= REALPATH_CACHE_SIZE:
+                    self.__realpaths.clear()
+                realpath = os.path.realpath(directory)
+                self.__realpaths[directory] = realpath
+            return os.path.join(realpath, name)
+
+        def lookup(self, path, match_existing=False):
+            """Lookup prefix for path
+
+            Returns (prefix, relative path) for first registered prefix
+            matching path or realpath of path, or None. Realpath of path is
+            not resolved if the first prefix matches path as given, and is
+            otherwise resolved with cached directory realpaths from realpath().
+            When same prefix matches both, relative path is returned for path
+            as given.
+            """
+            match = self.trie.lookup(path, match_existing)
+            if match is None or match[0] > 0:
+                realpath = self.realpath(path)
+                if realpath != path:
+                    real_match = self.trie.lookup(realpath, match_existing)
+                    if real_match is not None and (match is None or real_match[0] < match[0]):
+                        match = real_match
+
+            if match is None:
+                return None
+            return match[1], match[2]
 
+        def match_extension(self, extension, match_existing=False):
+            for prefix in self:
                 if match_existing and not os.path.isdir(prefix.path):
                     continue
 
-                if prefix.match(path):
+                if prefix.match_extension(extension):
                     return prefix
 
             return None
 
+        def match(self, path, match_existing=False):
+            match = self.lookup(path, match_existing)
+            if match is None:
+                return None
+            return match[0]
+
         def relative_path(self, path):
-            prefix = self.match(path)
-            if not prefix:
+            match = self.lookup(path)
+            if match is None:
                 return path
-
-            return prefix.relative_path(path)
+            return match[1]
 
     def __getattr__(self, attr):
         return getattr(self.__instance, attr)
@@ -6,14 +6,19 @@ Parsing of syncing options
 
 import os
 import shutil
-import threading
 import time
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from subprocess import Popen, PIPE
 
+from soundforest import TreeError
+from soundforest.checksum import audio_checksum, checksums_equal, parse_checksum, ChecksumError
 from soundforest.defaults import SOUNDFOREST_USER_DIR
 from soundforest.cli import ScriptThread, ScriptThreadManager
 from soundforest.log import SoundforestLogger
+from soundforest.tags import TagError
+from soundforest.tags.albumart import AlbumArtError
 from soundforest.tree import Tree, Track
 
 RSYNC_DELETE_FLAGS = (
@@ -27,6 +32,18 @@ RSYNC_DELETE_FLAGS = (
 )
 DEFAULT_DELETE_FLAG = '--delete-before'
 
+# Number of files copied at once by each directory sync target
+DEFAULT_COPY_THREADS = 4
+
+# Maximum total size of files being copied at once by directory sync target
+DEFAULT_COPY_BYTES = 256 * 2**20
+
+# Directory sync target flags, given as name=value pairs
+DIRECTORY_SYNC_FLAGS = (
+    'copy_threads',
+    'copy_bytes',
+)
+
 
 class SyncError(Exception):
     pass
@@ -56,6 +73,54 @@ RENAME_CALLBACKS = {
 }
 
 
+def parse_directory_sync_flags(flags):
+    """Parse directory sync flags
+
+    Directory sync target flags are name=value pairs separated by spaces, for
+    example 'copy_threads=8 copy_bytes=67108864'. Returns dictionary of
+    FilesystemSyncThread arguments.
+    """
+    options = {}
+    if not flags:
+        return options
+
+    if isinstance(flags, str):
+        flags = flags.split()
+
+    for flag in flags:
+        try:
+            name, value = flag.split('=', 1)
+            if name not in DIRECTORY_SYNC_FLAGS:
+                raise ValueError
+            options[name] = int(value)
+        except ValueError:
+            raise SyncError('Invalid directory sync flag: {}'.format(flag))
+
+    return options
+
+
+class SyncJob(object):
+    """SyncJob
+
+    Track to copy to directory sync target. Modified tracks are retagged
+    instead of copied if only tags differ. Status is set to 'new',
+    'modified', 'retagged' or 'skipped' when the job is done, or error if it
+    failed. Modified tracks with same audio and tags are skipped.
+    """
+
+    def __init__(self, index, track, dst_track, modified=False):
+        self.index = index
+        self.track = track
+        self.dst_track = dst_track
+        self.modified = modified
+        self.size = track.size or 0
+        self.status = None
+        self.error = None
+
+    def __repr__(self):
+        return '{:6d} {}: {}'.format(self.index, self.status, self.dst_track.path)
+
+
 class SyncThread(ScriptThread):
     def __init__(self, manager, index, src, dst, delete=False):
         super(SyncThread, self).__init__('sync')
@@ -90,7 +155,20 @@ class SyncThread(ScriptThread):
 
 
 class FilesystemSyncThread(SyncThread):
-    def __init__(self, manager, index, src, dst, delete=False, rename=None):
+    """FilesystemSyncThread
+
+    Copy new and modified tracks to destination directory. Tracks to copy
+    are collected first, and then copied in a pool of copy_threads worker
+    threads, with at most copy_bytes bytes of files being copied at once.
+
+    Audio checksums of source tracks stored in database can be given as
+    dictionary of track paths to (mtime, audio_checksum) tuples, returned by
+    SyncManager.get_audio_checksums, to avoid reading source tracks when
+    checking if modified tracks only need retagging.
+    """
+
+    def __init__(self, manager, index, src, dst, delete=False, rename=None, copy_threads=None, copy_bytes=None,
+                 audio_checksums=None):
         super(FilesystemSyncThread, self).__init__(manager, index, src, dst, delete)
 
         if rename is not None:
@@ -100,6 +178,9 @@ class FilesystemSyncThread(SyncThread):
                 raise SyncError('Unknown rename callback: {}'.format(rename))
 
         self.rename = rename
+        self.copy_threads = max(1, int(copy_threads is not None and copy_threads or DEFAULT_COPY_THREADS))
+        self.copy_bytes = max(1, int(copy_bytes is not None and copy_bytes or DEFAULT_COPY_BYTES))
+        self.audio_checksums = audio_checksums is not None and audio_checksums or {}
 
     def copy_track(self, src, dst):
         try:
@@ -111,15 +192,94 @@ class FilesystemSyncThread(SyncThread):
         except OSError as e:
             raise SyncError('Error writing to {}: {}'.format(dst, e))
 
-    def run(self):
-        if not os.path.isdir(self.src_tree.path):
-            raise SyncError('Source not available while syncing: {}'.format(self.src_tree.path))
+    def albumart_checksum(self, tags):
+        """Embedded albumart checksum
 
-        if not os.path.isdir(self.dst_tree.path):
-            raise SyncError('Destination not available while syncing: {}'.format(self.dst_tree.path))
+        Returns checksum of albumart embedded in tags, or None
+        """
+        if tags.albumart_obj is None:
+            return None
+        try:
+            return tags.albumart_obj.checksum
+        except AlbumArtError:
+            return None
+
+    def retag_track(self, src, dst):
+        """Update tags of modified track
+
+        If audio payload of src and dst tracks is same and only tags differ,
+        replace dst tags with src tags instead of copying the file. Returns
+        'retagged' if tags were replaced, 'skipped' if tags were already same
+        and None if the track must be copied. Tracks with different albumart
+        image checksums are copied, because albumart is not copied between
+        tags.
 
+        Stored audio checksum of src is used if src is not modified after
+        it was stored, and dst is hashed with the same algorithm.
+        """
+        try:
+            mtime, src_checksum = self.audio_checksums.get(src.path, (None, None))
+            if src_checksum is None or mtime != src.mtime:
+                src_checksum = audio_checksum(src.path)
+            algorithm = parse_checksum(src_checksum)[0]
+            if not checksums_equal(src_checksum, audio_checksum(dst.path, algorithm)):
+                return None
+            src_tags = src.tags
+            dst_tags = dst.tags
+        except ChecksumError:
+            return None
+        except TreeError:
+            return None
+
+        if src_tags is None or dst_tags is None:
+            return None
+        if self.albumart_checksum(src_tags) != self.albumart_checksum(dst_tags):
+            return None
+
+        tags = src_tags.as_dict()
+        if tags == dst_tags.as_dict():
+            return 'skipped'
+
+        try:
+            dst_tags.replace_tags(tags)
+            dst_tags.save()
+        except TagError as e:
+            self.log.info('Error updating tags {}: {}'.format(dst.path, e))
+            return None
+
+        return 'retagged'
+
+    def sync_track(self, job):
+        """Sync track of job
+
+        Called in worker threads. Errors are stored to job.error.
+        """
+        try:
+            status = None
+            if job.modified:
+                status = self.retag_track(job.track, job.dst_track)
+            if status is None:
+                self.copy_track(job.track.path, job.dst_track.path)
+                status = job.modified and 'modified' or 'new'
+            job.status = status
+
+        except SyncError as e:
+            job.error = e
+
+        return job
+
+    def plan(self):
+        """Collect sync jobs
+
+        Create missing album directories in destination and return SyncJob
+        objects for new tracks and tracks with different size or older
+        modification time in destination. Size alone misses tag edits which
+        fit in the padding of existing tags, so newer source tracks are
+        compared by audio checksum and tags in retag_track before copying.
+        """
         src = self.src_tree
         dst = self.dst_tree
+        jobs = []
         i = 0
 
         for album in src.as_albums():
@@ -138,28 +298,58 @@ class FilesystemSyncThread(SyncThread):
 
             for track in album:
                 i += 1
-                dst_track_path = os.path.join(dst.path, track.relative_path())
+                dst_track_path = os.path.join(dst.path, src.relative_path(track))
 
                 if self.rename:
                     dst_track_path = self.rename(dst_track_path)
                 dst_track = Track(os.path.join(dst_track_path))
 
-                modified = False
                 if not os.path.isfile(dst_track.path):
-                    self.log.info('{:6d} new: {}'.format(i, dst_track.path))
-                    modified = True
+                    jobs.append(SyncJob(i, track, dst_track))
+
+                elif track.size != dst_track.size or track.mtime > dst_track.mtime:
+                    jobs.append(SyncJob(i, track, dst_track, modified=True))
 
-                elif track.size != dst_track.size:
-                    self.log.info('{:6d} modified: {}'.format(i, dst_track.path))
-                    modified = True
+        return jobs
 
-                if modified:
+    def run(self):
+        if not os.path.isdir(self.src_tree.path):
+            raise SyncError('Source not available while syncing: {}'.format(self.src_tree.path))
+
+        if not os.path.isdir(self.dst_tree.path):
+            raise SyncError('Destination not available while syncing: {}'.format(self.dst_tree.path))
+
+        queue = deque(self.plan())
+        self.log.debug('{} {:d} tracks to sync to {}'.format(self.index, len(queue), self.dst_tree.path))
+
+        pending = {}
+        inflight = 0
+
+        with ThreadPoolExecutor(max_workers=self.copy_threads) as executor:
+            while queue or pending:
+                # Files larger than copy_bytes are copied when nothing else is in flight
+                while queue and len(pending) < self.copy_threads:
+                    if pending and inflight + queue[0].size > self.copy_bytes:
+                        break
+
+                    job = queue.popleft()
+                    inflight += job.size
+                    pending[executor.submit(self.sync_track, job)] = job
+
+                done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = pending.pop(future)
+                    inflight -= job.size
                     try:
-                        self.copy_track(track.path, dst_track.path)
+                        future.result()
+                    except Exception as e:
+                        # Unexpected errors fail only this job, not the whole sync
+                        job.error = SyncError('Error syncing {}: {}'.format(job, e))
 
-                    except SyncError as e:
-                        self.log.info(e)
-                        continue
+                    if job.error is not None:
+                        self.log.info(job.error)
+                    else:
+                        self.log.info(job)
 
 
 class RsyncThread(SyncThread):
@@ -201,10 +391,11 @@ class RsyncThread(SyncThread):
 
 
 class SyncManager(ScriptThreadManager):
-    def __init__(self, threads=None, delete=False, debug=False):
+    def __init__(self, threads=None, delete=False, debug=False, copy_threads=None):
         super(SyncManager, self).__init__('sync', threads)
         self.delete = delete
         self.debug = debug
+        self.copy_threads = copy_threads
 
         if not debug:
             self.log = SoundforestLogger('sync').register_file_handler('sync', SOUNDFOREST_USER_DIR)
@@ -215,7 +406,7 @@ class SyncManager(ScriptThreadManager):
 
     def parse_target(self, name):
         try:
-            target = self.db.sync[name]
+            target = dict(self.db.sync_configuration[name])
 
         except KeyError:
             return None
@@ -232,14 +423,35 @@ class SyncManager(ScriptThreadManager):
     def rename_callbacks(self):
         return RENAME_CALLBACKS
 
+    def get_audio_checksums(self, path):
+        """Stored audio checksums of tree tracks
+
+        Returns dictionary of track paths to (mtime, audio_checksum) tuples
+        for tracks with audio checksum in database tree at path, loaded with
+        one query. Returns empty dictionary if path is not a database tree.
+        """
+        db_tree = self.db.get_tree(os.path.expandvars(path).rstrip(os.sep))
+        if db_tree is None:
+            return {}
+
+        return dict(
+            (os.path.join(directory, '{}.{}'.format(name, extension)), (mtime, stored))
+            for (directory, name, extension), (track_id, mtime, checksum, stored)
+            in self.db.get_tree_track_map(db_tree).items()
+            if stored is not None
+        )
+
     def get_entry_handler(self, index, config):
         sync_type = config.pop('type', None)
         if sync_type == 'rsync':
             return RsyncThread(manager=self, index=index, **config)
 
         elif sync_type == 'directory':
-            if 'flags' in config:
-                del config['flags']
+            config.update(parse_directory_sync_flags(config.pop('flags', None)))
+            if self.copy_threads is not None:
+                config['copy_threads'] = self.copy_threads
+            if isinstance(config.get('src', None), str):
+                config['audio_checksums'] = self.get_audio_checksums(config['src'])
             return FilesystemSyncThread(manager=self, index=index, **config)
 
         else:
@@ -266,18 +478,19 @@ class SyncManager(ScriptThreadManager):
         if len(self) == 0:
             return
 
+        # Only count sync threads, directory syncs run copy worker threads
         total = len(self)
+        running = []
         while len(self) > 0:
-            active = threading.active_count()
-            if active > self.threads:
+            running = [t for t in running if t.is_alive()]
+            if len(running) >= int(self.threads):
                 time.sleep(0.5)
                 continue
 
             index = '{:d}/{:d}'.format(total-len(self)+1, total)
             t = self.get_entry_handler(index, self.pop(0))
             t.start()
+            running.append(t)
 
-        active = threading.active_count()
-        while active > 1:
+        while [t for t in running if t.is_alive()]:
             time.sleep(0.5)
-            active = threading.active_count()
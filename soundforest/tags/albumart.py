@@ -4,13 +4,31 @@ Abstraction for album art image format processing
 
 """
 
+import hashlib
 import os
-import requests
+import tempfile
+import time
 from io import BytesIO
 
-from PIL import ImageFile
+from soundforest.defaults import SOUNDFOREST_CACHE_DIR
 
 DEFAULT_ARTWORK_FILENAME = 'artwork.jpg'
+DEFAULT_ALBUMART_STORE = os.path.join(SOUNDFOREST_CACHE_DIR, 'albumart')
+
+DEFAULT_THUMBNAIL_CACHE = os.path.join(SOUNDFOREST_CACHE_DIR, 'thumbnails')
+DEFAULT_THUMBNAIL_SIZES = (64, 256, 600)
+DEFAULT_THUMBNAIL_CACHE_BYTES = 256 * 1024 * 1024
+THUMBNAIL_FORMAT = 'JPEG'
+THUMBNAIL_QUALITY = 85
+
+# Eviction removes thumbnails until cache is below this fraction of byte budget
+THUMBNAIL_CACHE_LOW_WATERMARK = 0.9
+
+# Maximum number of colors counted by AlbumArt.colors()
+DEFAULT_MAX_COLORS = 256
+
+# Hash algorithm for album art image checksums
+ALBUMART_CHECKSUM_ALGORITHM = 'sha1'
 
 PIL_EXTENSION_MAP = {
     'JPEG':     'jpg',
@@ -30,11 +48,20 @@ class AlbumArtError(Exception):
 class AlbumArt(object):
     """
     Class to parse albumart image files from tags and files
+
+    Image data is stored as encoded bytes. Image format and size are probed
+    from image header when requested, and the image is decoded with PIL only
+    when pixels are needed.
     """
 
     def __init__(self, path=None):
-        self.__image = None
+        self.__data = None
         self.__mimetype = None
+        self.__checksum = None
+        self.__header = None
+        self.__format = None
+        self.__size = None
+        self.__image = None
 
         if path is not None:
             self.import_file(path)
@@ -46,7 +73,8 @@ class AlbumArt(object):
 
         if not self.is_loaded():
             return 'Uninitialized AlbumArt object.'
-        return '%(mime)s %(bytes)d bytes %(width)dx%(height)d' % self.get_info()
+        width, height = self.size
+        return '{} {:d} bytes {:d}x{:d}'.format(self.mimetype, len(self), width, height)
 
     def __unicode__(self):
         """
@@ -55,45 +83,137 @@ class AlbumArt(object):
 
         if not self.is_loaded():
             return u'Uninitialized AlbumArt object'
-        return '%(mime)s %(width)dx%(height)dpx' % self.get_info()
+        width, height = self.size
+        return '{} {:d}x{:d}px'.format(self.mimetype, width, height)
 
     def __len__(self):
         """
-        Returns PIL image length as string
+        Returns length of encoded image data in bytes
         """
 
         if not self.is_loaded():
             return 0
-        return len(self.__image.tostring())
+        return len(self.__data)
+
+    def __probe(self):
+        """
+        Open the image header with PIL without decoding image data
+        """
+        if self.__header is None:
+            if self.__data is None:
+                raise AlbumArtError('AlbumArt not yet initialized.')
+
+            from PIL import Image
+            try:
+                header = Image.open(BytesIO(self.__data))
+            except IOError:
+                raise AlbumArtError('Error parsing albumart image data')
+
+            if header.format not in PIL_MIME_MAP:
+                raise AlbumArtError('Unsupported PIL image format: {}'.format(
+                    header.format,
+                ))
+
+            self.__header = header
+            self.__format = header.format
+            self.__size = (int(header.size[0]), int(header.size[1]))
+            self.__mimetype = PIL_MIME_MAP[header.format]
 
-    def __parse_image(self, data):
+        return self.__header
+
+    def load_details(self):
+        """
+        Load image header details and checksum
+
+        Details are otherwise loaded on first lookup. Load them before sharing
+        the image with threads, so threads only read cached values.
+        """
+        self.__probe()
+        return self.checksum
+
+    @property
+    def mimetype(self):
+        """
+        Return image mime type, given on import or probed from image header
+        """
+        if self.__mimetype is None:
+            self.__probe()
+        return self.__mimetype
+
+    @property
+    def checksum(self):
         """
-        Load the image from data with PIL
+        Return hex digest of encoded image bytes
         """
+        if self.__checksum is None:
+            if self.__data is None:
+                raise AlbumArtError('AlbumArt not yet initialized.')
+            self.__checksum = hashlib.new(ALBUMART_CHECKSUM_ALGORITHM, self.__data).hexdigest()
+        return self.__checksum
+
+    @property
+    def size(self):
+        """
+        Return image (width, height) from image header
+        """
+        if self.__size is None:
+            self.__probe()
+        return self.__size
+
+    @property
+    def image(self):
+        """
+        Return image decoded with PIL and converted to RGB
+        """
+        if self.__image is None:
+            image = self.__probe()
+            try:
+                image.load()
+            except IOError:
+                raise AlbumArtError('Error parsing albumart image data')
+
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            self.__image = image
 
+        return self.__image
+
+    def thumbnail(self, size):
+        """
+        Return RGB PIL image scaled to fit in size x size pixels
+
+        JPEG images are decoded directly at reduced scale, and the full
+        image cached in self.image is not decoded.
+        """
+        if not self.is_loaded():
+            raise AlbumArtError('AlbumArt not yet initialized.')
+
+        from PIL import Image
         try:
-            parser = ImageFile.Parser()
-            parser.feed(data)
-            self.__image = parser.close()
+            image = Image.open(BytesIO(self.__data))
+            image.draft('RGB', (size, size))
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            image.thumbnail((size, size), Image.LANCZOS)
         except IOError:
             raise AlbumArtError('Error parsing albumart image data')
 
-        try:
-            self.__mimetype = PIL_MIME_MAP[self.__image.format]
-        except KeyError:
-            self.__image = None
-            raise AlbumArtError('Unsupported PIL image format: {}'.format(
-                self.__image.format,
-            ))
-
-        if self.__image.mode != 'RGB':
-            self.__image = self.__image.convert('RGB')
+        return image
 
-    def import_data(self, data):
+    def import_data(self, data, mimetype=None):
         """
         Import albumart from metadata tag or database as bytes
         """
-        self.__parse_image(data)
+        if not data:
+            raise AlbumArtError('Albumart image data is empty')
+
+        self.__data = bytes(data)
+        self.__mimetype = mimetype in PIL_MIME_MAP.values() and mimetype or None
+        self.__checksum = None
+        self.__header = None
+        self.__format = None
+        self.__size = None
+        self.__image = None
 
     def import_file(self, path):
         """
@@ -106,13 +226,14 @@ class AlbumArt(object):
                 path,
             ))
 
-        self.__parse_image(open(path, 'r').read())
+        with open(path, 'rb') as fd:
+            self.import_data(fd.read())
 
     def is_loaded(self):
         """
         Boolean test to see if album art image is loaded
         """
-        return self.__image is not None
+        return self.__data is not None
 
     def get_fileformat(self):
         """
@@ -120,42 +241,63 @@ class AlbumArt(object):
         """
         if not self.is_loaded():
             raise AlbumArtError('AlbumArt not yet initialized.')
-        return self.__image.format
+        if self.__format is None:
+            self.__probe()
+        return self.__format
 
-    def get_info(self):
+    def colors(self, max_colors=DEFAULT_MAX_COLORS):
         """
-        Return details of loaded album art image
+        Return number of colors in the image
+
+        Returns None if the image has more than max_colors colors. Requires
+        decoding the image.
         """
         if not self.is_loaded():
             raise AlbumArtError('AlbumArt not yet initialized.')
-        colors = self.__image.getcolors()
+        colors = self.image.getcolors(max_colors)
         if colors is None:
-            colors = 0
-        return {
+            return None
+        return len(colors)
+
+    def get_info(self, colors=False):
+        """
+        Return details of loaded album art image
+
+        Details are read from image header. Color count requires decoding
+        the image and is only returned if colors is True, or number
+        of colors to count at most.
+        """
+        if not self.is_loaded():
+            raise AlbumArtError('AlbumArt not yet initialized.')
+        width, height = self.size
+        info = {
             'type': 3,  # Album cover
-            'mime': self.__mimetype,
+            'mime': self.mimetype,
+            'format': self.get_fileformat(),
             'bytes': len(self),
-            'width': int(self.__image.size[0]),
-            'height': int(self.__image.size[1]),
-            'colors': colors,
+            'width': width,
+            'height': height,
         }
+        if colors:
+            if colors is True:
+                colors = DEFAULT_MAX_COLORS
+            info['colors'] = self.colors(colors)
+        return info
 
     def dump(self):
         """
-        Returns bytes from the image with BytesIO   read() call
+        Returns encoded bytes of the image
         """
         if not self.is_loaded():
             raise AlbumArtError('AlbumArt not yet initialized.')
 
-        s = BytesIO()
-        self.__image.save(s, self.get_fileformat())
-        s.seek(0)
-        return s.read()
+        return self.__data
 
     def save(self, path, fileformat=None):
         """
         Saves the image data to given target file.
 
+        Image is written as is, unless different fileformat is requested.
         If target filename exists, it is removed before saving.
         """
         if not self.is_loaded():
@@ -177,7 +319,11 @@ class AlbumArt(object):
                 ))
 
         try:
-            self.__image.save(path, fileformat)
+            if fileformat == self.get_fileformat():
+                with open(path, 'wb') as fd:
+                    fd.write(self.__data)
+            else:
+                self.image.save(path, fileformat)
         except IOError as e:
             raise AlbumArtError('Error saving {}: {}'.format(
                 path,
@@ -185,6 +331,7 @@ class AlbumArt(object):
             ))
 
     def fetch(self, url):
+        import requests
         res = requests.get(url)
         if res.status_code != 200:
             raise AlbumArtError('Error fetching url {} (returns {})'.format(
@@ -210,4 +357,218 @@ class AlbumArt(object):
                 res.headers.get('content-type', None)
             ))
 
-        return self.import_data(res.content)
+        return self.import_data(res.content, content_type)
+
+
+class AlbumArtStore(object):
+    """
+    Content addressed store of album art image files
+
+    Each image is stored once, named by image checksum in subdirectories
+    named by first two characters of the checksum. Files are written to
+    temporary files and renamed, so the store can be written from multiple
+    processes.
+    """
+
+    def __init__(self, path=DEFAULT_ALBUMART_STORE):
+        self.path = path
+
+    def __repr__(self):
+        return self.path
+
+    def __contains__(self, checksum):
+        return os.path.isfile(self.image_path(checksum))
+
+    def image_path(self, checksum):
+        """
+        Return path to image file with given checksum
+        """
+        return os.path.join(self.path, checksum[:2], checksum)
+
+    def store(self, albumart):
+        """
+        Store albumart image, if not already stored. Returns image checksum.
+        """
+        checksum = albumart.checksum
+        path = self.image_path(checksum)
+        if os.path.isfile(path):
+            return checksum
+
+        directory = os.path.dirname(path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory, exist_ok=True)
+
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as tmpfile:
+                    tmpfile.write(albumart.dump())
+                os.replace(tmp, path)
+            except OSError:
+                os.unlink(tmp)
+                raise
+
+        except OSError as e:
+            raise AlbumArtError('Error storing albumart {}: {}'.format(path, e))
+
+        return checksum
+
+    def load(self, checksum):
+        """
+        Return AlbumArt for image with given checksum
+        """
+        path = self.image_path(checksum)
+        if not os.path.isfile(path):
+            raise AlbumArtError('Albumart not in store: {}'.format(checksum))
+        return AlbumArt(path)
+
+
+class AlbumArtThumbnails(object):
+    """
+    Cache of album art thumbnail images
+
+    Thumbnails are stored as JPEG files in subdirectories by thumbnail size,
+    named by album art image checksum. A changed image gets a new checksum
+    and is thumbnailed again.
+
+    File modification time is the time thumbnail was generated, and access
+    time is updated explicitly when thumbnail is used. Least recently used
+    thumbnails are removed when total size of cache exceeds max_bytes.
+    """
+
+    def __init__(self, path=DEFAULT_THUMBNAIL_CACHE, sizes=DEFAULT_THUMBNAIL_SIZES,
+                 max_bytes=DEFAULT_THUMBNAIL_CACHE_BYTES):
+        self.path = path
+        self.sizes = tuple(int(size) for size in sizes)
+        self.max_bytes = max_bytes
+        self.__total_bytes = None
+
+    def __repr__(self):
+        return self.path
+
+    @property
+    def total_bytes(self):
+        """
+        Return total size of cached thumbnails in bytes
+        """
+        if self.__total_bytes is None:
+            self.__total_bytes = sum(entry[2] for entry in self.__entries())
+        return self.__total_bytes
+
+    def __entries(self):
+        """
+        Return (atime, path, bytes) for all cached thumbnails
+        """
+        entries = []
+        for root, dirs, files in os.walk(self.path):
+            for filename in files:
+                if filename.startswith('.tmp'):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_atime, path, st.st_size))
+        return entries
+
+    def thumbnail_path(self, checksum, size):
+        """
+        Return path to thumbnail of given size for image with given checksum
+        """
+        return os.path.join(
+            self.path,
+            '{:d}'.format(size),
+            checksum[:2],
+            '{}.{}'.format(checksum, PIL_EXTENSION_MAP[THUMBNAIL_FORMAT]),
+        )
+
+    def get(self, albumart, size, mtime=None):
+        """
+        Return path to thumbnail of given size for albumart
+
+        Thumbnail is generated if it is not cached, or if it is older than
+        mtime of album art source file given as mtime.
+        """
+        size = int(size)
+        if size not in self.sizes:
+            raise AlbumArtError('Unsupported thumbnail size: {}'.format(size))
+
+        path = self.thumbnail_path(albumart.checksum, size)
+        try:
+            st = os.stat(path)
+            if mtime is None or st.st_mtime >= mtime:
+                os.utime(path, (time.time(), st.st_mtime))
+                return path
+        except OSError:
+            pass
+
+        self.__store(albumart.thumbnail(size), path)
+        return path
+
+    def generate(self, albumart, mtime=None):
+        """
+        Generate thumbnails of all sizes for albumart
+
+        Returns dictionary of thumbnail paths by size.
+        """
+        return dict((size, self.get(albumart, size, mtime)) for size in self.sizes)
+
+    def __store(self, image, path):
+        """
+        Write thumbnail image to cache and evict old thumbnails if needed
+        """
+        directory = os.path.dirname(path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory, exist_ok=True)
+
+            try:
+                replaced = os.stat(path).st_size
+            except OSError:
+                replaced = 0
+
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as tmpfile:
+                    image.save(tmpfile, THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY)
+                written = os.stat(tmp).st_size
+                os.replace(tmp, path)
+            except (OSError, IOError):
+                os.unlink(tmp)
+                raise
+
+        except (OSError, IOError) as e:
+            raise AlbumArtError('Error storing thumbnail {}: {}'.format(path, e))
+
+        if self.__total_bytes is not None:
+            self.__total_bytes += written - replaced
+        if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self, max_bytes=None):
+        """
+        Remove least recently used thumbnails
+
+        Thumbnails are removed until total size of cache is below low
+        watermark of max_bytes. Returns number of removed thumbnails.
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        limit = int(max_bytes * THUMBNAIL_CACHE_LOW_WATERMARK)
+
+        entries = sorted(self.__entries())
+        total = sum(entry[2] for entry in entries)
+        removed = 0
+        for atime, path, size in entries:
+            if total <= limit:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+
+        self.__total_bytes = total
+        return removed
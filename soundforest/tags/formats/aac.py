@@ -19,6 +19,10 @@ AAC_ALBUMART_PIL_FORMAT_MAP = {
     'JPEG':     MP4Cover.FORMAT_JPEG,
     'PNG':      MP4Cover.FORMAT_PNG
 }
+AAC_ALBUMART_MIME_MAP = {
+    MP4Cover.FORMAT_JPEG:   'image/jpeg',
+    MP4Cover.FORMAT_PNG:    'image/png',
+}
 
 AAC_STANDARD_TAGS = {
     'album_artist':         ['aART'],
@@ -119,8 +123,9 @@ class AACAlbumArt(TrackAlbumart):
             return
 
         try:
+            cover = self.track.entry[self.tag][0]
             albumart = AlbumArt()
-            albumart.import_data(self.track.entry[self.tag][0])
+            albumart.import_data(cover, AAC_ALBUMART_MIME_MAP.get(cover.imageformat, None))
         except AlbumArtError as e:
             raise TagError('Error reading AAC albumart tag: {}'.format(e))
 
@@ -9,7 +9,7 @@ from mutagen.flac import FLAC
 from mutagen.flac import Picture, FLACNoHeaderError
 
 from soundforest.tags import TagError, format_unicode_string_value
-from soundforest.tags.albumart import AlbumArt
+from soundforest.tags.albumart import AlbumArt, AlbumArtError
 from soundforest.tags.constants import OGG_MULTIPLE_VALUES_TAGS
 from soundforest.tags.tagparser import TagParser, TrackNumberingTag, TrackAlbumart
 
@@ -87,12 +87,17 @@ class FLACAlbumart(TrackAlbumart):
         super(FLACAlbumart, self).__init__(track)
 
         try:
-            self.albumart = AlbumArt()
-            self.albumart.import_data(self.track.entry.pictures[0].data)
+            picture = self.track.entry.pictures[0]
         except IndexError:
             self.albumart = None
             return
 
+        try:
+            self.albumart = AlbumArt()
+            self.albumart.import_data(picture.data, picture.mime)
+        except AlbumArtError as e:
+            raise TagError('Error reading FLAC albumart tag: {}'.format(e))
+
     def import_albumart(self, albumart):
         """
         Imports albumart object to the file tags.
@@ -103,7 +108,11 @@ class FLACAlbumart(TrackAlbumart):
         super(FLACAlbumart, self).import_albumart(albumart)
 
         p = Picture()
-        [setattr(p, k, v) for k, v in self.albumart.info.items()]
+        p.type = 3  # Album cover
+        p.mime = self.albumart.mimetype
+        p.width, p.height = self.albumart.size
+        p.data = self.albumart.dump()
+        self.track.entry.clear_pictures()
         self.track.entry.add_picture(p)
         self.track.modified = True
 
@@ -82,7 +82,7 @@ class MP3AlbumArt(TrackAlbumart):
 
         try:
             albumart = AlbumArt()
-            albumart.import_data(self.track.entry[self.tag].data)
+            albumart.import_data(self.track.entry[self.tag].data, self.track.entry[self.tag].mime)
         except AlbumArtError as e:
             raise TagError('Error reading mp3 albumart tag: {}'.format(e))
         self.albumart = albumart
@@ -14,7 +14,6 @@ from soundforest.log import SoundforestLogger
 from soundforest.formats import AudioFileFormat
 from soundforest.tags import TagError, format_unicode_string_value
 from soundforest.tags.constants import STANDARD_TAG_ORDER, STANDARD_TAG_MAP
-from soundforest.tags.xmltag import XMLTags
 from soundforest.tags.albumart import AlbumArt, AlbumArtError
 
 YEAR_FORMATTERS = [
@@ -41,6 +40,7 @@ class TagParser(dict):
         self.tag_map = tag_map is not None and tag_map or {}
         self.entry = None
         self.modified = False
+        self.fileformat = None
 
         self.albumart_obj = None
         self.supports_albumart = False
@@ -306,6 +306,7 @@ class TagParser(dict):
         """
         Return tags formatted as XML
         """
+        from soundforest.tags.xmltag import XMLTags
         return XMLTags(self.as_dict())
 
     def to_json(self, indent=2):
@@ -387,6 +388,8 @@ class TagParser(dict):
 
             if self.modified:
                 self.entry.save()
+                if self.fileformat is not None:
+                    self.fileformat.invalidate_stat()
 
         except OSError as e:
             raise TagError(e)
@@ -412,7 +415,16 @@ class TrackAlbumart(object):
     def info(self):
         if self.albumart is None:
             return {}
-        self.albumart.get_info()
+        return self.albumart.get_info()
+
+    @property
+    def checksum(self):
+        """
+        Returns checksum of albumart image, or None if albumart is not defined
+        """
+        if self.albumart is None:
+            return None
+        return self.albumart.checksum
 
     @property
     def defined(self):
@@ -536,4 +548,6 @@ def Tags(path, fileformat=None):
     if tag_parser is None:
         return None
 
-    return tag_parser(fileformat.codec, path)
+    tags = tag_parser(fileformat.codec, path)
+    tags.fileformat = fileformat
+    return tags
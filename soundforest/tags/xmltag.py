@@ -2,6 +2,10 @@
 XML schema representation of audio file metadata tags
 """
 
+import gzip
+
+from contextlib import ExitStack
+
 from lxml import etree as ET
 from lxml.builder import E
 
@@ -39,7 +43,7 @@ def XMLTrackNumberField(details):
             'tracknumber',
             track=details['tracknumber'][0],
         )
-    return node
+    return [node]
 
 
 def XMLTrackYear(details):
@@ -53,6 +57,9 @@ def XMLTrackYear(details):
     return nodes
 
 
+# Width of total attribute placeholder patched by XMLTrackWriter
+XML_TOTAL_PLACEHOLDER_WIDTH = 12
+
 XML_FIELD_CLASSES = {
     'tracknumber': XMLTrackNumberField,
     'year': XMLTrackYear,
@@ -63,6 +70,17 @@ class XMLTagError(Exception):
     pass
 
 
+def seekable_output(output):
+    """
+    Return True if total placeholder can be patched in output
+
+    Gzip files report being seekable, but can only seek forward when writing.
+    """
+    if isinstance(output, gzip.GzipFile):
+        return False
+    return output.seekable()
+
+
 class XMLTags(dict):
     def __init__(self, data):
         self.tree = E('track')
@@ -100,3 +118,88 @@ class XMLTrackTree(object):
     def tostring(self):
         self.tracks.set('total', '{:d}'.format(len(self.tracks)))
         return ET.tostring(self.tree, pretty_print=True)
+
+
+class XMLTrackWriter(object):
+    """
+    Streaming writer for XML track trees
+
+    Writes same document as XMLTrackTree, but each appended track is written
+    to output immediately with lxml xmlfile and not kept in memory. Output
+    must be a file object opened in binary mode, for example a gzip file.
+
+    The tracks total attribute is written with the start tag, if total is
+    known. Otherwise a placeholder is written and replaced with number of
+    appended tracks when closing the writer. This requires seekable output,
+    for non-seekable or gzip output the total attribute is omitted.
+    """
+    def __init__(self, output, total=None):
+        self.output = output
+        self.total = total
+        self.count = 0
+        self.__stack = None
+        self.__xf = None
+        self.__placeholder = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        """
+        Write XML declaration and start tags for track tree
+        """
+        if self.__stack is not None:
+            raise XMLTagError('XMLTrackWriter is already open')
+
+        attributes = {}
+        if self.total is not None:
+            attributes['total'] = '{:d}'.format(self.total)
+        elif seekable_output(self.output):
+            attributes['total'] = ' ' * XML_TOTAL_PLACEHOLDER_WIDTH
+
+        self.__stack = ExitStack()
+        self.__xf = self.__stack.enter_context(ET.xmlfile(self.output, encoding='utf-8', buffered=False))
+        self.__xf.write_declaration()
+        self.__stack.enter_context(self.__xf.element('soundforest'))
+        self.__xf.write('\n')
+
+        if self.total is None and 'total' in attributes:
+            self.__placeholder = self.output.tell() + len('<tracks total="')
+
+        self.__stack.enter_context(self.__xf.element('tracks', attributes))
+        self.__xf.write('\n')
+
+    def append(self, xmltags):
+        """
+        Write track tags to output
+        """
+        if not isinstance(xmltags, XMLTags):
+            raise XMLTagError('xmltags must be XMLTags instance')
+        if self.__xf is None:
+            raise XMLTagError('XMLTrackWriter is not open')
+
+        self.__xf.write(xmltags.tree, pretty_print=True)
+        self.count += 1
+
+    def close(self):
+        """
+        Write end tags and fill in total attribute placeholder
+        """
+        if self.__stack is None:
+            return
+
+        self.__stack.close()
+        self.__stack = None
+        self.__xf = None
+
+        if self.__placeholder is not None:
+            total = '{:d}'.format(self.count).ljust(XML_TOTAL_PLACEHOLDER_WIDTH)
+            end = self.output.tell()
+            self.output.seek(self.__placeholder)
+            self.output.write(total.encode('utf-8'))
+            self.output.seek(end)
+            self.__placeholder = None
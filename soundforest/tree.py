@@ -6,16 +6,18 @@ Abstraction of filesystem audio file trees, albums and tracks
 """
 from __future__ import unicode_literals
 
-import hashlib
 import os
 import re
 import shutil
 import time
 
 from builtins import str
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 from soundforest import normalized, path_string, TreeError
-from soundforest.defaults import DEFAULT_CODECS
+from soundforest.checksum import (read_checksums, parse_checksum, audio_cache_key, ChecksumError,
+                                  DEFAULT_CHECKSUM_ALGORITHM)
+from soundforest.database import ConfigDB
 from soundforest.log import SoundforestLogger
 from soundforest.formats import AudioFileFormat, match_codec, match_metadata
 from soundforest.prefixes import TreePrefixes
@@ -34,6 +36,56 @@ IGNORED_TREE_FOLDER_NAMES = (
 )
 
 
+def stat_entry(entry):
+    """Stat directory entry
+
+    Returns os.stat result cached by os.scandir directory entry, or None if the
+    entry can't be accessed (for example a broken symlink)
+    """
+    try:
+        return entry.stat()
+    except OSError:
+        return None
+
+
+def scan_directory(path, stat_files=True):
+    """Scan a directory
+
+    Lists one directory with os.scandir, returning lists of subdirectory and file
+    entries as (path, stat) tuples. Symlinked directories are returned in
+    subdirectories but flagged with None as stat result to prevent following them,
+    matching os.walk defaults. If stat_files is False, stat result for files is
+    None and must be looked up later when needed.
+
+    Errors listing the directory are ignored like os.walk does.
+    """
+    directories = []
+    files = []
+
+    try:
+        with os.scandir(path) as iterator:
+            entries = list(iterator)
+    except OSError:
+        return directories, files
+
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+
+        if is_dir:
+            if entry.is_symlink():
+                directories.append((entry.path, None))
+            else:
+                directories.append((entry.path, stat_entry(entry)))
+
+        elif entry.name != '':
+            files.append((entry.path, stat_files and stat_entry(entry) or None))
+
+    return directories, files
+
+
 class IterableTrackFolder(object):
     """IterableTrackFolder model
 
@@ -51,6 +103,7 @@ class IterableTrackFolder(object):
 
         self.path = path_string(path)
         self.prefixes = TreePrefixes()
+        self.paths = {}
         self.invalid_paths = []
         self.has_been_iterated = False
 
@@ -89,7 +142,7 @@ class IterableTrackFolder(object):
             self.__next += 1
             path = os.path.join(entry[0], entry[1])
             try:
-                return Track(path)
+                return Track(path, stat=self.paths.get(path, None))
             except TreeError:
                 if not self.invalid_paths.count(path):
                     self.invalid_paths.append(path)
@@ -107,6 +160,7 @@ class IterableTrackFolder(object):
         iterable = getattr(self, self.__iterable)
         del iterable[0:len(iterable)]
         del self.invalid_paths[0:len(self.invalid_paths)]
+        self.paths = {}
 
     def relative_path(self, item=None):
         """Item relative path
@@ -154,11 +208,21 @@ class Tree(IterableTrackFolder):
 
     Audio file tree
 
+    With parallel flag, directories are listed concurrently with a pool of
+    threads. This helps with high latency network filesystems. Number of
+    threads is read from configuration database 'threads' setting if not
+    given.
+
+    File stat results are cached while walking unless stat_files is False.
     """
 
-    def __init__(self, path):
+    def __init__(self, path, parallel=False, threads=None, stat_files=True):
         super(Tree, self).__init__(path, 'files')
-        self.paths = {}
+        self.stat_files = stat_files
+
+        self.threads = parallel and ConfigDB().get_threads(threads) or 1
+
+        self.directory_stats = {}
         self.empty_dirs = []
         self.relative_dirs = []
 
@@ -177,43 +241,6 @@ class Tree(IterableTrackFolder):
 
         return super(Tree, self).__len__()
 
-    def __cmp_file_path__(self):
-        class K(object):
-            def __init__(self, obj, *args):
-                self.obj = obj
-
-            def __lt__(self, other):
-                if self.obj[0] == other.obj[0]:
-                    return self.obj[1] < other.obj[1]
-                return self.obj[0] < other.obj[0]
-
-            def __gt__(self, other):
-                if self.obj[0] == other.obj[0]:
-                    return self.obj[1] > other.obj[1]
-                return self.obj[0] > other.obj[0]
-
-            def __eq__(self, other):
-                if self.obj[0] == other.obj[0]:
-                    return self.obj[1] == other.obj[1]
-                return self.obj[0] == other.obj[0]
-
-            def __le__(self, other):
-                if self.obj[0] == other.obj[0]:
-                    return self.obj[1] <= other.obj[1]
-                return self.obj[0] <= other.obj[0]
-
-            def __ge__(self, other):
-                if self.obj[0] == other.obj[0]:
-                    return self.obj[1] >= other.obj[1]
-                return self.obj[0] >= other.obj[0]
-
-            def __ne__(self, other):
-                if self.obj[0] == other.obj[0]:
-                    return self.obj[1] != other.obj[1]
-                return self.obj[0] != other.obj[0]
-
-        return K
-
     def load(self):
         """Load the albums and songs in the tree"""
 
@@ -224,24 +251,16 @@ class Tree(IterableTrackFolder):
         start = int(time.mktime(time.localtime()))
 
         super(Tree, self).load()
-        self.paths = {}
+        self.directory_stats = {}
         self.empty_dirs = []
-        self.relative_dirs = []
-
-        for (root, dirs, files) in os.walk(self.path, topdown=True):
-            if os.path.basename(root) in IGNORED_TREE_FOLDER_NAMES:
-                continue
-
-            if files:
-                self.files.extend((root, filename) for filename in files if filename != '')
-                for filename in files:
-                    self.paths[os.path.join(root, filename)] = True
+        self.relative_dirs = set()
 
-            elif not dirs:
-                self.empty_dirs.append(root)
+        if self.threads > 1:
+            self.__walk_parallel()
+        else:
+            self.__walk()
 
-        self.relative_dirs = set(self.relative_path(x[0]) for x in self.files)
-        self.files.sort(key=self.__cmp_file_path__())
+        self.files.sort()
 
         stop = int(time.mktime(time.localtime()))
         self.log.debug('loaded {:d} files in {:d} seconds'.format(
@@ -249,6 +268,64 @@ class Tree(IterableTrackFolder):
             (stop-start)
         ))
 
+    def __walk_directories(self, directories):
+        """Walked subdirectories
+
+        Return paths of scanned subdirectories to be walked
+        """
+        return [
+            path for path, stat in directories
+            if stat is not None and os.path.basename(path) not in IGNORED_TREE_FOLDER_NAMES
+        ]
+
+    def __walk(self):
+        """Walk tree
+
+        Walk the tree directories one at a time
+        """
+        pending = [self.path]
+        while pending:
+            root = pending.pop()
+            directories, files = scan_directory(root, self.stat_files)
+            self.add_directory(root, directories, files)
+            pending.extend(self.__walk_directories(directories))
+
+    def __walk_parallel(self):
+        """Walk tree in parallel
+
+        Walk the tree by listing directories in a pool of self.threads threads.
+        Subdirectories are submitted to the pool as soon as their parent has been
+        listed, results are merged to the file table in calling thread.
+        """
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            pending = {executor.submit(scan_directory, self.path, self.stat_files): self.path}
+            while pending:
+                done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    root = pending.pop(future)
+                    directories, files = future.result()
+                    self.add_directory(root, directories, files)
+                    for path in self.__walk_directories(directories):
+                        pending[executor.submit(scan_directory, path, self.stat_files)] = path
+
+    def add_directory(self, root, directories, files):
+        """Add scanned directory
+
+        Add results of scan_directory for root to the tree file table, caching
+        file and directory stat results for tracks and albums.
+        """
+        for path, stat in directories:
+            if stat is not None:
+                self.directory_stats[path] = stat
+
+        if files:
+            self.files.extend((root, os.path.basename(path)) for path, stat in files)
+            self.paths.update(files)
+            self.relative_dirs.add(self.relative_path(root))
+
+        elif not directories:
+            self.empty_dirs.append(root)
+
     def filter_tracks(self, regexp=None, re_path=True, re_file=True, as_tracks=False):
         if not len(self.files):
             self.load()
@@ -267,7 +344,8 @@ class Tree(IterableTrackFolder):
             ]
 
         if as_tracks:
-            return [Track(os.path.join(t[0], t[1])) for t in tracks]
+            paths = [os.path.join(t[0], t[1]) for t in tracks]
+            return [Track(path, stat=self.paths.get(path, None)) for path in paths]
         else:
             return tracks
 
@@ -292,7 +370,10 @@ class Tree(IterableTrackFolder):
     def as_albums(self):
         if not self.has_been_iterated:
             self.load()
-        return [Album(path) for path in sorted(set(d[0] for d in self.files)) if path not in (self.path, '')]
+        return [
+            Album(path, stat=self.directory_stats.get(path, None), file_stats=self.paths)
+            for path in sorted(set(d[0] for d in self.files)) if path not in (self.path, '')
+        ]
 
     def match(self, path):
         match_path = self.relative_path(path)
@@ -312,43 +393,59 @@ class Tree(IterableTrackFolder):
 
 class Album(IterableTrackFolder):
 
-    def __init__(self, path):
+    def __init__(self, path, stat=None, file_stats=None):
         super(Album, self).__init__(path, 'files')
         self.metadata_files = []
+        self.__stat = stat
+        self.__file_stats = file_stats is not None and file_stats or {}
 
     def __repr__(self):
         return 'album {0}'.format(self.path)
 
     def __getitem__(self, item):
         item = super(Album, self).__getitem__(item)
-        return Track(os.path.join(*item))
+        path = os.path.join(*item)
+        return Track(path, stat=self.paths.get(path, None))
 
     def load(self):
         super(Album, self).load()
 
         self.metadata_files = []
-        for name in os.listdir(self.path):
-            if match_codec(name) is not None:
-                self.files.append((self.path, name))
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if match_codec(entry.name) is not None:
+                    self.files.append((self.path, entry.name))
+                    self.paths[entry.path] = self.__file_stats.get(entry.path, None)
 
-            else:
-                metadata = match_metadata(name)
-                if metadata is not None:
-                    self.metadata_files.append(MetaDataFile(os.path.join(self.path, name), metadata))
+                else:
+                    metadata = match_metadata(entry.name)
+                    if metadata is not None:
+                        self.metadata_files.append(MetaDataFile(entry.path, metadata))
 
         self.files.sort()
 
+    @property
+    def stat(self):
+        """Album directory stat
+
+        Returns os.stat result for album directory, cached by tree walker or
+        on first lookup
+        """
+        if self.__stat is None:
+            self.__stat = os.stat(self.path)
+        return self.__stat
+
     @property
     def mtime(self):
-        return os.stat(self.path).st_mtime
+        return self.stat.st_mtime
 
     @property
     def ctime(self):
-        return os.stat(self.path).st_ctime
+        return self.stat.st_ctime
 
     @property
     def atime(self):
-        return os.stat(self.path).st_atime
+        return self.stat.st_atime
 
     @property
     def metadata(self):
@@ -369,7 +466,16 @@ class Album(IterableTrackFolder):
 
         return None
 
-    def copy_metadata(self, target):
+    def copy_metadata(self, target, threads=None):
+        """Copy metadata files to target album
+
+        Copies metadata files to target album directory and embeds album art
+        to tracks in target album. Tracks are tagged in a pool of threads,
+        read from configuration database 'threads' setting if not given.
+
+        Album art is embedded to all tracks even if some of them fail, and
+        TreeError listing the failed tracks is raised after that.
+        """
         if isinstance(target, str):
             target = Album(target)
 
@@ -396,19 +502,52 @@ class Album(IterableTrackFolder):
 
         target.load()
         albumart = target.albumart
-        if target.albumart:
-            for track in target:
-                tags = track.tags
-                if tags is None:
-                    continue
+        if albumart is None:
+            return
+
+        albumart.load_details()
 
-                if not tags.supports_albumart:
-                    self.log.debug('albumart not supported: {}'.format(track.path))
+        errors = []
+        with ThreadPoolExecutor(max_workers=ConfigDB().get_threads(threads)) as executor:
+            futures = [executor.submit(self.embed_albumart, track, albumart) for track in target]
+            for future in futures:
+                try:
+                    track = future.result()
+                except TreeError as e:
+                    self.log.debug('ERROR {}'.format(e))
+                    errors.append(str(e))
                     continue
 
-                if tags.set_albumart(albumart):
+                if track is not None:
                     self.log.debug('albumart: {}'.format(track))
-                    tags.save()
+
+        if errors:
+            raise TreeError('Error embedding albumart to {:d} tracks: {}'.format(len(errors), '; '.join(errors)))
+
+    def embed_albumart(self, track, albumart):
+        """Embed album art to track
+
+        Saves album art to track tags, unless tags already contain same image.
+        Returns the track if tags were modified, None otherwise.
+        """
+        tags = track.tags
+        if tags is None:
+            return None
+
+        if not tags.supports_albumart:
+            self.log.debug('albumart not supported: {}'.format(track.path))
+            return None
+
+        if tags.albumart is not None and tags.albumart.checksum == albumart.checksum:
+            return None
+
+        try:
+            tags.set_albumart(albumart)
+            tags.save()
+        except TagError as e:
+            raise TreeError('Error saving albumart to {}: {}'.format(track.path, e))
+
+        return track
 
 
 class MetaDataFile(object):
@@ -446,8 +585,8 @@ class Track(AudioFileFormat):
 
     """
 
-    def __init__(self, path):
-        super(Track, self).__init__(path)
+    def __init__(self, path, stat=None):
+        super(Track, self).__init__(path, stat=stat)
 
         self.prefixes = TreePrefixes()
         if self.codec is None:
@@ -497,18 +636,78 @@ class Track(AudioFileFormat):
 
     @property
     def checksum(self):
-        with open(self.path, 'rb') as fd:
-            m = hashlib.md5()
-            m.update(fd.read())
-            return m.hexdigest()
+        return self.get_checksum()
+
+    def get_checksum(self, algorithm=None, deep=False, cache=None):
+        """Calculate track checksum
+
+        Returns checksum string prefixed with algorithm name. Default algorithm
+        is soundforest.checksum.DEFAULT_CHECKSUM_ALGORITHM.
+
+        With cache database, checksums are looked up from the checksum cache
+        by file stat signature, and the file is only read if it was changed
+        after last checksum. With deep=True the file is always read and the
+        cached checksum replaced. New cached checksums are added to the cache
+        database session, and the caller must commit them.
+        """
+        return self.get_checksums(algorithm, deep=deep, cache=cache, audio=False)[0]
+
+    @property
+    def audio_checksum(self):
+        return self.get_checksums()[1]
+
+    def get_checksums(self, algorithm=None, deep=False, cache=None, audio=True):
+        """Calculate track and audio checksums
+
+        Returns (checksum, audio_checksum) tuple, calculated in one pass over
+        the file. Audio checksum does not change when the track is retagged.
+        Audio checksum is None if audio is False. Checksums are cached like in
+        get_checksum.
+        """
+        if algorithm is None:
+            algorithm = DEFAULT_CHECKSUM_ALGORITHM
+
+        if cache is not None and not deep:
+            stat = self.stat
+            checksum = cache.get_cached_checksum(stat, algorithm)
+            audio_checksum = audio and cache.get_cached_checksum(stat, audio_cache_key(algorithm)) or None
+            if checksum is not None and (audio_checksum is not None or not audio):
+                return checksum, audio_checksum
+
+        try:
+            stat, checksum, audio_checksum = read_checksums(self.path, algorithm, audio=audio)
+        except ChecksumError as e:
+            raise TreeError(e)
+
+        if cache is not None:
+            cache.cache_checksum(self.path, stat, algorithm, checksum, commit=False)
+            if audio:
+                cache.cache_checksum(self.path, stat, audio_cache_key(algorithm), audio_checksum, commit=False)
+
+        return checksum, audio_checksum
+
+    def match_checksum(self, checksum):
+        """Verify track checksum
+
+        Returns True if track matches checksum string, calculated with the
+        algorithm of given checksum.
+        """
+        try:
+            algorithm, digest = parse_checksum(checksum)
+        except ChecksumError as e:
+            raise TreeError(e)
+
+        if algorithm is None:
+            return False
+
+        return parse_checksum(self.get_checksum(algorithm))[1] == digest
 
     def get_album_tracks(self):
         path = os.path.dirname(self.path)
-        extensions = DEFAULT_CODECS[self.codec]['extensions']
         tracks = []
 
         for t in os.listdir(path):
-            if os.path.splitext(t)[1][1:] not in extensions:
+            if match_codec(t) is not self.codec:
                 continue
             tracks.append(Track(os.path.join(path, t)))
 
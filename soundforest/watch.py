@@ -0,0 +1,437 @@
+# coding=utf-8
+"""Tree watcher
+
+Keep the database in sync with changes in audio file trees. Changes are
+detected with Linux inotify, or by polling directory mtimes on other
+platforms, and only modified directories are updated in the database.
+
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from soundforest import SoundforestError
+from soundforest.database import ConfigDB
+from soundforest.log import SoundforestLogger
+from soundforest.tree import Tree, IGNORED_TREE_FOLDER_NAMES
+
+# Seconds without new events in a directory before it is updated
+DEFAULT_WATCH_DELAY = 2.0
+
+# Seconds between directory mtime checks with polling watcher
+DEFAULT_POLL_INTERVAL = 10.0
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+INOTIFY_WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+    IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+INOTIFY_EVENT = struct.Struct('iIII')
+INOTIFY_READ_SIZE = 65536
+
+
+class WatchError(Exception):
+    pass
+
+
+def watched_directories(path):
+    """Watched directories
+
+    Return directories in tree to watch, skipping symlinked and ignored
+    directories like tree walking does
+    """
+    directories = []
+    pending = [path]
+    while pending:
+        directory = pending.pop()
+        directories.append(directory)
+        try:
+            with os.scandir(directory) as iterator:
+                entries = list(iterator)
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+            except OSError:
+                continue
+            if entry.name not in IGNORED_TREE_FOLDER_NAMES:
+                pending.append(entry.path)
+    return directories
+
+
+def strip_separators(path):
+    """Strip trailing separators
+
+    Return path without trailing path separators, for comparing tree paths
+    """
+    return path.rstrip(os.sep) or os.sep
+
+
+class InotifyMonitor(object):
+    """InotifyMonitor
+
+    Detect changes in directories with Linux inotify, using libc with ctypes.
+    Each directory in watched trees gets an inotify watch. Changes are
+    returned as (path, recursive) tuples: events for files in a directory
+    return the directory, and events for subdirectories return the
+    subdirectory with recursive flag.
+    """
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise WatchError('inotify is only available on linux')
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise WatchError('Error initializing inotify: {}'.format(os.strerror(ctypes.get_errno())))
+
+        self.watches = {}
+        self.paths = {}
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def add(self, path):
+        """Watch directory tree
+
+        Add watches for path and all subdirectories
+        """
+        for directory in watched_directories(path):
+            if directory in self.paths:
+                continue
+
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), INOTIFY_WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOSPC:
+                    raise WatchError('inotify watch limit reached, increase fs.inotify.max_user_watches')
+                if error in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                    continue
+                raise WatchError('Error watching {}: {}'.format(directory, os.strerror(error)))
+
+            self.watches[wd] = directory
+            self.paths[directory] = wd
+
+    def remove(self, path):
+        """Stop watching directory tree
+
+        Remove watches for path and all subdirectories
+        """
+        prefix = path.rstrip(os.sep) + os.sep
+        for directory in [d for d in self.paths if d == path or d.startswith(prefix)]:
+            wd = self.paths.pop(directory)
+            del self.watches[wd]
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        """Read changes
+
+        Wait for inotify events for at most timeout seconds. Returns list of
+        changed (path, recursive) tuples, or None if the event queue overflowed
+        and changes were lost.
+        """
+        readable, writable, exceptional = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        changes = []
+        overflow = False
+        while True:
+            try:
+                data = os.read(self.fd, INOTIFY_READ_SIZE)
+            except BlockingIOError:
+                break
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+
+                directory = self.watches.get(wd, None)
+                if directory is None:
+                    continue
+
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    if self.paths.get(directory, None) == wd:
+                        del self.paths[directory]
+                    continue
+
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    changes.append((directory, True))
+                    continue
+
+                path = os.path.join(directory, name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_MOVED_FROM | IN_DELETE):
+                        self.remove(path)
+                    elif mask & (IN_CREATE | IN_MOVED_TO):
+                        self.add(path)
+                    changes.append((path, True))
+                else:
+                    changes.append((directory, False))
+
+        if overflow:
+            return None
+        return changes
+
+
+class PollingMonitor(object):
+    """PollingMonitor
+
+    Detect changes in directories by comparing directory mtimes every
+    interval seconds. Directory mtime changes when files are added, removed
+    or renamed, but not when file contents are modified in place.
+    """
+
+    def __init__(self, interval=DEFAULT_POLL_INTERVAL):
+        self.interval = interval
+        self.mtimes = {}
+        self.checked = None
+
+    def close(self):
+        pass
+
+    def __mtime(self, path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def add(self, path):
+        for directory in watched_directories(path):
+            self.mtimes[directory] = self.__mtime(directory)
+
+    def remove(self, path):
+        prefix = path.rstrip(os.sep) + os.sep
+        for directory in [d for d in self.mtimes if d == path or d.startswith(prefix)]:
+            del self.mtimes[directory]
+
+    def read(self, timeout):
+        """Read changes
+
+        Check directory mtimes if interval has passed since previous check,
+        otherwise sleep for at most timeout seconds. Returns list of changed
+        (path, recursive) tuples.
+        """
+        now = time.time()
+        if self.checked is not None and now - self.checked < self.interval:
+            time.sleep(min(timeout, self.interval - (now - self.checked)))
+            return []
+        self.checked = now
+
+        changes = []
+        for directory, mtime in list(self.mtimes.items()):
+            if directory not in self.mtimes:
+                continue
+
+            current = self.__mtime(directory)
+            if current == mtime:
+                continue
+
+            if current is None:
+                self.remove(directory)
+                changes.append((directory, True))
+                continue
+
+            self.mtimes[directory] = current
+            changes.append((directory, False))
+            for path in watched_directories(directory)[1:]:
+                if path not in self.mtimes:
+                    self.add(path)
+                    changes.append((path, True))
+
+        return changes
+
+
+class TreeWatcher(object):
+    """TreeWatcher
+
+    Watch trees registered in database and update changed directories in
+    database. Changes in a directory are coalesced until there have been no
+    new changes for delay seconds, and then all pending directories of a tree
+    are updated with ConfigDB.update_directories.
+
+    Trees are watched with inotify when available, or by polling directory
+    mtimes if polling is True or inotify can't be used.
+    """
+
+    def __init__(self, paths=None, delay=DEFAULT_WATCH_DELAY, interval=DEFAULT_POLL_INTERVAL, polling=False,
+                 update_checksum=False, processes=None):
+        self.log = SoundforestLogger().default_stream
+        self.db = ConfigDB()
+        self.delay = delay
+        self.interval = interval
+        self.update_checksum = update_checksum
+        self.processes = processes
+
+        if paths is not None:
+            paths = set(strip_separators(path) for path in paths)
+
+        self.trees = sorted(
+            (tree.path for tree in self.db.trees if paths is None or strip_separators(tree.path) in paths),
+            key=len,
+            reverse=True,
+        )
+        if not self.trees:
+            raise WatchError('No trees to watch')
+
+        self.monitor = None
+        if not polling:
+            try:
+                self.monitor = InotifyMonitor()
+            except WatchError as e:
+                self.log.debug('Using polling watcher: {}'.format(e))
+        if self.monitor is None:
+            self.monitor = PollingMonitor(interval)
+
+        self.pending = {}
+
+    def __repr__(self):
+        return '{} {}'.format(self.monitor.__class__.__name__, ' '.join(self.trees))
+
+    def start(self):
+        """Start watching trees
+
+        Adds watches for trees and updates the trees incrementally, to pick
+        up changes made while not watching
+        """
+        for path in self.trees:
+            try:
+                self.monitor.add(path)
+            except WatchError as e:
+                self.log.debug('Using polling watcher: {}'.format(e))
+                self.monitor.close()
+                self.monitor = PollingMonitor(self.interval)
+                return self.start()
+
+        self.update_trees()
+
+    def update_trees(self):
+        """Update trees
+
+        Update all watched trees incrementally
+        """
+        for path in self.trees:
+            self.db.update_tree(
+                Tree(path, stat_files=False),
+                update_checksum=self.update_checksum,
+                incremental=True,
+                processes=self.processes,
+            )
+
+    def tree_path(self, path):
+        """Return tree of path
+
+        Return path of the innermost watched tree containing path, or None
+        """
+        for tree in self.trees:
+            if path == tree or path.startswith(tree.rstrip(os.sep) + os.sep):
+                return tree
+        return None
+
+    def add_changes(self, changes):
+        """Add changed directories
+
+        Changed directories are queued with time of latest change. Recursive
+        flag of same directory is kept if any change was recursive.
+        """
+        now = time.time()
+        for path, recursive in changes:
+            previous = self.pending.get(path, None)
+            if previous is not None:
+                recursive = recursive or previous[0]
+            self.pending[path] = (recursive, now)
+
+    def update(self, force=False):
+        """Update changed directories
+
+        Update directories without changes for self.delay seconds in
+        database, grouped by tree. Directories are left pending on database
+        errors, to be retried after self.delay seconds. Returns number of
+        successfully updated directories.
+        """
+        now = time.time()
+        trees = {}
+        for path, (recursive, changed) in list(self.pending.items()):
+            if not force and now - changed < self.delay:
+                continue
+            del self.pending[path]
+
+            tree = self.tree_path(path)
+            if tree is not None:
+                trees.setdefault(tree, []).append((path, recursive))
+
+        count = 0
+        for tree, directories in trees.items():
+            self.log.debug('{} update {}'.format(tree, ' '.join(path for path, recursive in directories)))
+            try:
+                self.db.update_directories(
+                    Tree(tree),
+                    directories,
+                    update_checksum=self.update_checksum,
+                    processes=self.processes,
+                )
+            except SQLAlchemyError as e:
+                self.db.rollback()
+                self.log.debug('{} error updating directories, retrying: {}'.format(tree, e))
+                self.add_changes(directories)
+                continue
+            except (SoundforestError, OSError) as e:
+                self.db.rollback()
+                self.log.debug('{} error updating directories: {}'.format(tree, e))
+                continue
+            count += len(directories)
+
+        return count
+
+    def run(self):
+        """Watch trees until interrupted
+
+        """
+        self.start()
+        try:
+            while True:
+                changes = self.monitor.read(self.delay)
+                if changes is None:
+                    self.log.debug('Change events lost, updating trees')
+                    self.pending = {}
+                    self.update_trees()
+                    continue
+
+                self.add_changes(changes)
+                self.update()
+        finally:
+            self.monitor.close()
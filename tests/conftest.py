@@ -0,0 +1,67 @@
+# coding=utf-8
+"""Test configuration
+
+Tests run with a temporary home directory, so soundforest modules imported
+by tests don't use the configuration database of the user. Trees of tagged
+FLAC tracks are created with the create_tree fixture.
+"""
+
+import atexit
+import importlib.util
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+HOME = tempfile.mkdtemp(prefix='soundforest-tests-')
+
+os.environ['HOME'] = HOME
+sys.path.insert(0, ROOT)
+atexit.register(shutil.rmtree, HOME, True)
+
+# FLAC STREAMINFO for 44.1 kHz stereo 16 bit stream with unknown length
+FLAC_STREAMINFO = struct.pack('>HH', 4096, 4096) + b'\x00' * 6 + \
+    ((44100 << 44) | (1 << 41) | (15 << 36)).to_bytes(8, 'big') + b'\x00' * 16
+
+
+def import_benchmark(name):
+    """Import benchmark script from benchmarks directory"""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, 'benchmarks', '{}.py'.format(name)))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def create_flac_tree(path, albums, tracks):
+    """Create tree
+
+    Create albums directories 'Artist N/Album N' with tracks tagged FLAC files
+    named 'NN Track N.flac' each
+    """
+    from mutagen.flac import FLAC
+
+    for album in range(albums):
+        directory = os.path.join(path, 'Artist {:d}'.format(album), 'Album {:d}'.format(album))
+        os.makedirs(directory)
+        for track in range(tracks):
+            filename = os.path.join(directory, '{:02d} Track {:d}.flac'.format(track + 1, track + 1))
+            with open(filename, 'wb') as fd:
+                fd.write(b'fLaC\x80' + len(FLAC_STREAMINFO).to_bytes(3, 'big') + FLAC_STREAMINFO)
+                fd.write(os.urandom(4096))
+
+            tags = FLAC(filename)
+            tags['artist'] = 'Artist {:d}'.format(album)
+            tags['album'] = 'Album {:d}'.format(album)
+            tags['title'] = 'Track {:d}'.format(track + 1)
+            tags['tracknumber'] = '{:d}'.format(track + 1)
+            tags.save()
+
+
+@pytest.fixture
+def create_tree():
+    """Function creating trees of tagged FLAC tracks"""
+    return create_flac_tree
@@ -0,0 +1,242 @@
+# coding=utf-8
+"""Album art tests
+
+Album art image details from image headers, content addressed album art
+store, thumbnail cache and embedding album art to tracks
+"""
+
+import os
+import shutil
+
+from io import BytesIO
+
+import pytest
+
+from mutagen.flac import FLAC, Picture
+from PIL import Image, ImageFile
+
+from soundforest import models, TreeError
+from soundforest.database import ConfigDB
+from soundforest.tags.albumart import AlbumArt, AlbumArtError, AlbumArtStore, AlbumArtThumbnails
+from soundforest.tags.formats.flac import FLACAlbumart
+from soundforest.tags.tagparser import Tags
+from soundforest.tree import Album, Tree
+
+
+def image_data(fileformat='PNG', size=(40, 30), color=(255, 0, 0)):
+    fd = BytesIO()
+    Image.new('RGB', size, color).save(fd, fileformat)
+    return fd.getvalue()
+
+
+def count_image_loads(monkeypatch):
+    """Record images decoded by PIL"""
+    loads = []
+    load = ImageFile.ImageFile.load
+
+    def counting_load(image):
+        loads.append(image)
+        return load(image)
+
+    monkeypatch.setattr(ImageFile.ImageFile, 'load', counting_load)
+    return loads
+
+
+def test_albumart_details_are_read_without_decoding_image(monkeypatch):
+    loads = count_image_loads(monkeypatch)
+    data = image_data('PNG')
+
+    albumart = AlbumArt()
+    albumart.import_data(data)
+    assert albumart.get_info() == {
+        'type': 3,
+        'mime': 'image/png',
+        'format': 'PNG',
+        'bytes': len(data),
+        'width': 40,
+        'height': 30,
+    }
+    assert albumart.checksum
+    assert loads == []
+
+    assert albumart.colors() == 1
+    assert loads
+
+
+def test_albumart_size_and_colors_are_read_from_header(monkeypatch):
+    loads = count_image_loads(monkeypatch)
+    data = image_data('JPEG', size=(64, 48))
+
+    albumart = AlbumArt()
+    albumart.import_data(data)
+    assert len(albumart) == len(data)
+    assert repr(albumart) == 'image/jpeg {:d} bytes 64x48'.format(len(data))
+    assert albumart.size == (64, 48)
+    assert loads == []
+
+    gradient = Image.new('RGB', (64, 48))
+    gradient.putdata([(x * 4, y * 5, 0) for y in range(48) for x in range(64)])
+    fd = BytesIO()
+    gradient.save(fd, 'PNG')
+    albumart = AlbumArt()
+    albumart.import_data(fd.getvalue())
+    assert albumart.colors(max_colors=16) is None
+    assert albumart.colors(max_colors=64 * 48) == 64 * 48
+    assert albumart.get_info(colors=16)['colors'] is None
+    assert albumart.get_info(colors=True)['colors'] is None
+    assert 'colors' not in albumart.get_info()
+
+
+def test_flac_albumart_is_read_without_decoding_image(tmpdir, monkeypatch, create_tree):
+    create_tree(str(tmpdir), albums=1, tracks=1)
+    path = str(tmpdir.join('Artist 0', 'Album 0', '01 Track 1.flac'))
+    picture = Picture()
+    picture.mime = 'image/jpeg'
+    picture.data = image_data('JPEG', size=(120, 80))
+    tags = FLAC(path)
+    tags.add_picture(picture)
+    tags.save()
+
+    loads = count_image_loads(monkeypatch)
+    albumart = FLACAlbumart(Tags(path)).albumart
+    assert (albumart.mimetype, albumart.size, len(albumart)) == ('image/jpeg', (120, 80), len(picture.data))
+    assert albumart.dump() == picture.data
+    assert loads == []
+
+
+def test_albumart_store_saves_identical_images_once(tmpdir):
+    store = AlbumArtStore(str(tmpdir.join('store')))
+    albumart = AlbumArt()
+    albumart.import_data(image_data('JPEG'))
+    copy = AlbumArt()
+    copy.import_data(image_data('JPEG'))
+    other = AlbumArt()
+    other.import_data(image_data('JPEG', color=(0, 0, 255)))
+
+    checksum = store.store(albumart)
+    assert checksum == albumart.checksum
+    assert store.image_path(checksum) == os.path.join(store.path, checksum[:2], checksum)
+    assert checksum in store
+
+    mtime = os.stat(store.image_path(checksum)).st_mtime_ns
+    assert store.store(copy) == checksum
+    assert os.stat(store.image_path(checksum)).st_mtime_ns == mtime
+    assert store.store(other) != checksum
+    assert sorted(os.listdir(os.path.join(store.path, checksum[:2]))) == [checksum]
+
+    loaded = store.load(checksum)
+    assert loaded.dump() == albumart.dump()
+    assert loaded.checksum == checksum
+    with pytest.raises(AlbumArtError):
+        store.load(other.checksum[::-1])
+
+
+def test_albums_with_identical_artwork_reference_one_image(tmpdir, create_tree):
+    path = str(tmpdir.mkdir('tree'))
+    create_tree(path, albums=3, tracks=1)
+    for artist in os.listdir(path):
+        for album in os.listdir(os.path.join(path, artist)):
+            with open(os.path.join(path, artist, album, 'artwork.jpg'), 'wb') as fd:
+                fd.write(image_data('JPEG', size=(20, 20)))
+
+    db = ConfigDB()
+    db.add_tree(path)
+    db.update_tree(Tree(path))
+
+    albums = db.get_tree(path).albums
+    assert len(albums) == 3
+    checksums = set(album.albumart_checksum for album in albums)
+    assert len(checksums) == 1
+    checksum = checksums.pop()
+    assert checksum in AlbumArtStore()
+
+    albumart = db.get_albumart(checksum)
+    assert (albumart.mimetype, albumart.width, albumart.height) == ('image/jpeg', 20, 20)
+    assert len([a for a in db.query(models.AlbumArtModel) if a.checksum == checksum]) == 1
+
+
+def test_thumbnails_are_generated_in_configured_sizes(tmpdir):
+    thumbnails = AlbumArtThumbnails(str(tmpdir), sizes=(16, 64))
+    albumart = AlbumArt()
+    albumart.import_data(image_data('PNG', size=(200, 100)))
+
+    paths = thumbnails.generate(albumart)
+    assert sorted(paths) == [16, 64]
+    for size, path in paths.items():
+        assert path == thumbnails.thumbnail_path(albumart.checksum, size)
+        image = Image.open(path)
+        assert (image.format, image.size) == ('JPEG', (size, size // 2))
+
+    with pytest.raises(AlbumArtError):
+        thumbnails.get(albumart, 32)
+
+
+def test_thumbnail_is_regenerated_when_source_is_newer(tmpdir):
+    thumbnails = AlbumArtThumbnails(str(tmpdir), sizes=(16, ))
+    albumart = AlbumArt()
+    albumart.import_data(image_data('PNG'))
+    path = thumbnails.get(albumart, 16)
+    os.utime(path, (1000, 1000))
+
+    assert thumbnails.get(albumart, 16, mtime=500) == path
+    assert os.stat(path).st_mtime == 1000
+    assert os.stat(path).st_atime > 1000
+
+    assert thumbnails.get(albumart, 16, mtime=2000) == path
+    assert os.stat(path).st_mtime > 2000
+
+
+def test_thumbnail_eviction_removes_least_recently_used(tmpdir):
+    thumbnails = AlbumArtThumbnails(str(tmpdir), sizes=(16, ), max_bytes=None)
+    paths = []
+    for index in range(10):
+        albumart = AlbumArt()
+        albumart.import_data(image_data('PNG', color=(index * 20, 0, 0)))
+        path = thumbnails.get(albumart, 16)
+        os.utime(path, (1000 + index, 1000))
+        paths.append(path)
+
+    sizes = [os.stat(path).st_size for path in paths]
+    max_bytes = sum(sizes) - 1
+    removed = thumbnails.evict(max_bytes)
+    kept = [path for path in paths if os.path.isfile(path)]
+
+    assert kept == paths[removed:]
+    assert thumbnails.total_bytes == sum(sizes[removed:])
+    assert thumbnails.total_bytes <= max_bytes * 0.9
+    assert sum(sizes[removed - 1:]) > max_bytes * 0.9
+
+    thumbnails.max_bytes = thumbnails.total_bytes
+    albumart = AlbumArt()
+    albumart.import_data(image_data('PNG', color=(0, 0, 255)))
+    path = thumbnails.get(albumart, 16)
+    assert os.path.isfile(path)
+    assert not os.path.isfile(kept[0])
+    assert thumbnails.total_bytes <= thumbnails.max_bytes * 0.9
+
+
+def test_copy_metadata_embeds_albumart_to_all_tracks_despite_errors(tmpdir, monkeypatch, create_tree):
+    create_tree(str(tmpdir.join('src')), albums=1, tracks=3)
+    src = str(tmpdir.join('src', 'Artist 0', 'Album 0'))
+    dst = str(tmpdir.mkdir('dst'))
+    with open(os.path.join(src, 'artwork.jpg'), 'wb') as fd:
+        fd.write(image_data('JPEG'))
+    for filename in os.listdir(src):
+        if filename.endswith('.flac'):
+            shutil.copyfile(os.path.join(src, filename), os.path.join(dst, filename))
+
+    embedded = []
+
+    def embed_albumart(album, track, albumart):
+        if track.filename == '02 Track 2.flac':
+            raise TreeError('Error saving albumart to {}'.format(track.path))
+        embedded.append(track.filename)
+        return track
+
+    monkeypatch.setattr(Album, 'embed_albumart', embed_albumart)
+    with pytest.raises(TreeError) as e:
+        Album(src).copy_metadata(dst, threads=2)
+
+    assert '02 Track 2.flac' in str(e.value)
+    assert sorted(embedded) == ['01 Track 1.flac', '03 Track 3.flac']
+    assert os.path.isfile(os.path.join(dst, 'artwork.jpg'))
@@ -0,0 +1,293 @@
+# coding=utf-8
+"""Checksum tests
+
+Chunked file checksums, checksum string comparison, checksum cache and
+audio payload checksums of generated FLAC, MP3, MP4 and Ogg files
+"""
+
+import hashlib
+import os
+import random
+import struct
+import subprocess
+import sys
+
+from conftest import FLAC_STREAMINFO
+from mutagen.flac import FLAC, Picture
+from mutagen.ogg import OggPage
+
+from soundforest import checksum as checksum_module, models, tree as tree_module
+from soundforest.database import ConfigDB
+from soundforest.tree import Tree, Track
+from soundforest.checksum import APEV2_FOOTER, CHECKSUM_ALGORITHMS, audio_checksum, checksums_equal, \
+    file_checksum, file_checksums, match_checksum
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+AUDIO = bytes(random.Random('audio').getrandbits(8) for _ in range(5000))
+AUDIO_CHECKSUM = 'md5:{}'.format(hashlib.md5(AUDIO).hexdigest())
+
+AUDIO_PACKETS = [bytes(random.Random(index).getrandbits(8) for _ in range(300)) for index in range(40)]
+
+
+def test_file_checksum_reads_file_in_chunks(tmpdir):
+    path = str(tmpdir.join('track.bin'))
+    data = os.urandom(10000)
+    with open(path, 'wb') as fd:
+        fd.write(data)
+
+    for algorithm in CHECKSUM_ALGORITHMS:
+        expected = '{}:{}'.format(algorithm, hashlib.new(algorithm, data).hexdigest())
+        for chunk_size in (1, 333, 4096, 20000):
+            assert file_checksum(path, algorithm, chunk_size=chunk_size) == expected
+        assert file_checksums(path, algorithm, chunk_size=333) == (expected, expected)
+
+
+def test_legacy_checksums_compare_as_md5(tmpdir):
+    path = str(tmpdir.join('track.bin'))
+    with open(path, 'wb') as fd:
+        fd.write(b'soundforest')
+    digest = hashlib.md5(b'soundforest').hexdigest()
+
+    assert checksums_equal(digest, 'md5:{}'.format(digest))
+    assert not checksums_equal(digest, 'sha1:{}'.format(digest))
+    assert not checksums_equal('unknown:{}'.format(digest), 'unknown:{}'.format(digest))
+    assert match_checksum(path, digest)
+    assert match_checksum(path, file_checksum(path, 'sha256'))
+    assert not match_checksum(path, 'sha1:{}'.format(digest))
+
+
+def rewrite_keeping_stat(path, data):
+    """Replace file contents in place without changing size or mtime"""
+    stat = os.stat(path)
+    with open(path, 'r+b') as fd:
+        fd.write(data)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+
+def test_checksum_cache_is_keyed_by_file_stat(tmpdir, monkeypatch):
+    path = str(tmpdir.join('track.flac'))
+    with open(path, 'wb') as fd:
+        fd.write(b'soundforest')
+
+    reads = []
+
+    def read_checksums(path, *args, **kwargs):
+        reads.append(path)
+        return checksum_module.read_checksums(path, *args, **kwargs)
+
+    monkeypatch.setattr(tree_module, 'read_checksums', read_checksums)
+    db = ConfigDB()
+    track = Track(path)
+
+    checksum = track.get_checksums(cache=db)
+    assert track.get_checksums(cache=db) == checksum
+    assert len(reads) == 1
+
+    rewrite_keeping_stat(path, b'SOUNDFOREST')
+    assert Track(path).get_checksums(cache=db) == checksum
+    assert Track(path).get_checksums(cache=db, deep=True) != checksum
+    assert len(reads) == 2
+
+    os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 1000))
+    assert Track(path).get_checksums(cache=db) != checksum
+    assert len(reads) == 3
+
+    replaced = str(tmpdir.join('replaced.flac'))
+    with open(replaced, 'wb') as fd:
+        fd.write(b'Soundforest')
+    stat = os.stat(path)
+    os.utime(replaced, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.rename(replaced, path)
+    assert Track(path).get_checksums(cache=db)[0] == file_checksum(path)
+    assert len(reads) == 4
+    db.commit()
+
+
+def test_checksum_cache_rows_are_removed_with_tracks(tmpdir, create_tree):
+    path = str(tmpdir.mkdir('tree'))
+    create_tree(path, albums=1, tracks=2)
+
+    db = ConfigDB()
+    db.add_tree(path)
+    db.update_tree(Tree(path), update_checksum=True)
+    db_tracks = db.get_tree(path).tracks
+    paths = [db_track.path for db_track in db_tracks]
+
+    def cached(path):
+        return db.query(models.ChecksumCacheModel).filter(models.ChecksumCacheModel.path == path).count()
+
+    assert [cached(path) for path in paths] == [2, 2]
+    db.delete_tracks([db_tracks[0].id])
+    assert [cached(path) for path in paths] == [0, 2]
+
+
+def test_checksum_command_deep_ignores_cached_checksums(tmpdir, create_tree):
+    path = str(tmpdir.mkdir('tree'))
+    create_tree(path, albums=1, tracks=1)
+    track = [os.path.join(root, filename) for root, directories, files in os.walk(path) for filename in files][0]
+
+    env = dict(os.environ)
+    env['HOME'] = str(tmpdir.mkdir('home'))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, (ROOT, env.get('PYTHONPATH', None))))
+
+    def soundforest(*args):
+        command = [sys.executable, os.path.join(ROOT, 'bin', 'soundforest')] + list(args)
+        return subprocess.check_output(command, env=env).decode('utf-8').strip().split(None, 1)
+
+    soundforest('tree', 'add', path)
+    soundforest('tree', 'update', path)
+    soundforest('checksum', 'update', path)
+    assert soundforest('checksum', 'verify', path) == ['OK', track]
+
+    with open(track, 'rb') as fd:
+        data = fd.read()
+    rewrite_keeping_stat(track, data[:-1] + bytes([data[-1] ^ 0xff]))
+    assert soundforest('checksum', 'verify', path) == ['OK', track]
+    assert soundforest('checksum', '--deep', 'verify', path) == ['NOK', track]
+
+
+def ogg_pages(serial, packets, sequence, position=None):
+    """Ogg pages for packets
+
+    Pages without packet ending have granule position -1, like pages of
+    packets continued on next page. Other pages get position, if given.
+    """
+    pages = OggPage.from_packets(packets, sequence=sequence, default_size=4096, wiggle_room=0)
+    for page in pages:
+        page.serial = serial
+        if not page.complete and len(page.packets) == 1:
+            page.position = -1
+        elif position is not None:
+            position += 1024
+            page.position = position
+    return pages
+
+
+def write_ogg(path, headers, comment, audio=AUDIO_PACKETS):
+    """Write Ogg stream
+
+    Header packets are written as in Vorbis and Opus streams: first packet on
+    its own page, comment and other header packets ending on a page before
+    audio packets.
+    """
+    pages = ogg_pages(1, headers[:1], 0)
+    pages[0].first = True
+    pages += ogg_pages(1, [comment] + headers[1:], len(pages))
+    pages += ogg_pages(1, audio, len(pages), position=0)
+    pages[-1].last = True
+
+    with open(path, 'wb') as fd:
+        for page in pages:
+            fd.write(page.write())
+
+
+def comment_packet(magic, size):
+    return magic + bytes(random.Random(size).getrandbits(8) for _ in range(size))
+
+
+def test_vorbis_audio_checksum_ignores_comment_pages(tmpdir):
+    headers = [b'\x01vorbis' + bytes(23), b'\x05vorbis' + bytes(100)]
+    paths = [str(tmpdir.join('{:d}.ogg'.format(index))) for index in range(3)]
+
+    write_ogg(paths[0], headers, comment_packet(b'\x03vorbis', 100))
+    write_ogg(paths[1], headers, comment_packet(b'\x03vorbis', 20000))
+    write_ogg(paths[2], headers, comment_packet(b'\x03vorbis', 100), audio=AUDIO_PACKETS[1:])
+
+    checksums = [file_checksums(path) for path in paths]
+    assert checksums[0][0] != checksums[1][0]
+    assert checksums[0][1] == checksums[1][1]
+    assert checksums[0][1] != checksums[2][1]
+
+
+def test_opus_audio_checksum_ignores_comment_pages(tmpdir):
+    headers = [b'OpusHead' + bytes(11)]
+    paths = [str(tmpdir.join('{:d}.opus'.format(index))) for index in range(2)]
+
+    write_ogg(paths[0], headers, comment_packet(b'OpusTags', 10))
+    write_ogg(paths[1], headers, comment_packet(b'OpusTags', 30000))
+
+    checksums = [file_checksums(path) for path in paths]
+    assert checksums[0][0] != checksums[1][0]
+    assert checksums[0][1] == checksums[1][1]
+
+
+def write_file(path, *parts):
+    with open(path, 'wb') as fd:
+        for part in parts:
+            fd.write(part)
+    return path
+
+
+def id3v2(size, footer=False):
+    """ID3v2.4 tag with size bytes of frame data"""
+    flags = footer and 0x10 or 0
+    header = bytes([4, 0, flags]) + bytes((size >> (7 * (3 - i))) & 0x7f for i in range(4))
+    return b'ID3' + header + bytes(size) + (footer and b'3DI' + header or b'')
+
+
+def apev2(size):
+    """APEv2 tag with header and size bytes of items"""
+    header = APEV2_FOOTER.pack(b'APETAGEX', 2000, size + APEV2_FOOTER.size, 1, 0xa0000000, bytes(8))
+    footer = APEV2_FOOTER.pack(b'APETAGEX', 2000, size + APEV2_FOOTER.size, 1, 0x80000000, bytes(8))
+    return header + bytes(size) + footer
+
+
+def id3v1(title):
+    return b'TAG' + title.ljust(125, b'\0')
+
+
+def mp4_atom(name, body, extended=False):
+    if extended:
+        return struct.pack('>I4sQ', 1, name, 16 + len(body)) + body
+    return struct.pack('>I4s', 8 + len(body), name) + body
+
+
+def test_flac_audio_checksum_ignores_tags_and_pictures(tmpdir):
+    paths = []
+    for index, (title, picture) in enumerate(((b'Title', 0), (b'Longer title ' * 100, 20000))):
+        path = write_file(
+            str(tmpdir.join('{:d}.flac'.format(index))),
+            b'fLaC\x80' + len(FLAC_STREAMINFO).to_bytes(3, 'big'),
+            FLAC_STREAMINFO,
+            AUDIO,
+        )
+        tags = FLAC(path)
+        tags['title'] = title.decode('utf-8')
+        if picture:
+            image = Picture()
+            image.data = bytes(picture)
+            tags.add_picture(image)
+        tags.save()
+        paths.append(path)
+
+    checksums = [file_checksums(path) for path in paths]
+    assert checksums[0][0] != checksums[1][0]
+    assert [audio for checksum, audio in checksums] == [AUDIO_CHECKSUM, AUDIO_CHECKSUM]
+
+
+def test_mp3_audio_checksum_ignores_id3_and_ape_tags(tmpdir):
+    variants = (
+        (AUDIO, ),
+        (id3v2(100), AUDIO),
+        (id3v2(3000, footer=True), AUDIO, apev2(200), id3v1(b'Title')),
+        (AUDIO, id3v1(b'Other title'), apev2(50)),
+        (id3v2(10), AUDIO, apev2(1000)),
+    )
+    paths = [write_file(str(tmpdir.join('{:d}.mp3'.format(index))), *parts) for index, parts in enumerate(variants)]
+
+    assert len(set(file_checksum(path) for path in paths)) == len(paths)
+    assert [audio_checksum(path) for path in paths] == [AUDIO_CHECKSUM] * len(paths)
+
+
+def test_mp4_audio_checksum_reads_mdat_atoms(tmpdir):
+    ftyp = mp4_atom(b'ftyp', b'M4A ' + bytes(4) + b'M4A mp42')
+    variants = (
+        (ftyp, mp4_atom(b'moov', mp4_atom(b'udta', bytes(100))), mp4_atom(b'mdat', AUDIO)),
+        (ftyp, mp4_atom(b'mdat', AUDIO), mp4_atom(b'moov', mp4_atom(b'udta', bytes(9000))), mp4_atom(b'free', b'')),
+        (ftyp, mp4_atom(b'moov', b''), mp4_atom(b'mdat', AUDIO, extended=True)),
+    )
+    paths = [write_file(str(tmpdir.join('{:d}.m4a'.format(index))), *parts) for index, parts in enumerate(variants)]
+
+    assert len(set(file_checksum(path) for path in paths)) == len(paths)
+    assert [audio_checksum(path) for path in paths] == [AUDIO_CHECKSUM] * len(paths)
@@ -0,0 +1,49 @@
+# coding=utf-8
+"""Command path cache tests
+
+Looked up commands are saved once per batch, and only the shared command
+cache is saved at exit
+"""
+
+import atexit
+import json
+import os
+
+from soundforest import CommandPathCache
+
+
+def test_command_path_cache_saves_on_flush(tmpdir):
+    path = str(tmpdir.join('commands.json'))
+
+    cache = CommandPathCache(path)
+    cache.which('sh')
+    cache.which('soundforest-missing-command')
+    assert not os.path.exists(path)
+
+    cache.flush()
+    with open(path, 'r') as fd:
+        assert sorted(json.load(fd)['commands']) == ['sh', 'soundforest-missing-command']
+
+    mtime = os.stat(path).st_mtime_ns
+    cache.which('sh')
+    cache.flush()
+    assert os.stat(path).st_mtime_ns == mtime
+
+    cached = CommandPathCache(path)
+    assert cached.which('sh') == cache.which('sh')
+    assert not cached.modified
+
+
+def test_only_shared_command_path_cache_is_flushed_at_exit(tmpdir, monkeypatch):
+    registered = []
+    monkeypatch.setattr(atexit, 'register', lambda func, *args, **kwargs: registered.append(func))
+
+    path = str(tmpdir.join('commands.json'))
+    cache = CommandPathCache(path)
+    cache.which('sh')
+    assert registered == []
+
+    cache.flush()
+    mtime = os.stat(path).st_mtime_ns
+    CommandPathCache(path).flush()
+    assert os.stat(path).st_mtime_ns == mtime
@@ -0,0 +1,181 @@
+# coding=utf-8
+"""Database tests
+
+Tree updates, tag reading and writing, and codec lookups
+"""
+
+import gc
+import os
+import weakref
+
+
+from sqlalchemy import event
+
+from soundforest import models
+from soundforest.database import CodecConfiguration, ConfigDB, TrackTagReader, TrackTagWriter
+from soundforest.tree import Tree
+
+
+class Statements(object):
+    """Count SQL statements per table during database updates"""
+
+    def __init__(self, db):
+        self.engine = db.session.bind
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self.execute)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(self.engine, 'before_cursor_execute', self.execute)
+
+    def execute(self, connection, cursor, statement, parameters, context, executemany):
+        self.statements.append(' '.join(statement.split()) + ' ')
+
+    def count(self, statement, table):
+        prefix = {'SELECT': 'FROM', 'INSERT': 'INSERT INTO', 'DELETE': 'DELETE FROM'}[statement]
+        return len([
+            item for item in self.statements
+            if item.upper().startswith(statement) and ' {} {} '.format(prefix, table) in ' ' + item
+        ])
+
+
+def test_tag_reader_processes_return_results_in_order(tmpdir, create_tree):
+    create_tree(str(tmpdir), albums=3, tracks=4)
+    paths = sorted(
+        os.path.join(root, filename) for root, directories, files in os.walk(str(tmpdir)) for filename in files
+    )
+
+    reader = TrackTagReader(ConfigDB(), processes=2)
+    results = list(reader.read(iter(paths), chunksize=5))
+
+    assert [result['path'] for result in results] == paths
+    assert [result['error'] for result in results] == [None] * len(paths)
+    assert [dict(result['tags'])['album'] for result in results] == [
+        ['Album {:d}'.format(album)] for album in range(3) for track in range(4)
+    ]
+
+
+def test_tag_reader_processes_do_not_reload_tracks(tmpdir, create_tree):
+    path = str(tmpdir.mkdir('tree'))
+    create_tree(path, albums=4, tracks=5)
+
+    db = ConfigDB()
+    db.add_tree(path)
+    with Statements(db) as statements:
+        assert db.update_tree(Tree(path), processes=2) == (20, 0, 0, 20, 0)
+    assert statements.count('SELECT', 'track') == 1
+    assert len(db.codecs) == len(set(codec.name for codec in db.codecs))
+
+
+def test_codec_extension_index_is_cached_and_invalidated():
+    db = ConfigDB()
+    codecs = db.codec_configuration
+    codec = db.get_codec('flac')
+
+    assert codecs.match('/music/track.FLAC') is codecs['flac']
+    assert codecs.match('/music/track.soundforest-test') is None
+    assert codecs.extension_index is codecs.extension_index
+
+    index = codecs.extension_index
+    codec.add_extension(db.session, 'soundforest-test')
+    assert codecs.extension_index is not index
+    assert codecs.match('/music/track.SOUNDFOREST-TEST') is codecs['flac']
+
+    codec.delete_extension(db.session, 'soundforest-test')
+    assert codecs.match('/music/track.soundforest-test') is None
+
+    extension = models.ExtensionModel(codec=codec, extension='soundforest-pending')
+    assert codecs.match('/music/track.soundforest-pending') is codecs['flac']
+    codec.extensions.remove(extension)
+    assert codecs.match('/music/track.soundforest-pending') is None
+
+
+def test_codec_configurations_do_not_register_listeners():
+    db = ConfigDB()
+    codecs = CodecConfiguration(db)
+    configuration = weakref.ref(codecs)
+    del codecs
+    gc.collect()
+    assert configuration() is None
+
+
+def test_incremental_update_retries_albums_with_failed_tracks(tmpdir, create_tree):
+    path = str(tmpdir.mkdir('tree'))
+    create_tree(path, albums=2, tracks=2)
+    album = os.path.join(path, 'Artist 0', 'Album 0')
+    broken = os.path.join(album, '01 Track 1.flac')
+    with open(broken, 'rb') as fd:
+        data = fd.read()
+    with open(broken, 'wb') as fd:
+        fd.write(b'broken')
+
+    db = ConfigDB()
+    db.add_tree(path)
+    assert db.update_tree(Tree(path), incremental=True) == (3, 0, 0, 4, 1)
+    db_album = [db_album for db_album in db.get_tree(path).albums if db_album.path == album][0]
+    assert db_album.mtime is None
+
+    with open(broken, 'wb') as fd:
+        fd.write(data)
+    os.utime(broken, (os.stat(broken).st_atime, os.stat(broken).st_mtime + 1))
+    assert db.update_tree(Tree(path), incremental=True) == (0, 1, 0, 2, 0)
+    assert db_album.mtime == os.stat(album).st_mtime
+    assert db.update_tree(Tree(path), incremental=True) == (0, 0, 0, 0, 0)
+
+
+def test_tree_update_loads_modified_tracks_once_per_batch(tmpdir, monkeypatch, create_tree):
+    path = str(tmpdir.mkdir('tree'))
+    create_tree(path, albums=4, tracks=5)
+
+    db = ConfigDB()
+    db.add_tree(path)
+    db.update_tree(Tree(path))
+
+    for root, directories, files in os.walk(path):
+        for filename in files:
+            filename = os.path.join(root, filename)
+            os.utime(filename, (os.stat(filename).st_atime, os.stat(filename).st_mtime + 1))
+
+    reader_read = TrackTagReader.read
+    session_tracks = []
+
+    def read(reader, paths):
+        session_tracks.append(len([item for item in db.session if isinstance(item, models.TrackModel)]))
+        return reader_read(reader, paths)
+
+    monkeypatch.setattr(TrackTagReader, 'read', read)
+    with Statements(db) as statements:
+        assert db.update_tree(Tree(path), batch_size=6) == (0, 20, 0, 20, 0)
+
+    assert statements.count('SELECT', 'track') == 1 + 4
+    assert statements.count('SELECT', 'albumpathcomponent') == 1
+    assert max(session_tracks) <= 6
+
+
+def test_tag_writer_replaces_tags_in_batches(tmpdir, create_tree):
+    path = str(tmpdir.mkdir('tree'))
+    create_tree(path, albums=1, tracks=5)
+
+    db = ConfigDB()
+    db.add_tree(path)
+    db.update_tree(Tree(path))
+    db_tracks = db.get_tree(path).tracks
+
+    writer = TrackTagWriter(db, batch_size=2)
+    with Statements(db) as statements:
+        for index, db_track in enumerate(db_tracks):
+            writer.add(db_track, [('title', ['Title {:d}'.format(index), 'Other']), ('genre', 'Genre')])
+        assert len(writer) == 1
+        writer.flush()
+
+    assert len(writer) == 0
+    assert statements.count('DELETE', 'tag') == 3
+    assert statements.count('INSERT', 'tag') == 3
+    for index, db_track in enumerate(db_tracks):
+        tags = db.query(models.TagModel).filter(models.TagModel.track_id == db_track.id)
+        assert sorted((tag.tag, tag.value) for tag in tags) == [
+            ('genre', 'Genre'),
+            ('title', 'Title {:d}'.format(index)),
+        ]
@@ -0,0 +1,190 @@
+# coding=utf-8
+"""Track export tests
+
+Exported tracks read back from NDJSON, CSV and XML output, and streaming
+XML track writer
+"""
+
+import csv
+import gzip
+import io
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT
+from lxml import etree as ET
+
+from soundforest.database import ConfigDB
+from soundforest.export import track_exporter, ExportError
+from soundforest.tags.xmltag import XMLTags, XMLTrackWriter
+from soundforest.tree import Tree
+
+
+def create_trees(tmpdir, create_tree):
+    """Create two trees in database, returning paths to the trees"""
+    db = ConfigDB()
+    paths = []
+    for name, tracks in (('first', 3), ('second', 1)):
+        path = str(tmpdir.mkdir(name))
+        create_tree(path, albums=2, tracks=tracks)
+        db.add_tree(path)
+        db.update_tree(Tree(path), update_checksum=True)
+        paths.append(path)
+    return db, paths
+
+
+def export(db, fileformat, trees=None):
+    output = io.BytesIO()
+    count = track_exporter(fileformat, db, output).export(trees)
+    return count, output.getvalue()
+
+
+def expected_tracks(path, tracks):
+    """Return tags of tracks generated by create_tree, by track path"""
+    expected = {}
+    for album in range(2):
+        for track in range(1, tracks + 1):
+            track_path = os.path.join(
+                path,
+                'Artist {:d}'.format(album),
+                'Album {:d}'.format(album),
+                '{:02d} Track {:d}.flac'.format(track, track),
+            )
+            expected[track_path] = {
+                'artist': 'Artist {:d}'.format(album),
+                'album': 'Album {:d}'.format(album),
+                'title': 'Track {:d}'.format(track),
+                'tracknumber': '{:d}'.format(track),
+            }
+    return expected
+
+
+def test_ndjson_export_round_trip(tmpdir, create_tree):
+    db, (first, second) = create_trees(tmpdir, create_tree)
+
+    count, data = export(db, 'ndjson', [db.get_tree(first)])
+    lines = data.decode('utf-8').splitlines()
+    assert count == len(lines) == 6
+
+    tracks = [json.loads(line) for line in lines]
+    assert dict((track['path'], track['tags']) for track in tracks) == expected_tracks(first, 3)
+    for track in tracks:
+        db_track = db.get_track(track['path'])
+        assert track['tree'] == first
+        assert track['checksum'] == db_track.checksum is not None
+        assert track['modified'] is not None
+
+    count, data = export(db, 'ndjson', [db.get_tree(first), db.get_tree(second)])
+    assert count == 8
+    assert set(json.loads(line)['tree'] for line in data.decode('utf-8').splitlines()) == set([first, second])
+
+
+def test_csv_export_round_trip(tmpdir, create_tree):
+    db, (first, second) = create_trees(tmpdir, create_tree)
+
+    count, data = export(db, 'csv', [db.get_tree(second)])
+    rows = list(csv.DictReader(io.StringIO(data.decode('utf-8'), newline='')))
+    assert count == len(rows) == 2
+    assert list(rows[0].keys()) == [
+        'tree', 'path', 'checksum', 'audio_checksum', 'albumart', 'modified',
+        'album', 'artist', 'title', 'tracknumber',
+    ]
+
+    tracks = dict(
+        (row['path'], dict((tag, row[tag]) for tag in ('artist', 'album', 'title', 'tracknumber')))
+        for row in rows
+    )
+    assert tracks == expected_tracks(second, 1)
+    assert all(row['tree'] == second for row in rows)
+    assert all(row['checksum'] == db.get_track(row['path']).checksum for row in rows)
+
+
+def test_unsupported_export_format():
+    with pytest.raises(ExportError):
+        track_exporter('yaml', ConfigDB(), io.BytesIO())
+
+
+class StreamOutput(io.BytesIO):
+    """Output which can't be seeked, like standard output"""
+
+    def seekable(self):
+        return False
+
+
+def xml_tracks(data):
+    """Return total attribute and tags of tracks by path from XML export"""
+    tracks = ET.fromstring(data).find('tracks')
+    details = {}
+    for track in tracks:
+        tags = dict((element.tag, element.text) for element in track)
+        if track.find('tracknumber') is not None:
+            tags['tracknumber'] = track.find('tracknumber').get('track')
+        details[tags.pop('path')] = tags
+    return tracks.get('total'), details
+
+
+def test_xml_export_round_trip(tmpdir, create_tree):
+    db, (first, second) = create_trees(tmpdir, create_tree)
+
+    count, data = export(db, 'xml', [db.get_tree(first)])
+    assert count == 6
+    assert xml_tracks(data) == ('6', expected_tracks(first, 3))
+
+
+def test_xml_writer_fills_in_total(tmpdir):
+    def write(output, tracks, total=None):
+        with XMLTrackWriter(output, total=total) as writer:
+            for index in range(tracks):
+                writer.append(XMLTags({'path': ['track {:d}'.format(index)], 'title': ['Title']}))
+        return writer.count
+
+    output = io.BytesIO()
+    assert write(output, 3) == 3
+    total, tracks = xml_tracks(output.getvalue())
+    assert int(total) == 3
+    assert sorted(tracks) == ['track 0', 'track 1', 'track 2']
+
+    output = io.BytesIO()
+    write(output, 2, total=2)
+    assert xml_tracks(output.getvalue())[0] == '2'
+
+    output = StreamOutput()
+    write(output, 2)
+    assert xml_tracks(output.getvalue()) == (None, {'track 0': {'title': 'Title'}, 'track 1': {'title': 'Title'}})
+
+    output = io.BytesIO()
+    with gzip.GzipFile(fileobj=output, mode='wb') as compressed:
+        write(compressed, 2)
+    total, tracks = xml_tracks(gzip.decompress(output.getvalue()))
+    assert total is None
+    assert sorted(tracks) == ['track 0', 'track 1']
+
+
+def test_export_command_writes_gzip_output(tmpdir, create_tree):
+    path = str(tmpdir.mkdir('tree'))
+    create_tree(path, albums=2, tracks=2)
+    env = dict(os.environ)
+    env['HOME'] = str(tmpdir.mkdir('home'))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, (ROOT, env.get('PYTHONPATH', None))))
+
+    def soundforest(*args):
+        command = [sys.executable, os.path.join(ROOT, 'bin', 'soundforest')] + list(args)
+        subprocess.check_call(command, env=env)
+
+    soundforest('tree', 'add', path)
+    soundforest('tree', 'update', path)
+    for fileformat in ('ndjson', 'xml'):
+        output = str(tmpdir.join('tracks.{}.gz'.format(fileformat)))
+        soundforest('export', '-f', fileformat, '-z', '-o', output)
+        with gzip.open(output, 'rb') as fd:
+            data = fd.read()
+
+        if fileformat == 'xml':
+            assert xml_tracks(data) == ('4', expected_tracks(path, 2))
+        else:
+            tracks = [json.loads(line) for line in data.decode('utf-8').splitlines()]
+            assert dict((track['path'], track['tags']) for track in tracks) == expected_tracks(path, 2)
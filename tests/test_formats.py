@@ -0,0 +1,55 @@
+# coding=utf-8
+"""File format tests
+
+Importing file format detection or running a cheap command doesn't load
+optional heavy dependencies
+"""
+
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+OPTIONAL_MODULES = ('PIL', 'requests', 'lxml')
+
+
+def test_formats_import_does_not_load_optional_modules():
+    script = '; '.join((
+        'import sys',
+        'import soundforest.formats',
+        'print(",".join(name for name in {!r} if name in sys.modules))'.format(OPTIONAL_MODULES),
+    ))
+    output = subprocess.check_output([sys.executable, '-c', script], cwd=ROOT)
+    assert output.decode('utf-8').strip() == ''
+
+
+def imported_modules(tmpdir, *args):
+    """Return names of modules imported by soundforest command
+
+    Runs bin/soundforest with given arguments and python -X importtime, and
+    returns imported module names from the import time report
+    """
+    env = dict(os.environ)
+    env['HOME'] = str(tmpdir)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, (ROOT, env.get('PYTHONPATH', None))))
+    output = subprocess.run(
+        [sys.executable, '-X', 'importtime', os.path.join(ROOT, 'bin', 'soundforest')] + list(args),
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=True,
+    ).stderr.decode('utf-8')
+
+    modules = []
+    for line in output.splitlines():
+        if line.startswith('import time:'):
+            modules.append(line.rsplit('|', 1)[1].strip())
+    return modules
+
+
+def test_config_list_does_not_load_optional_modules(tmpdir):
+    modules = imported_modules(tmpdir, 'config', 'list')
+    assert 'soundforest.cli' in modules
+    assert [name for name in modules if name.split('.')[0] in OPTIONAL_MODULES] == []
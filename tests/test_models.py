@@ -0,0 +1,145 @@
+# coding=utf-8
+"""Database model tests
+
+Schema upgrades are skipped for current SQLite databases, and run only
+once for older databases. Full text search indexes are kept in sync with
+tags and tracks, and matching falls back to LIKE without them.
+"""
+
+import pytest
+
+from sqlalchemy.engine import reflection
+
+from soundforest import models, SoundforestError
+
+
+def add_tracks(db, path, tracks):
+    """Add tree with tracks given as (directory, name, tags) to database"""
+    tree = models.TreeModel(path=path)
+    db.session.add(tree)
+    for directory, name, tags in tracks:
+        track = models.TrackModel(tree=tree, directory=directory, name=name, extension='flac')
+        db.session.add(track)
+        for tag, value in tags.items():
+            db.session.add(models.TagModel(track=track, tag=tag, value=value))
+    db.session.commit()
+    return tree
+
+
+def track_names(tracks):
+    return [track.name for track in tracks]
+
+
+def test_current_schema_is_not_reflected_or_upgraded(tmpdir, monkeypatch):
+    path = str(tmpdir.join('soundforest.sqlite'))
+    db = models.SoundforestDB(path)
+    assert db.session.execute('pragma user_version').scalar() == models.SCHEMA_VERSION
+    db.session.close()
+
+    upgrades = []
+
+    def reflect(engine):
+        raise AssertionError('Schema reflected for current database')
+
+    monkeypatch.setattr(reflection.Inspector, 'from_engine', reflect)
+    monkeypatch.setattr(models.SoundforestDB, '_upgrade_schema', lambda self, engine: upgrades.append(engine))
+
+    db = models.SoundforestDB(path)
+    assert upgrades == []
+
+    db.session.execute('pragma user_version = 0')
+    db.session.close()
+    models.SoundforestDB(path)
+    assert len(upgrades) == 1
+
+
+def test_checksum_cache_rows_without_path_are_removed_once(tmpdir):
+    db = models.SoundforestDB(str(tmpdir.join('soundforest.sqlite')))
+    engine = db.session.bind
+
+    def insert():
+        engine.execute("insert into checksum_cache (inode, algorithm, checksum) values (1, 'md5', 'md5:00')")
+
+    def cached():
+        return engine.execute('select count(*) from checksum_cache where path is null').scalar()
+
+    insert()
+    db._upgrade_schema(engine)
+    assert cached() == 1
+
+    engine.execute('pragma user_version = 1')
+    db._upgrade_schema(engine)
+    assert cached() == 0
+
+
+def test_search_indexes_are_ranked_and_kept_in_sync(tmpdir):
+    db = models.SoundforestDB(str(tmpdir.join('soundforest.sqlite')))
+    assert db.search_indexes
+    tree = add_tracks(db, '/music', (
+        ('/music/Beatles/Abbey Road', '01 Come Together', {'artist': 'The Beatles', 'title': 'Come Together'}),
+        ('/music/Beatles/Help', '01 Help', {'artist': 'The Beatles', 'title': 'Help! Help!'}),
+        ('/music/Björk/Post', '01 Army of Me', {'artist': 'Björk', 'title': 'Army of Me'}),
+    ))
+    other = add_tracks(db, '/other', (
+        ('/other/Help', '01 Help', {'artist': 'Various', 'title': 'Help'}),
+    ))
+
+    assert track_names(tree.match_tag(db.session, 'beat')) == ['01 Come Together', '01 Help']
+    assert track_names(db.search_tracks('help')) == ['01 Help', '01 Help']
+    assert db.search_tracks('help')[0].tree == tree
+    assert track_names(db.search_tracks('help', tree=other)) == ['01 Help']
+    assert track_names(db.search_tracks('bjork')) == ['01 Army of Me']
+    assert track_names(tree.filter_tracks(db.session, 'abbey')) == ['01 Come Together']
+    assert track_names(db.search_tracks('post army', paths=True)) == ['01 Army of Me']
+    assert track_names(db.search_tracks('together "', tree=tree)) == ['01 Come Together']
+    with pytest.raises(SoundforestError):
+        db.search_tracks(' ')
+
+    tag = db.session.query(models.TagModel).filter(models.TagModel.value == 'Army of Me').one()
+    tag.value = 'Hyperballad'
+    track = db.session.query(models.TrackModel).filter(models.TrackModel.name == '01 Come Together').one()
+    track.directory = '/music/Beatles/Let It Be'
+    db.session.commit()
+    assert db.search_tracks('army') == []
+    assert track_names(db.search_tracks('hyperballad')) == ['01 Army of Me']
+    assert db.search_tracks('abbey', paths=True) == []
+    assert track_names(db.search_tracks('let it be', paths=True)) == ['01 Come Together']
+
+    db.session.delete(other)
+    db.session.commit()
+    assert track_names(db.search_tracks('help')) == ['01 Help']
+    assert db.search_tracks('various') == []
+
+
+def test_search_falls_back_to_like_without_search_indexes(tmpdir, monkeypatch):
+    monkeypatch.setattr(models.SoundforestDB, '_create_search_indexes', lambda self, engine, tables: False)
+    db = models.SoundforestDB(str(tmpdir.join('soundforest.sqlite')))
+    assert db.session.execute('pragma user_version').scalar() == models.SCHEMA_VERSION
+    assert not db.search_indexes
+
+    tree = add_tracks(db, '/music', (
+        ('/music/Beatles/Abbey Road', '01 Come Together', {'artist': 'The Beatles', 'title': 'Come Together'}),
+        ('/music/Beatles/Help', '01 Help', {'artist': 'The Beatles', 'title': 'Help!'}),
+    ))
+    assert track_names(tree.match_tag(db.session, 'eatle')) == ['01 Come Together', '01 Help']
+    assert track_names(tree.match_tag(db.session, 'ether')) == ['01 Come Together']
+    assert track_names(tree.filter_tracks(db.session, 'bey Ro')) == ['01 Come Together']
+    with pytest.raises(SoundforestError):
+        db.search_tracks('help')
+
+    monkeypatch.undo()
+    db = models.SoundforestDB(str(tmpdir.join('soundforest.sqlite')))
+    assert db.search_indexes
+    assert track_names(db.search_tracks('together')) == ['01 Come Together']
+
+
+def test_match_tracks_by_tree_prefix_matches_whole_directories(tmpdir):
+    db = models.SoundforestDB(str(tmpdir.join('soundforest.sqlite')))
+    add_tracks(db, '/music', (
+        ('/music/a', '01 A', {}),
+        ('/music/a/b', '01 B', {}),
+        ('/music/ab', '01 AB', {}),
+        ('/other/music/a', '01 Other', {}),
+    ))
+    assert sorted(track_names(db.match_tracks_by_tree_prefix('/music/a'))) == ['01 A', '01 B']
+    assert sorted(track_names(db.match_tracks_by_tree_prefix('/music/a/'))) == ['01 A', '01 B']
@@ -0,0 +1,75 @@
+# coding=utf-8
+"""Tree prefix tests
+
+Prefix lookup order with symlinked prefixes, and cached realpaths of looked
+up directories
+"""
+
+import os
+
+import pytest
+
+from soundforest.prefixes import MusicTreePrefix, TreePrefixes
+
+
+@pytest.fixture
+def prefixes():
+    """Empty shared tree prefixes, restored after the test"""
+    prefixes = TreePrefixes()
+    registered = prefixes.copy()
+    prefixes.clear()
+    yield prefixes
+    prefixes.clear()
+    prefixes.extend(registered)
+
+
+def test_prefix_lookup_prefers_first_prefix_matching_realpath(tmpdir, prefixes):
+    real = str(tmpdir.mkdir('real'))
+    link = os.path.join(str(tmpdir), 'link')
+    os.symlink(real, link)
+    path = os.path.join(link, 'flac', 'Artist', 'Album')
+
+    prefixes.add_prefix(MusicTreePrefix(os.path.join(real, 'flac'), ['flac']))
+    prefixes.add_prefix(MusicTreePrefix(link, ['mp3']))
+
+    prefix, relative_path = prefixes.lookup(path)
+    assert prefix.path == os.path.join(real, 'flac')
+    assert relative_path == os.path.join('Artist', 'Album')
+
+    prefixes.pop(0)
+    assert prefixes.match(path).path == link
+    assert prefixes.relative_path(path) == os.path.join('flac', 'Artist', 'Album')
+
+    prefixes.remove(prefixes.match(path))
+    assert prefixes.match(path) is None
+
+
+def test_prefix_lookup_caches_directory_realpaths(tmpdir, prefixes, monkeypatch):
+    real = str(tmpdir.mkdir('real'))
+    link = os.path.join(str(tmpdir), 'link')
+    os.symlink(real, link)
+    album = os.path.join(link, 'mp3', 'Artist', 'Album')
+    os.makedirs(album)
+    os.symlink(os.path.join(album, '01 Track.mp3'), os.path.join(album, 'linked.mp3'))
+    prefixes.add_prefix(MusicTreePrefix(os.path.join(real, 'flac'), ['flac']))
+    prefixes.add_prefix(MusicTreePrefix(os.path.join(real, 'mp3'), ['mp3']))
+
+    resolved = []
+    realpath = os.path.realpath
+
+    def counting_realpath(path, *args, **kwargs):
+        resolved.append(path)
+        return realpath(path, *args, **kwargs)
+
+    monkeypatch.setattr(os.path, 'realpath', counting_realpath)
+    for track in range(10):
+        path = os.path.join(album, '{:02d} Track.mp3'.format(track))
+        assert prefixes.relative_path(path) == os.path.join('Artist', 'Album', '{:02d} Track.mp3'.format(track))
+    assert resolved == [album]
+
+    prefixes.relative_path(os.path.join(album, 'linked.mp3'))
+    assert resolved == [album, os.path.join(album, 'linked.mp3')]
+
+    prefixes.refresh()
+    prefixes.relative_path(os.path.join(album, '01 Track.mp3'))
+    assert resolved[-1] == album
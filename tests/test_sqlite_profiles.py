@@ -0,0 +1,19 @@
+# coding=utf-8
+"""SQLite profile tests
+
+Run the SQLite profile benchmark with a small tree
+"""
+
+from conftest import import_benchmark
+
+sqlite_profiles = import_benchmark('sqlite_profiles')
+
+
+def test_sqlite_profiles_benchmark(tmpdir):
+    results = sqlite_profiles.run(str(tmpdir), albums=2, tracks=2)
+
+    assert [(profile, journal_mode, tracks) for profile, journal_mode, tracks, inserted, updated in results] == [
+        ('default', 'delete', 4),
+        ('performance', 'wal', 4),
+        ('wal', 'wal', 4),
+    ]
@@ -0,0 +1,198 @@
+# coding=utf-8
+"""Directory sync tests
+
+Directory sync flags, limits of concurrent file copies and retagging of
+modified tracks
+"""
+
+import os
+import shutil
+import threading
+import time
+
+import pytest
+
+from mutagen.flac import FLAC
+
+from soundforest import sync
+from soundforest.checksum import audio_checksum
+from soundforest.sync import FilesystemSyncThread, SyncError, parse_directory_sync_flags
+from soundforest.tree import Track
+
+
+class FakeJob(object):
+    """Sync job of fake track"""
+
+    def __init__(self, index, size):
+        self.index = index
+        self.size = size
+        self.status = None
+        self.error = None
+
+
+class LimitedSyncThread(FilesystemSyncThread):
+    """Directory sync recording concurrent jobs instead of copying files"""
+
+    def __init__(self, jobs, **kwargs):
+        super(LimitedSyncThread, self).__init__(None, '1/1', **kwargs)
+        self.jobs = jobs
+        self.lock = threading.Lock()
+        self.active = []
+        self.max_jobs = 0
+        self.max_bytes = 0
+
+    def plan(self):
+        return list(self.jobs)
+
+    def sync_track(self, job):
+        with self.lock:
+            self.active.append(job)
+            self.max_jobs = max(self.max_jobs, len(self.active))
+            self.max_bytes = max(self.max_bytes, sum(j.size for j in self.active))
+        time.sleep(0.01)
+        with self.lock:
+            self.active.remove(job)
+        job.status = 'new'
+        return job
+
+
+def test_parse_directory_sync_flags():
+    assert parse_directory_sync_flags(None) == {}
+    assert parse_directory_sync_flags('copy_threads=8 copy_bytes=1024') == {
+        'copy_threads': 8,
+        'copy_bytes': 1024,
+    }
+
+    for flags in ('copy_threads', 'copy_threads=many', 'delete=1'):
+        with pytest.raises(SyncError):
+            parse_directory_sync_flags(flags)
+
+
+def test_sync_limits_concurrent_copies(tmpdir):
+    src = str(tmpdir.mkdir('src'))
+    dst = str(tmpdir.mkdir('dst'))
+
+    jobs = [FakeJob(i, 100) for i in range(12)]
+    thread = LimitedSyncThread(jobs, src=src, dst=dst, copy_threads=3, copy_bytes=250)
+    thread.run()
+
+    assert all(job.status == 'new' for job in jobs)
+    assert thread.max_jobs == 2
+    assert thread.max_bytes == 200
+
+
+def test_sync_copies_large_files_alone(tmpdir):
+    src = str(tmpdir.mkdir('src'))
+    dst = str(tmpdir.mkdir('dst'))
+
+    jobs = [FakeJob(0, 100), FakeJob(1, 1000), FakeJob(2, 100)]
+    thread = LimitedSyncThread(jobs, src=src, dst=dst, copy_threads=3, copy_bytes=250)
+    thread.run()
+
+    assert all(job.status == 'new' for job in jobs)
+    assert thread.max_bytes == 1000
+
+
+def test_sync_continues_after_unexpected_errors(tmpdir):
+    src = str(tmpdir.mkdir('src'))
+    dst = str(tmpdir.mkdir('dst'))
+
+    class FailingSyncThread(LimitedSyncThread):
+        def sync_track(self, job):
+            if job.index == 1:
+                raise OSError('No space left on device')
+            return super(FailingSyncThread, self).sync_track(job)
+
+    jobs = [FakeJob(i, 100) for i in range(4)]
+    thread = FailingSyncThread(jobs, src=src, dst=dst, copy_threads=2, copy_bytes=1000)
+    thread.run()
+
+    assert [job.status for job in jobs] == ['new', None, 'new', 'new']
+    assert isinstance(jobs[1].error, SyncError)
+    assert 'No space left on device' in str(jobs[1].error)
+    assert [job.error for job in jobs if job.index != 1] == [None, None, None]
+
+
+def test_retag_uses_stored_source_audio_checksum(tmpdir, monkeypatch, create_tree):
+    src = str(tmpdir.mkdir('src'))
+    dst = str(tmpdir.mkdir('dst'))
+    create_tree(src, albums=1, tracks=1)
+    src_path = os.path.join(src, 'Artist 0', 'Album 0', '01 Track 1.flac')
+    dst_path = os.path.join(dst, '01 Track 1.flac')
+
+    def retag(audio_checksums):
+        shutil.copyfile(src_path, dst_path)
+        tags = FLAC(src_path)
+        tags['title'] = 'Retagged {:d}'.format(len(reads))
+        tags.save()
+
+        thread = FilesystemSyncThread(None, '1/1', src=src, dst=dst, audio_checksums=audio_checksums(src_path))
+        assert thread.retag_track(Track(src_path), Track(dst_path))
+        assert FLAC(dst_path)['title'] == FLAC(src_path)['title']
+
+    reads = []
+
+    def read_audio_checksum(path, *args, **kwargs):
+        reads.append(path)
+        return audio_checksum(path, *args, **kwargs)
+
+    monkeypatch.setattr(sync, 'audio_checksum', read_audio_checksum)
+
+    retag(lambda path: {path: (Track(path).mtime, audio_checksum(path, 'sha1'))})
+    assert reads == [dst_path]
+
+    retag(lambda path: {path: (Track(path).mtime - 1, audio_checksum(path, 'sha1'))})
+    assert reads == [dst_path, src_path, dst_path]
+
+
+class RecordingSyncThread(FilesystemSyncThread):
+    """Directory sync recording jobs and copied files"""
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingSyncThread, self).__init__(*args, **kwargs)
+        self.jobs = []
+        self.copied = []
+
+    def plan(self):
+        self.jobs = super(RecordingSyncThread, self).plan()
+        return self.jobs
+
+    def copy_track(self, src, dst):
+        self.copied.append(src)
+        return super(RecordingSyncThread, self).copy_track(src, dst)
+
+
+def test_retagged_tracks_are_not_copied_on_next_sync(tmpdir, create_tree):
+    src = str(tmpdir.mkdir('src'))
+    dst = str(tmpdir.mkdir('dst'))
+    create_tree(src, albums=1, tracks=1)
+    src_path = os.path.join(src, 'Artist 0', 'Album 0', '01 Track 1.flac')
+
+    def sync():
+        thread = RecordingSyncThread(None, '1/1', src=src, dst=dst)
+        thread.run()
+        return [job.status for job in thread.jobs], thread.copied
+
+    assert sync() == (['new'], [src_path])
+    assert sync() == ([], [])
+
+    tags = FLAC(src_path)
+    tags['title'] = 'Retagged with a title longer than the tag padding ' * 200
+    tags.save()
+    assert sync() == (['retagged'], [])
+
+    # Tag padding differs after retagging, but audio and tags match
+    dst_path = os.path.join(dst, 'Artist 0', 'Album 0', '01 Track 1.flac')
+    FLAC(dst_path).save(padding=lambda info: 8192)
+    assert os.stat(src_path).st_size != os.stat(dst_path).st_size
+    assert sync() == (['skipped'], [])
+
+    # Tag edit within tag padding keeps the size, newer mtime is synced
+    shutil.copyfile(src_path, dst_path)
+    tags = FLAC(src_path)
+    tags['title'] = 'Retagged again'
+    tags.save(padding=lambda info: info.padding)
+    os.utime(src_path, (time.time() + 10, time.time() + 10))
+    assert os.stat(src_path).st_size == os.stat(dst_path).st_size
+    assert sync() == (['retagged'], [])
+    assert FLAC(dst_path)['title'] == ['Retagged again']
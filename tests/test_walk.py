@@ -0,0 +1,18 @@
+# coding=utf-8
+"""Tree walk tests
+
+Run the tree walk benchmark with small trees
+"""
+
+from conftest import import_benchmark
+
+walk = import_benchmark('walk')
+
+
+def test_parallel_walk_benchmark(tmpdir):
+    results = walk.run(str(tmpdir), fanouts=(1, 3), depth=2, files=2, threads=4, latency=1.0)
+
+    assert [(fanout, directories, files) for fanout, directories, files, serial, parallel in results] == [
+        (1, 3, 2),
+        (3, 13, 18),
+    ]
@@ -0,0 +1,77 @@
+# coding=utf-8
+"""Tree watcher tests
+
+Tree selection and retrying of failed directory updates
+"""
+
+import os
+
+from sqlalchemy.exc import OperationalError
+
+from soundforest import SoundforestError
+from soundforest.database import ConfigDB
+from soundforest.watch import TreeWatcher
+
+
+class LockedDB(object):
+    """Database failing all directory updates"""
+
+    def __init__(self):
+        self.rollbacks = 0
+
+    def update_directories(self, tree, directories, **kwargs):
+        raise OperationalError('update', {}, Exception('database is locked'))
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class FailingDB(LockedDB):
+    """Database failing directory updates in one tree"""
+
+    def __init__(self, failing):
+        super(FailingDB, self).__init__()
+        self.failing = failing
+        self.updated = []
+
+    def update_directories(self, tree, directories, **kwargs):
+        if tree.path == self.failing:
+            raise SoundforestError('Error updating {}'.format(tree.path))
+        self.updated.extend(path for path, recursive in directories)
+
+
+def test_watcher_retries_directories_after_database_errors(tmpdir):
+    path = str(tmpdir.mkdir('tree'))
+    album = os.path.join(path, 'album')
+    os.makedirs(album)
+    ConfigDB().add_tree(path)
+
+    watcher = TreeWatcher(paths=[path + os.sep], polling=True)
+    assert watcher.trees == [path]
+
+    watcher.db = LockedDB()
+    watcher.add_changes([(album, True)])
+
+    assert watcher.update(force=True) == 0
+    assert watcher.db.rollbacks == 1
+    assert list(watcher.pending) == [album]
+    assert watcher.pending[album][0] is True
+
+
+def test_watcher_counts_only_updated_directories(tmpdir):
+    paths = [str(tmpdir.mkdir(name)) for name in ('first', 'second')]
+    albums = []
+    for path in paths:
+        ConfigDB().add_tree(path)
+        for name in ('album 1', 'album 2'):
+            albums.append(os.path.join(path, name))
+            os.makedirs(albums[-1])
+
+    watcher = TreeWatcher(paths=paths, polling=True)
+    watcher.db = FailingDB(paths[0])
+    watcher.add_changes([(album, False) for album in albums])
+
+    assert watcher.update(force=True) == 2
+    assert sorted(watcher.db.updated) == albums[2:]
+    assert watcher.db.rollbacks == 1
+    assert watcher.pending == {}